@@ -0,0 +1,605 @@
+"""
+Writers for the ZIP and pack shards produced by the downloader.
+"""
+import os
+import time
+import zlib
+import struct
+import zipfile
+import threading as th
+from queue import Queue
+from collections import deque
+from pathlib import Path
+from operator import attrgetter
+
+from pack import PACK_SUFFIX
+from pack import TRAILER
+from pack import make_index
+from pack import make_trailer
+from pack import record_header
+from pack import scan_pack
+from tools import MB
+
+
+WRITE_BUFFER = 64 * MB
+
+
+class BufferedWriter:
+    """
+    Write files to a shard from a dedicated thread.
+
+    Any number of threads can call write. It returns once the file is
+    queued, but blocks while more than max_buffer bytes are waiting to be
+    written, so downloads cannot run arbitrarily far ahead of the disk.
+    Keys of files without data are appended to errpath instead.
+    Data is either bytes or an iterable of parts, e.g., a PartStream that
+    another thread fills with the parts of a RangedObject. Parts are
+    written to the shard as they arrive. Since they are not known yet,
+    the caller passes the size they may occupy in memory at most.
+    If iterating over them fails, the incomplete file is removed from
+    the shard again and counts as a file without data.
+
+    Subclasses implement _store and _finish.
+    """
+    def __init__(self, errpath=None, max_buffer=WRITE_BUFFER):
+        self.errpath = errpath
+        self.max_buffer = max_buffer
+        self.buffered = 0
+        self.error = None
+        self.cond = th.Condition()
+        self.queue = Queue()
+        self.thread = th.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def write(self, key, data, size=None):
+        if size is None:
+            size = len(data) if isinstance(data, bytes) else 0
+        with self.cond:
+            # a single file larger than the buffer is still accepted
+            while self.buffered and self.buffered + size > self.max_buffer \
+                    and self.error is None:
+                self.cond.wait()
+            if self.error is not None:
+                raise self.error
+            self.buffered += size
+        self.queue.put((key, data, size))
+
+    def _store(self, key, data):
+        """
+        Returns whether data was written to the shard.
+        """
+        raise NotImplementedError
+
+    def _finish(self):
+        """
+        Complete the shard after all files were written.
+        """
+        raise NotImplementedError
+
+    def _write(self, key, data):
+        if self._store(key, data):
+            return
+        if self.errpath is not None:
+            with self.errpath.open('at', encoding='utf-8') as err:
+                err.write(key+'\n')
+
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            key, data, size = item
+            written = False
+            try:
+                if self.error is None:
+                    self._write(key, data)
+                    written = True
+            except BaseException as e:
+                self.error = e
+            finally:
+                # release threads that still fill unwritten parts
+                if isinstance(data, PartStream):
+                    data.close(written)
+            with self.cond:
+                self.buffered -= size
+                self.cond.notify_all()
+
+    def stop(self):
+        """
+        Write all queued files and stop the writer thread.
+        """
+        self.queue.put(None)
+        self.thread.join()
+        self.thread = None
+
+    def close(self):
+        if self.thread is None:
+            return
+        self.stop()
+        self._finish()
+        if self.error is not None:
+            raise self.error
+
+    def abort(self):
+        """
+        Stop writing after the download was interrupted.
+        """
+        self.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+class PartStream:
+    """
+    Parts of one file that are passed from the thread that downloads them
+    to the writer thread. put blocks while maxsize parts are waiting,
+    so downloads cannot run ahead of the writer.
+    The downloading thread calls finish when all parts were put, or with
+    the error that stopped it. If the writer stops reading first, e.g.,
+    because writing failed, put returns False.
+    The writer closes the stream once it is done with the file,
+    wait returns whether the whole file was written.
+    """
+    def __init__(self, maxsize=1):
+        self.parts = deque()
+        self.maxsize = maxsize
+        self.cond = th.Condition()
+        self.finished = False
+        self.error = None
+        self.closed = False
+        self.consumed = False
+        self.written = False
+
+    def put(self, part):
+        with self.cond:
+            while len(self.parts) >= self.maxsize and not self.closed:
+                self.cond.wait()
+            if self.closed:
+                return False
+            self.parts.append(part)
+            self.cond.notify_all()
+            return True
+
+    def finish(self, error=None):
+        with self.cond:
+            self.finished = True
+            self.error = error
+            self.cond.notify_all()
+
+    def close(self, written=False):
+        with self.cond:
+            self.closed = True
+            self.written = written and self.consumed
+            self.parts.clear()
+            self.cond.notify_all()
+
+    def wait(self):
+        with self.cond:
+            while not self.closed:
+                self.cond.wait()
+            return self.written
+
+    def __iter__(self):
+        while True:
+            with self.cond:
+                while not self.parts and not self.finished:
+                    self.cond.wait()
+                if self.parts:
+                    part = self.parts.popleft()
+                    self.cond.notify_all()
+                elif self.error is not None:
+                    raise self.error
+                else:
+                    self.consumed = True
+                    return
+            yield part
+
+
+def write_parts(write, parts):
+    """
+    Call write with every part and return True,
+    or False if iterating over parts fails.
+    Errors of write are raised.
+    """
+    parts = iter(parts)
+    while True:
+        try:
+            part = next(parts)
+        except StopIteration:
+            return True
+        except Exception:
+            return False
+        write(part)
+
+
+def stream_parts(writer, key, parts, size, maxsize=1):
+    """
+    Write parts as one file from the calling thread, which iterates over
+    them and hands them to the writer thread through a PartStream.
+    Size is the most memory the parts in flight may take up, it counts
+    against the buffer of the writer while the file is written.
+    Returns the PartStream once all parts were handed over.
+    """
+    stream = PartStream(maxsize)
+    writer.write(key, stream, size)
+    parts = iter(parts)
+    try:
+        for part in parts:
+            if not stream.put(part):
+                break
+    except BaseException as e:
+        # the writer removes the incomplete file
+        stream.finish(e if isinstance(e, Exception) else InterruptedError())
+        if not isinstance(e, Exception):
+            raise
+    else:
+        stream.finish()
+    finally:
+        # stops requests for parts that are no longer needed
+        close = getattr(parts, 'close', None)
+        if close is not None:
+            close()
+    return stream
+
+
+class BufferedZipWriter(BufferedWriter):
+    """
+    BufferedWriter for ZIP archives.
+    Files are written in the order they arrive, but the central directory
+    is sorted by name on close, so namelist() of the finished archive is
+    deterministic.
+    """
+    def __init__(self, path, errpath=None, max_buffer=WRITE_BUFFER, mode='w'):
+        self.zip = zipfile.ZipFile(path, mode)
+        super().__init__(errpath, max_buffer)
+
+    def _write_parts(self, key, parts):
+        zinfo = zipfile.ZipInfo(key, time.localtime(time.time())[:6])
+        zinfo.compress_type = self.zip.compression
+        zinfo.external_attr = 0o600 << 16
+        with self.zip.open(zinfo, 'w', force_zip64=True) as fp:
+            complete = write_parts(fp.write, parts)
+        if not complete:
+            # remove the incomplete file, the next file overwrites it
+            self.zip.filelist.remove(zinfo)
+            del self.zip.NameToInfo[key]
+            self.zip.fp.seek(zinfo.header_offset)
+            self.zip.fp.truncate()
+            self.zip.start_dir = zinfo.header_offset
+        return complete
+
+    def _store(self, key, data):
+        """
+        Returns whether data was written to the archive.
+        """
+        if not data:
+            return False
+        if isinstance(data, bytes):
+            self.zip.writestr(key, data)
+            return True
+        return self._write_parts(key, data)
+
+    def _finish(self):
+        self.zip.filelist.sort(key=attrgetter('filename'))
+        self.zip.close()
+
+
+def fsync_path(path):
+    with open(path, 'rb') as fp:
+        os.fsync(fp.fileno())
+
+
+def write_failed(errpath, failed):
+    """
+    Write the sorted keys of failed files to errpath,
+    or remove it if there are none.
+    """
+    if errpath is None:
+        return
+    if failed:
+        with errpath.open('wt', encoding='utf-8') as err:
+            for key in sorted(failed):
+                err.write(key+'\n')
+    else:
+        errpath.unlink(missing_ok=True)
+
+
+class JournaledZipWriter(BufferedZipWriter):
+    """
+    BufferedZipWriter that can resume interrupted shards.
+
+    Files are written to <path>.part. After every checkpoint_files files
+    the archive is closed, which writes its central directory, and the
+    position and content of the central directory are saved in
+    <path>.ckpt before the archive is reopened for appending.
+    If the writer is interrupted, the archive is checkpointed on exit.
+    When a writer is created for a path with an existing part file, the
+    part file is restored to its last checkpoint and keys contains the
+    files it holds, so they need not be downloaded again.
+
+    Keys of failed files are collected and written to errpath without
+    duplicates when the writer is closed. Finally, the part file is
+    renamed to path, so path only ever contains complete shards.
+    """
+    def __init__(
+            self,
+            path,
+            errpath=None,
+            max_buffer=WRITE_BUFFER,
+            checkpoint_files=1000,
+    ):
+        path = Path(path)
+        self.path = path
+        self.partpath = path.with_name(path.name + '.part')
+        self.ckptpath = path.with_name(path.name + '.ckpt')
+        self.restore()
+        super().__init__(self.partpath, None, max_buffer, mode='a')
+        self.keys = set(self.zip.namelist())
+        self.failed = set()
+        self.final_errpath = errpath
+        self.checkpoint_files = checkpoint_files
+        self.uncommitted = 0
+
+    def restore(self):
+        if not self.partpath.exists():
+            self.ckptpath.unlink(missing_ok=True)
+            return
+        try:
+            ckpt = self.ckptpath.read_bytes()
+        except FileNotFoundError:
+            # interrupted before the first checkpoint
+            self.partpath.unlink()
+            return
+        offset, = struct.unpack_from('<Q', ckpt)
+        # files after the checkpoint overwrote its central directory,
+        # drop them and put the directory back
+        with self.partpath.open('r+b') as fp:
+            fp.truncate(offset)
+            fp.seek(offset)
+            fp.write(ckpt[8:])
+
+    def _write(self, key, data):
+        if self._store(key, data):
+            self.uncommitted += 1
+            if self.uncommitted >= self.checkpoint_files:
+                self.checkpoint(reopen=True)
+        else:
+            self.failed.add(key)
+
+    def checkpoint(self, reopen):
+        offset = self.zip.start_dir
+        self.zip.close()
+        with self.partpath.open('rb') as fp:
+            os.fsync(fp.fileno())
+            fp.seek(offset)
+            tail = fp.read()
+        tmppath = self.ckptpath.with_name(self.ckptpath.name + '.tmp')
+        with tmppath.open('wb') as fp:
+            fp.write(struct.pack('<Q', offset))
+            fp.write(tail)
+            fp.flush()
+            os.fsync(fp.fileno())
+        os.replace(tmppath, self.ckptpath)
+        self.uncommitted = 0
+        if reopen:
+            self.zip = zipfile.ZipFile(self.partpath, 'a')
+
+    def close(self):
+        if self.thread is None:
+            return
+        super().close()
+        fsync_path(self.partpath)
+        os.replace(self.partpath, self.path)
+        self.ckptpath.unlink(missing_ok=True)
+        write_failed(self.final_errpath, self.failed)
+
+    def abort(self):
+        """
+        Keep the part file for later and checkpoint it.
+        """
+        if self.thread is None:
+            return
+        self.stop()
+        if self.error is None:
+            self.checkpoint(reopen=False)
+        else:
+            # the part file is restored to the last checkpoint later
+            self.zip.fp.close()
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+
+class PackWriter(BufferedWriter):
+    """
+    BufferedWriter for pack shards, see pack.py.
+
+    Like JournaledZipWriter, files are written to <path>.part and the
+    length of the part file is saved in <path>.ckpt after every
+    checkpoint_files files and when the writer is interrupted.
+    With resume, an existing part file is truncated to its last
+    checkpoint and keys contains the files it holds. Records describe
+    themselves, so only their headers are read to find them.
+    On close, the index is appended and the part file renamed to path.
+    Keys of failed files are written to errpath on close.
+    """
+    def __init__(
+            self,
+            path,
+            errpath=None,
+            max_buffer=WRITE_BUFFER,
+            checkpoint_files=1000,
+            resume=True,
+    ):
+        path = Path(path)
+        self.path = path
+        self.partpath = path.with_name(path.name + '.part')
+        self.ckptpath = path.with_name(path.name + '.ckpt')
+        if not resume:
+            self.partpath.unlink(missing_ok=True)
+            self.ckptpath.unlink(missing_ok=True)
+        self.entries = self.restore()
+        self.fp = self.partpath.open(
+            'r+b' if self.partpath.exists() else 'wb'
+        )
+        self.fp.seek(0, os.SEEK_END)
+        self.keys = {entry[0] for entry in self.entries}
+        self.failed = set()
+        self.final_errpath = errpath
+        self.checkpoint_files = checkpoint_files
+        self.uncommitted = 0
+        super().__init__(None, max_buffer)
+
+    def restore(self):
+        """
+        Returns index entries of the files in the part file
+        after truncating it to the last checkpoint.
+        """
+        if not self.partpath.exists():
+            self.ckptpath.unlink(missing_ok=True)
+            return []
+        try:
+            ckpt = self.ckptpath.read_bytes()
+        except FileNotFoundError:
+            # interrupted before the first checkpoint
+            self.partpath.unlink()
+            return []
+        offset, = struct.unpack_from('<Q', ckpt)
+        with self.partpath.open('r+b') as fp:
+            fp.truncate(offset)
+            return scan_pack(fp)
+
+    def _store(self, key, data):
+        if not data:
+            return False
+        fp = self.fp
+        start = fp.tell()
+        if isinstance(data, bytes):
+            length, crc = len(data), zlib.crc32(data)
+            fp.write(record_header(key, length, crc))
+            offset = fp.tell()
+            fp.write(data)
+        else:
+            # the header is completed once all parts are written
+            fp.write(record_header(key, 0, 0))
+            offset = fp.tell()
+            length = crc = 0
+
+            def write(part):
+                nonlocal length, crc
+                length += len(part)
+                crc = zlib.crc32(part, crc)
+                fp.write(part)
+
+            if not write_parts(write, data):
+                fp.seek(start)
+                fp.truncate()
+                return False
+            fp.seek(start)
+            fp.write(record_header(key, length, crc))
+            fp.seek(0, os.SEEK_END)
+        self.entries.append((key, offset, length, crc))
+        return True
+
+    def _write(self, key, data):
+        if self._store(key, data):
+            self.uncommitted += 1
+            if self.uncommitted >= self.checkpoint_files:
+                self.checkpoint()
+        else:
+            self.failed.add(key)
+
+    def checkpoint(self):
+        self.fp.flush()
+        os.fsync(self.fp.fileno())
+        tmppath = self.ckptpath.with_name(self.ckptpath.name + '.tmp')
+        with tmppath.open('wb') as fp:
+            fp.write(struct.pack('<Q', self.fp.tell()))
+            fp.flush()
+            os.fsync(fp.fileno())
+        os.replace(tmppath, self.ckptpath)
+        self.uncommitted = 0
+
+    def _finish(self):
+        fp = self.fp
+        index_offset = fp.tell()
+        fp.write(make_index(self.entries))
+        fp.write(make_trailer(len(self.entries), index_offset))
+        fp.flush()
+        os.fsync(fp.fileno())
+        fp.close()
+        os.replace(self.partpath, self.path)
+        self.ckptpath.unlink(missing_ok=True)
+        write_failed(self.final_errpath, self.failed)
+
+    def close(self):
+        if self.thread is None:
+            return
+        self.stop()
+        if self.error is not None:
+            # the part file is restored to the last checkpoint later
+            self.fp.close()
+            raise self.error
+        self._finish()
+
+    def abort(self):
+        """
+        Keep the part file for later and checkpoint it.
+        """
+        if self.thread is None:
+            return
+        self.stop()
+        if self.error is None:
+            self.checkpoint()
+        self.fp.close()
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+
+def append_writer(path, max_buffer=WRITE_BUFFER):
+    """
+    Returns a journaled writer that appends files to the finished ZIP or
+    pack shard at path, with keys of the files it already holds.
+    The shard is moved back to its part file with a checkpoint at its
+    current end, so if appending is interrupted, the next writer for path
+    restores the shard as it was before and continues from there.
+    Failed files are not recorded by the writer.
+    """
+    path = Path(path)
+    pack = path.name.endswith(PACK_SUFFIX)
+    partpath = path.with_name(path.name + '.part')
+    ckptpath = path.with_name(path.name + '.ckpt')
+    if path.exists():
+        if pack:
+            with path.open('rb') as fp:
+                fp.seek(-TRAILER.size, os.SEEK_END)
+                _, _, _, offset = TRAILER.unpack(fp.read(TRAILER.size))
+            # records end where the index starts
+            ckpt = struct.pack('<Q', offset)
+        else:
+            with zipfile.ZipFile(path, 'r') as z:
+                offset = z.start_dir
+            with path.open('rb') as fp:
+                fp.seek(offset)
+                ckpt = struct.pack('<Q', offset) + fp.read()
+        tmppath = ckptpath.with_name(ckptpath.name + '.tmp')
+        with tmppath.open('wb') as fp:
+            fp.write(ckpt)
+            fp.flush()
+            os.fsync(fp.fileno())
+        os.replace(tmppath, ckptpath)
+        os.replace(path, partpath)
+    if pack:
+        return PackWriter(path, None, max_buffer, resume=True)
+    return JournaledZipWriter(path, None, max_buffer)
@@ -1,11 +1,9 @@
 """
 Convert YFCC100m dataset shards into the datadings msgpack format.
+Shards can be ZIP files or packs.
 """
-import io
-import zipfile
 from pathlib import Path
 from multiprocessing.pool import ThreadPool
-from math import ceil
 
 from datadings.writer import FileWriter
 
@@ -14,78 +12,20 @@ from .tools import WorkerBase
 from .tools import DATAKEYS
 from .tools import load_finished_shards
 from .tools import shard_finished
+from .tools import validate_filter
+from .images import transcode_image
+from .pack import PACK_SUFFIX
+from .pack import iter_shard
+from .pack import read_keys
 
-import numpy as np
-from PIL import Image
 from tqdm import tqdm
-from simplejpeg import decode_jpeg
-from simplejpeg import decode_jpeg_header
-from simplejpeg import encode_jpeg
 from datadings.tools import yield_threaded
 
 
-def encode_fast(
-        arr,
-        quality=85,
-        colorspace='RGB',
-        colorsubsampling='422',
-        long_side=500,
-        target_pixels=500*375,
-):
-    h, w = arr.shape[:2]
-    # enforce full color resolution for small images
-    if h*w <= 0.5*target_pixels:
-        colorsubsampling = '444'
-    # downscale big images
-    if h*w > 1.5*target_pixels:
-        s = max(w, h)
-        r = long_side/s
-        w, h = int(round(r*w)), int(round(r*h))
-        pil = Image.fromarray(arr, 'RGB')
-        arr = np.array(pil.resize((w, h), resample=Image.LANCZOS))
-    return encode_jpeg(
-        arr,
-        quality=quality,
-        colorspace=colorspace,
-        colorsubsampling=colorsubsampling,
-    )
-
-
-def decode_fast(data):
-    try:
-        # decode JPEGs at reduced size for speedup
-        return data, False, decode_jpeg(
-            data,
-            'gray',
-            fastdct=True,
-            fastupsample=True,
-            min_height=100,
-            min_width=100,
-            min_factor=1,
-        )
-    except ValueError:
-        # use pillow in case anything goes wrong
-        # and re-encode the image
-        bio = io.BytesIO(data)
-        im = Image.open(bio)
-        data = encode_fast(np.array(im.convert('RGB')))
-        return data, True, np.array(im.convert('L'))
-
-
-def validate_image(data):
-    try:
-        data, compressed, im = decode_fast(data)
-        # if the compressed image is very small
-        # and less than 5% of all lines have significant variance
-        # the image is most likely garbage
-        if len(data) < 20000 and np.percentile(im.var(0), 95) < 50:
-            return None, False
-        return data, compressed
-    except (ValueError, IOError, OSError):
-        return None, False
-
-
 def sharp_path(indir, shard):
+    path = indir / (shard + PACK_SUFFIX)
+    if path.exists():
+        return path
     return indir / (shard + '.zip')
 
 
@@ -117,52 +57,37 @@ class Converter(WorkerBase):
         self.compress = compress
         self.subsampling = subsampling
         self.target_size = target_size
-        self.short_side = int(ceil(target_size / 4 * 3))
-        self.target_pixels = target_size * self.short_side
 
     def yield_samples(self, shard):
         metadata = {
             meta['key']: meta
             for meta in self.prepare_metadata(shard)
         }
-        with zipfile.ZipFile(sharp_path(self.indir, shard), 'r') as z:
-            for file in z.infolist():
-                key = Path(file.filename).stem
-                if key in metadata:
-                    sample = metadata.pop(key)
-                    datakey = DATAKEYS[sample['marker']]
-                    sample[datakey] = z.open(file).read()
-                    yield sample
+        for name, data in iter_shard(sharp_path(self.indir, shard)):
+            key = Path(name).stem
+            if key in metadata:
+                sample = metadata.pop(key)
+                datakey = DATAKEYS[sample['marker']]
+                sample[datakey] = data
+                yield sample
 
     def convert_file(self, sample):
         datakey = DATAKEYS[sample['marker']]
         # handle image recompression
         if sample['marker'] == 0:
-            data, compressed = validate_image(sample[datakey])
+            data = transcode_image(
+                sample[datakey],
+                self.compress,
+                self.subsampling,
+                self.target_size,
+            )
             if data is None:
                 return None
-            if self.compress and not compressed:
-                h, w, _, _ = decode_jpeg_header(data)
-                # do not compress small images
-                if h * w > 0.5 * self.target_pixels:
-                    arr = decode_jpeg(
-                        data,
-                        min_width=self.short_side,
-                        min_height=self.short_side,
-                    )
-                    data = encode_fast(
-                        arr,
-                        quality=self.compress,
-                        colorsubsampling=self.subsampling,
-                        target_pixels=self.target_pixels,
-                        long_side=self.target_size,
-                    )
             sample[datakey] = data
         return sample
 
     def convert_files(self, shard):
-        with zipfile.ZipFile(sharp_path(self.indir, shard), 'r') as z:
-            num_files = len(z.infolist())
+        num_files = len(read_keys(sharp_path(self.indir, shard)))
         pool = ThreadPool(self.threads)
         gen = yield_threaded(self.yield_samples(shard))
         with self.position() as position:
@@ -281,13 +206,14 @@ def main():
     )
 
     def _evalable(v):
-        eval(v)
+        validate_filter(v)
         return v
     parser.add_argument(
         '--filter',
         type=_evalable,
         default='lambda x: True',
-        help='Lambda function to select samples.'
+        help='Lambda function or filter expression to select samples, '
+             'e.g., "accuracy >= 12 and usertags has beach".'
     )
     parser.add_argument(
         '--overwrite',
@@ -9,6 +9,20 @@ counting the number of exported samples with:
     zcat <meta dir>/*.gz | wc -l
 It should show 100,000,000 lines across all files.
 
+Progress is checkpointed regularly (see --checkpoint). If the conversion is
+interrupted, running it again continues from the last checkpoint.
+
+With --processes N the database is split into N rowid ranges that are
+converted in parallel and merged afterwards. The result is identical to the
+single process conversion.
+
+With --columnar an additional <shard>.npz file is written for each shard.
+It stores samples column-wise, so the other tools can load only the columns
+they need (e.g. key, marker, and ext for downloads) in a fraction of the time.
+
+With --index sorted indexes key_index.bin and photoid_index.bin are written.
+Use metadata_index.MetadataIndex to find the shard and row of samples.
+
 IMPORTANT: After progress reaches 100% all remaining cached samples are flushed
            to files before the program exits. This may take a few minutes.
 
@@ -32,15 +46,30 @@ IMPORTANT: Needs AWS credentials to work. Create an AWS account (credit card
            aws_access_key_id = <key>
            aws_secret_access_key = <secret>
 """
-import gzip
+import os
 import json
+import time
+import zlib
+import random
+import shutil
 import sqlite3
+import threading as th
+import itertools as it
+import multiprocessing as mp
 from multiprocessing import Process
 from hashlib import md5
+from functools import partial
 from collections import defaultdict
+from collections import deque
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 
 import boto3
+import numpy as np
+from botocore.config import Config
+from botocore.exceptions import ClientError
+from botocore.exceptions import BotoCoreError
 from tqdm import tqdm
 from datadings.tools import yield_threaded
 
@@ -48,8 +77,18 @@ from .vars import FILES
 from .vars import TOTAL
 from .vars import AWS_KEY
 from .vars import BUCKET_NAME
+from .tools import MB
 from .tools import IterableQueue
+from .tools import load_metadata
+from .tools import find_meta_shards
+from .tools import load_jsonl
+from .tools import save_columns
 from .tools import make_meta_shard_names
+from .tools import make_columnar_shard_names
+from .metadata_index import KEY_INDEX
+from .metadata_index import PHOTOID_INDEX
+from .metadata_index import KEY_DTYPE
+from .metadata_index import PHOTOID_DTYPE
 
 
 def download_db(files):
@@ -65,6 +104,120 @@ def download_db(files):
         obj.download_file(str(outpath), Callback=lambda n: p.update(n))
 
 
+def make_s3_client(endpoint_url=None, max_pool_connections=10):
+    config = Config(max_pool_connections=max_pool_connections)
+    if endpoint_url:
+        config = config.merge(Config(s3={'addressing_style': 'path'}))
+    return boto3.Session().client(
+        's3', endpoint_url=endpoint_url, config=config
+    )
+
+
+def download_db_ranged(
+        files,
+        parallel=16,
+        part_size=16*MB,
+        endpoint_url=None,
+        retries=5,
+):
+    """
+    Download the DB file in parts of part_size bytes with parallel
+    range requests into a preallocated file.
+    The md5 of the file is computed while parts arrive in order,
+    so no second pass over the file is needed.
+    Finished parts are recorded in <path>.parts, an interrupted download
+    resumes with the missing parts (finished parts are hashed from disk).
+    Failed requests are retried with exponential backoff.
+
+    Returns True if the file was downloaded and verified,
+    False if it already existed.
+    """
+    outpath = Path(files['db']['path'])
+    statepath = outpath.with_name(outpath.name + '.parts')
+    if outpath.exists() and not statepath.exists():
+        return False
+    client = make_s3_client(endpoint_url, parallel)
+    total = client.head_object(Bucket=BUCKET_NAME, Key=AWS_KEY)['ContentLength']
+    num_parts = -(-total // part_size)
+
+    done = set()
+    if outpath.exists() and outpath.stat().st_size == total:
+        with statepath.open('rt', encoding='utf-8') as fp:
+            done = {int(line) for line in fp if line.strip()}
+    else:
+        # the state file is written first, a file without one is complete
+        statepath.write_text('')
+        with outpath.open('wb') as fp:
+            fp.truncate(total)
+
+    fd = os.open(outpath, os.O_RDWR)
+
+    def part_range(i):
+        start = i * part_size
+        return start, min(total, start + part_size) - 1
+
+    def fetch(i):
+        start, end = part_range(i)
+        for attempt in range(retries):
+            try:
+                response = client.get_object(
+                    Bucket=BUCKET_NAME,
+                    Key=AWS_KEY,
+                    Range=f'bytes={start}-{end}',
+                )
+                data = response['Body'].read()
+                if len(data) != end - start + 1:
+                    raise IOError(f'short read for part {i}')
+                break
+            except (ClientError, BotoCoreError, IOError):
+                if attempt == retries - 1:
+                    raise
+                # exponential backoff with full jitter like transfer.py
+                delay = min(30.0, 0.1 * 2 ** (attempt + 1))
+                time.sleep(random.uniform(0, delay))
+        os.pwrite(fd, data, start)
+        return data
+
+    h = md5()
+    try:
+        with tqdm(total=total, unit='B', unit_scale=True, desc=outpath.name) as p, \
+                statepath.open('at', encoding='utf-8') as state, \
+                ThreadPoolExecutor(parallel) as executor:
+            # parts are hashed in order, so the number of parts
+            # held in memory is limited to a window
+            window = deque()
+
+            def consume():
+                i, future = window.popleft()
+                if future is None:
+                    start, end = part_range(i)
+                    data = os.pread(fd, end - start + 1, start)
+                else:
+                    data = future.result()
+                    state.write(f'{i}\n')
+                    state.flush()
+                h.update(data)
+                p.update(len(data))
+
+            for i in range(num_parts):
+                future = None if i in done else executor.submit(fetch, i)
+                window.append((i, future))
+                if len(window) > 2 * parallel:
+                    consume()
+            while window:
+                consume()
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+    if h.hexdigest() != files['db']['md5']:
+        outpath.unlink()
+        statepath.unlink()
+        raise ValueError(f'md5 of {outpath} does not match')
+    statepath.unlink()
+    return True
+
+
 BYTE_MAP = {'%02x' % v: '%x' % v for v in range(256)}
 
 
@@ -74,13 +227,49 @@ def yfcc_hash(url, __bm=BYTE_MAP):
     return ''.join(__bm[h[x:x+2]] for x in range(0, 32, 2))
 
 
+HEX_DIGITS = np.frombuffer(b'0123456789abcdef', dtype=np.uint8)
+
+
+# noinspection PyDefaultArgument
+def yfcc_hash_batch(urls, __hd=HEX_DIGITS):
+    """
+    Same as ``yfcc_hash``, but for a sequence of URLs.
+    Only the md5 digests are computed per URL,
+    conversion to hex digits is done on all digests at once.
+    """
+    digests = np.frombuffer(
+        b''.join(md5(url.encode('utf-8')).digest() for url in urls),
+        dtype=np.uint8,
+    ).reshape(-1, 16)
+    high = digests >> 4
+    nibbles = np.stack((high, digests & 15), axis=2).reshape(-1, 32)
+    # like '%x' % v drop the leading zero of each byte
+    keep = np.ones(nibbles.shape, dtype=bool)
+    keep[:, 0::2] = high != 0
+    chars = __hd[nibbles[keep]].tobytes().decode('ascii')
+    ends = np.cumsum(keep.sum(axis=1)).tolist()
+    return [chars[a:b] for a, b in zip([0] + ends[:-1], ends)]
+
+
 def get_cols(path, table):
     conn = sqlite3.connect(path)
     result = conn.execute(f'select * from {table} limit 0').description
     return [c[0] for c in result]
 
 
-def generate_rows_from_db(path, table):
+def get_rowid_range(path, table):
+    conn = sqlite3.connect(path)
+    return conn.execute(f'select min(rowid), max(rowid) from {table}').fetchone()
+
+
+def split_rowid_range(first, last, parts):
+    # split [first, last] into half-open ranges of (almost) equal size
+    step = max(1, -(-(last - first + 1) // parts))
+    return [(start, min(start + step, last + 1))
+            for start in range(first, last + 1, step)]
+
+
+def generate_rows_from_db(path, table, start=None, end=None):
     conn = sqlite3.connect(path)
     # get column names
     # some settings that hopefully speed up the queries
@@ -90,8 +279,20 @@ def generate_rows_from_db(path, table):
     conn.execute(f'PRAGMA page_size = 4096')
     conn.execute(f'PRAGMA mmap_size = {4*1024*1024}')
     conn.execute(f'PRAGMA cache_size = 10000')
-    # retrieve rows in order
-    yield from conn.execute(f'select * from {table}')
+    # retrieve rows in order, together with their rowid
+    query = f'select rowid, * from {table}'
+    where = []
+    params = []
+    if start is not None:
+        where.append('rowid >= ?')
+        params.append(start)
+    if end is not None:
+        where.append('rowid < ?')
+        params.append(end)
+    if where:
+        query += ' where ' + ' and '.join(where) + ' order by rowid'
+    for rowid, *row in conn.execute(query, params):
+        yield rowid, row
 
 
 def _int_none(v):
@@ -102,58 +303,455 @@ def _float_none(v):
     return float(v) if v else None
 
 
-def create_sample(row, cols):
-    row = dict(zip(cols, row))
-    row['key'] = yfcc_hash(row['downloadurl'])
-    row['longitude'] = _float_none(row['longitude'])
-    row['latitude'] = _float_none(row['latitude'])
-    row['accuracy'] = _int_none(row['accuracy'])
-    return row
+def create_samples(rows, cols):
+    samples = [dict(zip(cols, row)) for row in rows]
+    keys = yfcc_hash_batch([sample['downloadurl'] for sample in samples])
+    for sample, key in zip(samples, keys):
+        sample['key'] = key
+        sample['longitude'] = _float_none(sample['longitude'])
+        sample['latitude'] = _float_none(sample['latitude'])
+        sample['accuracy'] = _int_none(sample['accuracy'])
+    return samples
 
 
-def write_buckets(queue):
+def create_sample(row, cols):
+    return create_samples([row], cols)[0]
+
+
+def generate_samples(rows, cols, hash_chunk_size=1024):
+    """
+    Create samples from (rowid, row) pairs in chunks.
+    Yields the rowid of the last row and the samples of each chunk.
+    """
+    rows = iter(rows)
+    for chunk in iter(lambda: list(it.islice(rows, hash_chunk_size)), []):
+        rowids, chunk = zip(*chunk)
+        yield rowids[-1], create_samples(chunk, cols)
+
+
+class GzipStream:
+    """
+    Append-only gzip stream. Each stream adds one gzip member to the file.
+    """
+    def __init__(self, path, compresslevel=1):
+        self.fp = open(path, 'ab')
+        self.compressor = zlib.compressobj(compresslevel, zlib.DEFLATED, 31)
+        self.lock = th.Lock()
+        self.closed = False
+
+    def write(self, data):
+        out = self.compressor.compress(data)
+        self.fp.write(out)
+        return len(out)
+
+    def close(self):
+        out = self.compressor.flush()
+        self.fp.write(out)
+        self.fp.close()
+        self.closed = True
+        return len(out)
+
+
+def sync_file(path):
+    with open(path, 'rb') as fp:
+        os.fsync(fp.fileno())
+
+
+class ShardWriter:
+    """
+    Write data to many gzip files at once.
+
+    Data is buffered per file and flushed when the buffer of a file
+    reaches ``flush_bytes`` or all buffers combined exceed
+    ``memory_budget``, in which case the largest buffer is flushed.
+    Flushed data is compressed by a pool of ``threads``.
+    At most ``max_open`` compressed streams are kept open,
+    the least recently used stream is closed to open another.
+    """
+    def __init__(
+            self,
+            max_open=256,
+            flush_bytes=MB,
+            memory_budget=256*MB,
+            threads=4,
+            compresslevel=1,
+    ):
+        self.max_open = max_open
+        self.flush_bytes = flush_bytes
+        self.memory_budget = memory_budget
+        self.compresslevel = compresslevel
+        self.buffers = defaultdict(list)
+        self.buffered = defaultdict(int)
+        self.total_buffered = 0
+        self.streams = OrderedDict()
+        self.streams_lock = th.Lock()
+        self.pending = {}
+        self.modified = set()
+        self.in_flight = th.BoundedSemaphore(2 * threads)
+        self.executor = ThreadPoolExecutor(threads)
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.start = time.monotonic()
+
+    def write(self, path, data):
+        self.buffers[path].append(data)
+        self.buffered[path] += len(data)
+        self.total_buffered += len(data)
+        if self.buffered[path] >= self.flush_bytes:
+            self.flush(path)
+        while self.total_buffered > self.memory_budget:
+            self.flush(max(self.buffered, key=self.buffered.get))
+
+    def flush(self, path):
+        data = b''.join(self.buffers.pop(path))
+        self.total_buffered -= self.buffered.pop(path)
+        self.in_flight.acquire()
+        # chain writes to the same file to keep them in order
+        self.pending[path] = self.executor.submit(
+            self._write, path, data, self.pending.get(path)
+        )
+
+    def _open(self, path):
+        with self.streams_lock:
+            stream = self.streams.get(path)
+            if stream is not None:
+                self.streams.move_to_end(path)
+                return stream
+            while len(self.streams) >= self.max_open:
+                _, lru = self.streams.popitem(last=False)
+                with lru.lock:
+                    self.bytes_out += lru.close()
+            stream = self.streams[path] = GzipStream(path, self.compresslevel)
+            self.modified.add(path)
+            return stream
+
+    def _write(self, path, data, previous):
+        try:
+            if previous is not None:
+                previous.result()
+            while True:
+                stream = self._open(path)
+                with stream.lock:
+                    # stream may have been closed after it was opened
+                    if not stream.closed:
+                        n = stream.write(data)
+                        break
+            with self.streams_lock:
+                self.bytes_in += len(data)
+                self.bytes_out += n
+        finally:
+            self.in_flight.release()
+
+    def close_streams(self, sync=False):
+        """
+        Write all buffered data and close all streams, so every file
+        ends with a complete gzip member.
+        If sync is True, all files modified since the last call
+        are synced to disk.
+        """
+        for path in list(self.buffers):
+            self.flush(path)
+        for future in self.pending.values():
+            future.result()
+        self.pending.clear()
+        with self.streams_lock:
+            for stream in self.streams.values():
+                self.bytes_out += stream.close()
+            self.streams.clear()
+        if sync:
+            for path in self.modified:
+                sync_file(path)
+        self.modified.clear()
+
+    def close(self):
+        self.close_streams()
+        self.executor.shutdown()
+
+    def throughput(self):
+        elapsed = time.monotonic() - self.start
+        return (
+            f'wrote {self.bytes_in / 1e6:.1f} MB '
+            f'({self.bytes_out / 1e6:.1f} MB compressed) '
+            f'in {elapsed:.1f}s, {self.bytes_in / 1e6 / elapsed:.1f} MB/s'
+        )
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+def write_buckets(queue, max_open=256, memory_budget=256*MB):
     gen = yield_threaded(
-        (outdir, key, '\n'.join(json.dumps(sample) for sample in samples))
+        (outdir, key, samples if key is None else ''.join(
+            json.dumps(sample) + '\n' for sample in samples
+        ).encode('utf-8'))
         for outdir, key, samples in queue
     )
-    for outdir, key, chunk in gen:
-        path = outdir / (key + '.gz')
-        with gzip.open(path, 'at', encoding='utf-8', compresslevel=1) as fp:
-            fp.write(chunk)
-            fp.write('\n')
-
-
-def clear_outdir(outdir: Path, __shards=make_meta_shard_names()):
+    with ShardWriter(max_open, memory_budget=memory_budget) as writer:
+        for outdir, key, chunk in gen:
+            if key is None:
+                # all rows up to rowid chunk have been sent
+                writer.close_streams(sync=True)
+                save_checkpoint(outdir, chunk)
+            else:
+                writer.write(outdir / (key + '.gz'), chunk)
+    tqdm.write(writer.throughput())
+
+
+def clear_outdir(
+        outdir: Path,
+        __shards=make_meta_shard_names() | make_columnar_shard_names(),
+):
     for path in outdir.glob('*'):
-        if path.name in __shards:
+        if path.name in __shards or path.name == CHECKPOINT:
             path.unlink()
 
 
-def convert_metadata(files, outdir, chunk_size=100):
-    table = 'yfcc100m_dataset'
-    path = files['db']['path']
-    cols = get_cols(path, table)
+CHECKPOINT = 'checkpoint.json'
 
-    write_queue = IterableQueue(maxsize=4096)
-    buckets = defaultdict(list)
-    writer = Process(target=write_buckets, args=(write_queue,))
-    writer.start()
-    gen = yield_threaded(generate_rows_from_db(path, table))
 
-    clear_outdir(outdir)
+def save_checkpoint(outdir, rowid, __shards=make_meta_shard_names()):
+    sizes = {
+        path.name: path.stat().st_size
+        for path in outdir.glob('*.gz')
+        if path.name in __shards
+    }
+    tmp = outdir / (CHECKPOINT + '.tmp')
+    with tmp.open('wt', encoding='utf-8') as fp:
+        json.dump({'rowid': rowid, 'sizes': sizes}, fp)
+        fp.flush()
+        os.fsync(fp.fileno())
+    tmp.replace(outdir / CHECKPOINT)
+
 
+def load_checkpoint(outdir):
     try:
-        for row in tqdm(gen, total=TOTAL['db']):
-            sample = create_sample(row, cols)
+        with (outdir / CHECKPOINT).open('rt', encoding='utf-8') as fp:
+            return json.load(fp)
+    except FileNotFoundError:
+        return None
+
+
+def restore_checkpoint(outdir, checkpoint, __shards=make_meta_shard_names()):
+    """
+    Truncate shard files to their size at the checkpoint
+    and remove those that were created after it.
+    """
+    sizes = checkpoint['sizes']
+    for path in outdir.glob('*.gz'):
+        if path.name not in __shards:
+            continue
+        if path.name in sizes:
+            os.truncate(path, sizes[path.name])
+        else:
+            path.unlink()
+
+
+def bucket_samples(rows, cols, chunk_size, checkpoint_size=0):
+    """
+    Yield (key, samples) for buckets of samples with the same key prefix.
+    Every checkpoint_size rows and at the end all buckets are emptied
+    and (None, rowid) of the last row is yielded.
+    """
+    buckets = defaultdict(list)
+    count = 0
+    rowid = None
+    for rowid, samples in generate_samples(rows, cols):
+        for sample in samples:
             key = sample['key'][:3]
             buckets[key].append(sample)
             if len(buckets[key]) >= chunk_size:
-                write_queue.put((outdir, key, buckets.pop(key)))
-        # send remaining buckets to be written
-        for key, bucket in buckets.items():
-            write_queue.put((outdir, key, bucket))
+                yield key, buckets.pop(key)
+        count += len(samples)
+        if checkpoint_size and count >= checkpoint_size:
+            yield from buckets.items()
+            buckets.clear()
+            yield None, rowid
+            count = 0
+    # send remaining buckets to be written
+    yield from buckets.items()
+    if rowid is not None:
+        yield None, rowid
+
+
+def convert_range(
+        path,
+        table,
+        cols,
+        outdir,
+        start=None,
+        end=None,
+        chunk_size=100,
+        total=TOTAL['db'],
+        position=0,
+        max_open=256,
+        memory_budget=256*MB,
+        checkpoint_size=1_000_000,
+):
+    first = 1 if start is None else start
+    checkpoint = load_checkpoint(outdir)
+    if checkpoint is None:
+        clear_outdir(outdir)
+    else:
+        # continue after the last committed row
+        restore_checkpoint(outdir, checkpoint)
+        start = checkpoint['rowid'] + 1
+    done = 0 if start is None else start - first
+
+    write_queue = IterableQueue(maxsize=4096)
+    writer = Process(
+        target=write_buckets,
+        args=(write_queue, max_open, memory_budget),
+    )
+    writer.start()
+    gen = yield_threaded(generate_rows_from_db(path, table, start, end))
+    desc = None if end is None else f'{first}-{end}'
+
+    try:
+        rows = tqdm(
+            gen,
+            desc=desc,
+            total=total,
+            initial=done,
+            position=position,
+        )
+        for key, samples in bucket_samples(
+                rows, cols, chunk_size, checkpoint_size
+        ):
+            write_queue.put((outdir, key, samples))
     finally:
         write_queue.close()
+        writer.join()
+
+
+def _convert_range_worker(lock, *args):
+    tqdm.set_lock(lock)
+    convert_range(*args)
+
+
+def merge_parts(outdir, partdirs, __shards=make_meta_shard_names()):
+    # gzip members can simply be concatenated,
+    # parts are ordered by rowid, so lines end up in scan order
+    for name in tqdm(sorted(__shards), desc='merge'):
+        paths = [part / name for part in partdirs if (part / name).exists()]
+        if not paths:
+            continue
+        with (outdir / name).open('wb') as out:
+            for path in paths:
+                with path.open('rb') as fp:
+                    shutil.copyfileobj(fp, out, 1024*1024)
+
+
+def write_columnar_shard(outdir, shard):
+    rows = list(load_jsonl(outdir / (shard + '.gz')))
+    save_columns(outdir / (shard + '.npz'), rows)
+    return shard
+
+
+def write_columnar_shards(outdir, processes=0):
+    shards = sorted(find_meta_shards(outdir))
+    with mp.Pool(processes or None) as pool:
+        gen = pool.imap_unordered(
+            partial(write_columnar_shard, outdir), shards
+        )
+        for _ in tqdm(gen, desc='columnar', total=len(shards)):
+            pass
+
+
+def write_index(outdir):
+    """
+    Write the key and photo id indexes for all shards in outdir.
+    Keys start with the shard name, so sorting keys per shard and
+    writing shards in order gives the sorted key index.
+    Photo ids are sorted in place in the memory-mapped file afterwards.
+    """
+    keypath = outdir / KEY_INDEX
+    photoidpath = outdir / (PHOTOID_INDEX + '.tmp')
+    with keypath.open('wb') as keyfp, photoidpath.open('wb') as photoidfp:
+        for shard in tqdm(sorted(find_meta_shards(outdir)), desc='index'):
+            samples = list(load_metadata(outdir, shard, ('key', 'photoid')))
+            keys = np.zeros(len(samples), dtype=KEY_DTYPE)
+            keys['key'] = [sample['key'] for sample in samples]
+            keys['shard'] = int(shard, 16)
+            keys['row'] = np.arange(len(samples))
+            keys[np.argsort(keys['key'], kind='stable')].tofile(keyfp)
+            photoids = np.zeros(len(samples), dtype=PHOTOID_DTYPE)
+            photoids['photoid'] = [int(sample['photoid']) for sample in samples]
+            photoids['shard'] = keys['shard']
+            photoids['row'] = keys['row']
+            photoids.tofile(photoidfp)
+    if photoidpath.stat().st_size:
+        photoids = np.memmap(photoidpath, dtype=PHOTOID_DTYPE, mode='r+')
+        photoids.sort(order='photoid', kind='stable')
+        photoids.flush()
+        del photoids
+    photoidpath.replace(outdir / PHOTOID_INDEX)
+
+
+def convert_metadata(
+        files,
+        outdir,
+        chunk_size=100,
+        processes=0,
+        max_open=256,
+        memory_budget=256*MB,
+        checkpoint_size=1_000_000,
+):
+    table = 'yfcc100m_dataset'
+    path = files['db']['path']
+    cols = get_cols(path, table)
+
+    if processes < 1:
+        convert_range(
+            path, table, cols, outdir,
+            chunk_size=chunk_size,
+            max_open=max_open,
+            memory_budget=memory_budget,
+            checkpoint_size=checkpoint_size,
+        )
+        (outdir / CHECKPOINT).unlink(missing_ok=True)
+        return
+
+    clear_outdir(outdir)
+
+    # each worker scans its own rowid range into a separate part directory
+    first, last = get_rowid_range(path, table)
+    ranges = split_rowid_range(first, last, processes)
+    partroot = outdir / 'parts'
+    rangespath = partroot / 'ranges.json'
+    try:
+        with rangespath.open('rt', encoding='utf-8') as fp:
+            resumable = json.load(fp) == [list(r) for r in ranges]
+    except FileNotFoundError:
+        resumable = False
+    if not resumable:
+        shutil.rmtree(partroot, ignore_errors=True)
+        partroot.mkdir(parents=True)
+        with rangespath.open('wt', encoding='utf-8') as fp:
+            json.dump(ranges, fp)
+    partdirs = [partroot / f'{i:03d}' for i in range(len(ranges))]
+    write_lock = mp.Lock()
+    tqdm.set_lock(write_lock)
+    workers = []
+    for position, ((start, end), partdir) in enumerate(zip(ranges, partdirs)):
+        partdir.mkdir(exist_ok=True)
+        worker = Process(
+            target=_convert_range_worker,
+            args=(write_lock, path, table, cols, partdir,
+                  start, end, chunk_size, end - start, position,
+                  max_open, memory_budget // len(ranges), checkpoint_size),
+        )
+        worker.start()
+        workers.append(worker)
+    for worker in workers:
+        worker.join()
+    if any(worker.exitcode != 0 for worker in workers):
+        raise RuntimeError('conversion of some rowid ranges failed')
+
+    merge_parts(outdir, partdirs)
+    shutil.rmtree(partroot)
 
 
 def main():
@@ -162,17 +760,85 @@ def main():
     from datadings.tools import prepare_indir
 
     parser = make_parser(__doc__, no_confirm=False, shuffle=False)
+    parser.add_argument(
+        '-p', '--processes',
+        default=0,
+        type=int,
+        help='Number of processes that each convert a range of rows. '
+             'Defaults to 0, i.e., scan the DB in a single process.'
+    )
+    parser.add_argument(
+        '--download-parallel',
+        default=0,
+        type=int,
+        help='Download the DB file with this many parallel range requests. '
+             'The checksum is verified during the download.'
+    )
+    parser.add_argument(
+        '--endpoint-url',
+        default=None,
+        type=str,
+        help='Use this S3 endpoint instead of AWS, e.g., s3local.py.'
+    )
+    parser.add_argument(
+        '--max-open',
+        default=256,
+        type=int,
+        help='Maximum number of shard files each writer keeps open.'
+    )
+    parser.add_argument(
+        '--write-buffer',
+        default=256,
+        type=int,
+        help='Total size in MB of buffered samples before they are flushed.'
+    )
+    parser.add_argument(
+        '--checkpoint',
+        default=1_000_000,
+        type=int,
+        help='Number of rows between checkpoints.'
+    )
+    parser.add_argument(
+        '--columnar',
+        action='store_true',
+        help='Also write a columnar <shard>.npz file for each shard.'
+    )
+    parser.add_argument(
+        '--index',
+        action='store_true',
+        help='Also write indexes to look up samples by key and photo id.'
+    )
     args = parser.parse_args()
     args.outdir = Path(args.outdir or args.indir)
 
     files = locate_files(FILES, args.indir)
     # download DB file with AWS tools
-    download_db(files)
+    if args.download_parallel > 0:
+        if download_db_ranged(
+                files,
+                parallel=args.download_parallel,
+                endpoint_url=args.endpoint_url,
+        ):
+            # already verified while downloading
+            args.skip_verification = True
+    else:
+        download_db(files)
     # check indir correctness
     files = prepare_indir(FILES, args)
 
     try:
-        convert_metadata(files, args.outdir)
+        convert_metadata(
+            files,
+            args.outdir,
+            processes=args.processes,
+            max_open=args.max_open,
+            memory_budget=args.write_buffer*MB,
+            checkpoint_size=args.checkpoint,
+        )
+        if args.columnar:
+            write_columnar_shards(args.outdir, args.processes)
+        if args.index:
+            write_index(args.outdir)
     except KeyboardInterrupt:
         pass
 
@@ -0,0 +1,181 @@
+"""
+Dataset-wide store of content hashes to find byte-identical files.
+
+The store is an SQLite database in WAL mode, so any number of processes
+can use it at the same time. It maps the hash of each stored file to the
+key of the first file with that content, the original, and every other
+file with the same content to its original.
+The downloader writes only originals into shards. Duplicates are listed
+as <key>\t<original> in <shard>.dups instead. Files larger than the part
+size of the downloader are hashed while they are written, duplicates among
+them are kept in their shards and only recorded in the store.
+
+Existing ZIP or pack shards can be added with:
+    python dedup.py dedup.sqlite images/*.zip
+"""
+import sqlite3
+import argparse
+import threading as th
+from hashlib import blake2b
+from pathlib import Path
+
+from tqdm import tqdm
+
+from pack import iter_shard
+
+
+DUPS_SUFFIX = '.dups'
+SCHEMA = (
+    'CREATE TABLE IF NOT EXISTS originals '
+    '(digest BLOB PRIMARY KEY, key TEXT NOT NULL) WITHOUT ROWID',
+    'CREATE TABLE IF NOT EXISTS duplicates '
+    '(key TEXT PRIMARY KEY, original TEXT NOT NULL) WITHOUT ROWID',
+)
+
+
+def content_hash(data):
+    return content_hasher(data).digest()
+
+
+def content_hasher(data=b''):
+    """
+    Returns a hash object like content_hash for data that arrives in parts.
+    """
+    return blake2b(data, digest_size=20)
+
+
+class DedupStore:
+    """
+    Content hash store at path, see module docstring.
+    The connection is opened on first use, so stores can be passed to
+    worker processes. Threads share the connection of their process.
+    """
+    def __init__(self, path, timeout=60):
+        self.path = Path(path)
+        self.timeout = timeout
+        self.conn = None
+        self.lock = th.Lock()
+
+    def __getstate__(self):
+        return self.path, self.timeout
+
+    def __setstate__(self, state):
+        self.__init__(*state)
+
+    def _connect(self):
+        if self.conn is None:
+            conn = sqlite3.connect(
+                self.path,
+                timeout=self.timeout,
+                isolation_level=None,
+                check_same_thread=False,
+            )
+            conn.execute('PRAGMA journal_mode = WAL')
+            conn.execute('PRAGMA synchronous = NORMAL')
+            for statement in SCHEMA:
+                conn.execute(statement)
+            self.conn = conn
+        return self.conn
+
+    def add(self, digest, key):
+        """
+        Record that key has content with the given digest.
+        Returns the key of the original, which is key itself unless
+        another file with the same content was added before.
+        """
+        with self.lock:
+            conn = self._connect()
+            with conn:
+                conn.execute('BEGIN IMMEDIATE')
+                conn.execute(
+                    'INSERT OR IGNORE INTO originals VALUES (?, ?)',
+                    (digest, key),
+                )
+                original, = conn.execute(
+                    'SELECT key FROM originals WHERE digest = ?', (digest,)
+                ).fetchone()
+                if original != key:
+                    conn.execute(
+                        'INSERT OR REPLACE INTO duplicates VALUES (?, ?)',
+                        (key, original),
+                    )
+        return original
+
+    def lookup(self, digest):
+        """
+        Returns the key of the original with the given digest, or None.
+        """
+        with self.lock:
+            row = self._connect().execute(
+                'SELECT key FROM originals WHERE digest = ?', (digest,)
+            ).fetchone()
+        return row[0] if row else None
+
+    def original(self, key):
+        """
+        Returns the original of key if it is a duplicate, else None.
+        """
+        with self.lock:
+            row = self._connect().execute(
+                'SELECT original FROM duplicates WHERE key = ?', (key,)
+            ).fetchone()
+        return row[0] if row else None
+
+    def is_duplicate(self, key):
+        return self.original(key) is not None
+
+    def duplicates(self, keys=None, batch_size=500):
+        """
+        Returns a dict that maps duplicates among keys to their originals,
+        or all duplicates if keys is None.
+        """
+        with self.lock:
+            conn = self._connect()
+            if keys is None:
+                return dict(conn.execute('SELECT * FROM duplicates'))
+            keys = list(keys)
+            result = {}
+            for start in range(0, len(keys), batch_size):
+                batch = keys[start:start + batch_size]
+                query = 'SELECT * FROM duplicates WHERE key IN (%s)' \
+                        % ','.join('?' * len(batch))
+                result.update(conn.execute(query, batch))
+        return result
+
+    def add_shard(self, path):
+        """
+        Add all files of an existing shard.
+        Returns the dict of duplicates it contains.
+        """
+        found = {}
+        for name, data in iter_shard(path):
+            original = self.add(content_hash(data), name)
+            if original != name:
+                found[name] = original
+        return found
+
+    def close(self):
+        with self.lock:
+            if self.conn is not None:
+                self.conn.close()
+                self.conn = None
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+    )
+    parser.add_argument('store', help='Path of the store.')
+    parser.add_argument('shards', nargs='+', help='Shards to add.')
+    args = parser.parse_args()
+    store = DedupStore(args.store)
+    num_duplicates = 0
+    for path in tqdm(args.shards):
+        num_duplicates += len(store.add_shard(path))
+    store.close()
+    print(f'{num_duplicates} duplicates')
+
+
+if __name__ == '__main__':
+    main()
@@ -3,6 +3,20 @@ Download the YFCC100m dataset from AWS. Requires the metadata files produced by
 the convert_metadata tool as input. Files are stored in 4096 ZIP-files. For
 images shards are ~27000 files each and occupy 11 TiB. The download can be
 stopped at any time and will ignore fully downloaded shards when resumed.
+Which key exists for each sample is cached in <shard>.keys files next to the
+shards, so --check and repair runs never request missing files again.
+Use --max-bandwidth and --max-requests to limit all processes together.
+With --validate, garbage images are dropped before they are written and
+their keys are listed in <shard>.dropped. Add --compress to also re-compress
+and downscale images like the convert tool.
+With --dedup, files whose content was downloaded before are not written
+again, see dedup.py.
+With --format pack, shards are written as <shard>.pack files instead of
+ZIP files, which can be read without extracting them, see pack.py.
+Videos larger than --part-size are downloaded in parts with concurrent ranged
+GETs and streamed into the shard.
+Metrics of all processes are written to metrics.prom and metrics.json in the
+output directory, and a summary of each shard to shard_metrics.jsonl.
 
 WARNING:
 
@@ -26,116 +40,580 @@ IMPORTANT: Needs AWS credentials to work. Create an AWS account (credit card
            aws_access_key_id = <key>
            aws_secret_access_key = <secret>
 """
-import io
-import zipfile
+import time
 from pathlib import Path
+from functools import partial
 import threading as th
+from queue import Empty
+from queue import Queue
 from multiprocessing.pool import ThreadPool
 
 from tqdm import tqdm
-import boto3
-from botocore.exceptions import ClientError
 from datadings.tools.cached_property import cached_property
 
-from download_repair_error import hex_range
+from archive import BufferedZipWriter
+from archive import JournaledZipWriter
+from archive import PackWriter
+from archive import WRITE_BUFFER
+from archive import stream_parts
+from dedup import DedupStore
+from dedup import DUPS_SUFFIX
+from dedup import content_hash
+from dedup import content_hasher
+from download_async import AsyncFetcher
+from download_scheduler import AIMDLimiter
+from download_scheduler import RateLimiter
+from metrics import DownloadMetrics
+from metrics import METRICS_INTERVAL
+from pack import PACK_SUFFIX
+from pack import read_keys
+from images import transcode_image
+from transfer import MANIFEST_TTL
+from transfer import CircuitBreaker
+from transfer import KeyCacheStore
+from transfer import RangedObject
+from transfer import RetryPolicy
+from transfer import attach_shared
+from transfer import fetch_sample
+from transfer import get_range
+from transfer import is_credential_error
+from transfer import load_manifest
+from transfer import s3_connections
+from transfer import sample_exists
+from transfer import shared_states
 from vars import BUCKET_NAME
 from tools import find_meta_shards
 from tools import get_possible_keys
+from tools import hex_range
+from tools import MB
+from tools import PREFIX
 from tools import WorkerBase
 from tools import load_finished_shards
 from tools import shard_finished
+from tools import validate_filter
+
+
+PART_SIZE = 8 * MB
 
 
 class Downloader(WorkerBase):
-    @cached_property
+    columns = 'key', 'marker', 'ext'
+
+    def __init__(
+            self,
+            shards,
+            indir,
+            metadir,
+            outdir,
+            kinds,
+            filter_code,
+            processes,
+            threads,
+            engine='threads',
+            endpoint_url=None,
+            write_buffer=WRITE_BUFFER,
+            journal=False,
+            manifest_ttl=MANIFEST_TTL,
+            max_bandwidth=0,
+            max_requests=0,
+            validate=False,
+            compress=None,
+            subsampling='422',
+            target_size=500,
+            dedup=None,
+            part_size=PART_SIZE,
+            part_parallelism=4,
+            shard_format='zip',
+    ):
+        super().__init__(
+            shards,
+            indir,
+            metadir,
+            outdir,
+            kinds,
+            filter_code,
+            processes,
+            threads,
+        )
+        self.engine = engine
+        self.endpoint_url = endpoint_url
+        self.write_buffer = write_buffer
+        self.journal = journal
+        self.manifest_ttl = manifest_ttl
+        self.limiter = None
+        self.retry = RetryPolicy(breaker=CircuitBreaker())
+        self.rate_limiter = RateLimiter(max_bandwidth, max_requests)
+        # compressing implies validation
+        self.validate = validate or bool(compress)
+        self.compress = compress
+        self.subsampling = subsampling
+        self.target_size = target_size
+        self.dedup = DedupStore(dedup) if dedup else None
+        self.metrics = DownloadMetrics()
+        self.part_size = part_size
+        self.part_parallelism = part_parallelism
+        self.shard_format = shard_format
+        self.shard_suffix = PACK_SUFFIX if shard_format == 'pack' else '.zip'
+        # number of concurrent requests and shards open in each process,
+        # both are higher with the adaptive scheduler
+        self.concurrency = threads
+        self.open_shards = 1
+
+    @property
+    def connections(self):
+        # download threads and part threads of this process share a client
+        return s3_connections(
+            self.endpoint_url,
+            self.concurrency + self.part_parallelism * self.open_shards,
+        )
+
+    @property
     def bucket(self):
-        loc = th.local()
-        if not hasattr(loc, 'bucket'):
-            loc.session = boto3.Session()
-            loc.bucket = loc.session.resource('s3').Bucket(BUCKET_NAME)
-        return loc.bucket
+        return self.connections.bucket(BUCKET_NAME)
+
+    @cached_property
+    def key_caches(self):
+        return KeyCacheStore(self.outdir)
+
+    @cached_property
+    def part_pool(self):
+        # part_parallelism requests per open shard,
+        # download threads request parts themselves while it is busy
+        return ThreadPool(self.part_parallelism * self.open_shards)
+
+    def close_part_pool(self):
+        # worker processes download many shards, so threads must not leak
+        pool = self.__dict__.pop('part_pool', None)
+        if pool is not None:
+            pool.terminate()
+
+    def finish_shard(self, shard, **extra):
+        """
+        Close the key cache and write metrics of a finished shard,
+        including requests and new connections of this process since
+        the last shard was finished.
+        """
+        self.key_caches.close(shard)
+        requests, connections = self.connections.take_stats()
+        self.metrics.record(shard, 'requests', requests)
+        self.metrics.record(shard, 'connections', connections)
+        self.metrics.finish_shard(shard, self.outdir, **extra)
+
+    def record_error(self, key, error):
+        self.metrics.record_error(key, error)
+        if self.limiter is not None:
+            self.limiter.record_error(error)
 
     def file_exists(self, sample):
-        for _, key in get_possible_keys(sample):
-            try:
-                self.bucket.Object(key).load()
-                return True
-            except ClientError:
-                pass
-        return False
+        cache = self.key_caches.for_sample(sample)
+        try:
+            return self.retry.call(
+                sample_exists,
+                (self.bucket, sample, cache, self.rate_limiter),
+                partial(self.record_error, sample['key']),
+            )
+        except Exception as e:
+            if is_credential_error(e):
+                raise
+            return False
 
     def download_file(self, sample):
-        for canonical_key, key in get_possible_keys(sample):
-            try:
-                bio = io.BytesIO()
-                for try_time in range(20):
-                    try:
-                        self.bucket.download_fileobj(key, bio)
-                        break
-                    except:
-                        continue
-                return key, bio.getvalue()
-            except ClientError:
-                pass
-        else:
-            # noinspection PyUnboundLocalVariable
-            return canonical_key, None
+        """
+        Returns (key, data) for the sample,
+        or (canonical key, None) if it could not be downloaded.
+        Data of videos larger than part_size is a RangedObject
+        that is downloaded when written.
+        Credential errors are raised, since all other requests would fail too.
+        """
+        _, key, data, _ = self.fetch_file(sample)
+        return key, data
+
+    def fetch_file(self, sample):
+        """
+        Like download_file, but returns (canonical key, key, data, error).
+        Error is the exception if the download failed and None if the
+        sample was downloaded or does not exist.
+        """
+        cache = self.key_caches.for_sample(sample)
+        canonical_key = next(get_possible_keys(sample))[0]
+        # images are small, only request videos in parts
+        part_size = self.part_size if sample['marker'] == 1 else 0
+        start = time.monotonic()
+        try:
+            key, data = self.retry.call(
+                fetch_sample,
+                (self.bucket, sample, cache, self.rate_limiter, part_size),
+                partial(self.record_error, canonical_key),
+            )
+        except Exception as e:
+            if is_credential_error(e):
+                raise
+            self.metrics.record_file(
+                canonical_key, None, time.monotonic() - start, failed=True
+            )
+            return canonical_key, canonical_key, None, e
+        self.metrics.record_file(key, data, time.monotonic() - start)
+        return canonical_key, key, data, None
+
+    @cached_property
+    def sidecar_lock(self):
+        return th.Lock()
+
+    def append_sidecar(self, key, suffix, line):
+        # sidecars belong to the shard of the key
+        path = self.outdir / (Path(key).stem[:3] + suffix)
+        with self.sidecar_lock, path.open('at', encoding='utf-8') as fp:
+            fp.write(line + '\n')
+
+    def load_sidecar(self, shard, suffix):
+        """
+        Returns the keys listed in a sidecar of the shard.
+        """
+        try:
+            text = (self.outdir / (shard + suffix)).read_text('utf-8')
+        except FileNotFoundError:
+            return set()
+        return {line.partition('\t')[0] for line in text.splitlines()}
+
+    def skipped_keys(self, shard):
+        """
+        Returns keys that were downloaded, but not written to the shard.
+        """
+        return self.load_sidecar(shard, '.dropped') \
+            | self.load_sidecar(shard, DUPS_SUFFIX)
 
-    def download_files(self, shard, files):
-        pool = ThreadPool(self.threads)
+    def fetch_range(self, key, start, end):
+        return self.retry.call(
+            get_range,
+            (self.bucket, key, start, end, self.rate_limiter),
+            partial(self.record_error, key),
+        )
+
+    @staticmethod
+    def hash_parts(parts, hasher):
+        try:
+            for part in parts:
+                hasher.update(part)
+                yield part
+        finally:
+            parts.close()
+
+    def store_file(self, writer, key, data):
+        """
+        Write a downloaded file.
+        The remaining parts of RangedObjects are downloaded by the calling
+        thread while the writer writes them. Parts in flight count against
+        the write buffer, so the writer limits how many large files are
+        downloaded at the same time.
+        With dedup, files with known content are not written, they are
+        recorded in <shard>.dups with the key of their original instead.
+        Streamed RangedObjects are hashed while they are written and
+        added to the store afterwards, so they are always written.
+        With validate, images are validated and optionally re-compressed
+        first. Garbage images are not written, their keys are appended to
+        <shard>.dropped instead, so they are not downloaded again.
+        """
+        if isinstance(data, RangedObject):
+            parts = data.parts(
+                partial(self.fetch_range, key),
+                self.part_pool,
+                self.part_parallelism,
+            )
+            # the first part, finished parts waiting for their turn
+            # and one part handed over to the writer
+            size = len(data.first) \
+                + data.part_size * (self.part_parallelism + 1)
+            if self.dedup is None:
+                stream_parts(writer, key, parts, size)
+                return
+            hasher = content_hasher()
+            stream = stream_parts(
+                writer, key, self.hash_parts(parts, hasher), size
+            )
+            # the content is only known once the file was written,
+            # so duplicates are kept, but recorded in the store
+            if stream.wait():
+                self.dedup.add(hasher.digest(), key)
+            return
+        digest = None
+        if self.dedup is not None and data:
+            digest = content_hash(data)
+            original = self.dedup.lookup(digest)
+            if original is not None and original != key:
+                self.dedup.add(digest, key)
+                self.append_sidecar(key, DUPS_SUFFIX, f'{key}\t{original}')
+                self.metrics.record(key, 'duplicates')
+                return
+        if self.validate and data and key.startswith(PREFIX[0]):
+            data = transcode_image(
+                data, self.compress, self.subsampling, self.target_size
+            )
+            if data is None:
+                self.append_sidecar(key, '.dropped', key)
+                self.metrics.record(key, 'dropped')
+                return
+        if digest is not None:
+            # another process may have stored the same content meanwhile
+            original = self.dedup.add(digest, key)
+            if original != key:
+                self.append_sidecar(key, DUPS_SUFFIX, f'{key}\t{original}')
+                self.metrics.record(key, 'duplicates')
+                return
+        writer.write(key, data)
+
+    def fetch_into(self, writer, sample):
+        key, data = self.download_file(sample)
+        self.store_file(writer, key, data)
+        return key
+
+    def fetch_threads(self, files, writer):
+        # decoding and encoding images releases the GIL,
+        # so download threads validate images themselves
+        with ThreadPool(self.threads) as pool:
+            yield from pool.imap_unordered(
+                partial(self.fetch_into, writer), files
+            )
+
+    def fetch_async(self, files, writer):
+        # threads is the number of requests in flight
+        fetcher = AsyncFetcher(
+            self.endpoint_url,
+            self.threads,
+            limiter=self.rate_limiter,
+            metrics=self.metrics,
+        )
+        results = fetcher.fetch(
+            files, self.key_caches.for_sample, ordered=False
+        )
+        if not self.validate and self.dedup is None:
+            for key, data in results:
+                writer.write(key, data)
+                yield key
+            return
+
+        def store(result):
+            self.store_file(writer, *result)
+            return result[0]
+        # validate and hash files in threads, the event loop must not wait
+        with ThreadPool(self.threads) as pool:
+            yield from pool.imap_unordered(store, results)
+
+    def download_files(self, shard, files, writer):
+        """
+        Download files into writer in the order they complete.
+        Yields keys of finished files.
+        """
+        if self.engine == 'async':
+            gen = self.fetch_async(files, writer)
+        else:
+            gen = self.fetch_threads(files, writer)
         with self.position() as position:
             yield from self.tqdm(
-                pool.imap(self.download_file, files),
+                gen,
                 shard,
                 position,
                 length=len(files),
             )
 
-    def download_shard(self, shard):
+    def open_writer(self, shard, suffix='', errors=True, resume=False):
+        path = self.outdir / (shard + suffix + self.shard_suffix)
+        errpath = self.outdir / (shard + '.err') if errors else None
+        if self.shard_format == 'pack':
+            return PackWriter(
+                path, errpath, self.write_buffer, resume=resume
+            )
+        if resume:
+            return JournaledZipWriter(path, errpath, self.write_buffer)
+        return BufferedZipWriter(path, errpath, self.write_buffer)
+
+    def open_shard(self, shard):
+        """
+        Returns the writer and the samples that still need to be
+        downloaded for the shard.
+        With journal, samples already in an interrupted shard are skipped.
+        """
         metadata = self.prepare_metadata(shard)
-        errpath = self.outdir / (shard + '.err')
-        with zipfile.ZipFile(self.outdir / (shard + '.zip'), 'w') as z:
-            for key, data in self.download_files(shard, metadata):
-                if data:
-                    z.writestr(key, data)
-                else:
-                    with errpath.open('at', encoding='utf-8') as err:
-                        err.write(key+'\n')
+        if not self.journal:
+            for suffix in ('.dropped', DUPS_SUFFIX):
+                (self.outdir / (shard + suffix)).unlink(missing_ok=True)
+            return self.open_writer(shard), metadata
+        writer = self.open_writer(shard, resume=True)
+        done = writer.keys | self.skipped_keys(shard)
+        if done:
+            metadata = [
+                sample for sample in metadata
+                if not any(
+                    key in done
+                    for _, key in get_possible_keys(sample)
+                )
+            ]
+        return writer, metadata
+
+    def download_shard(self, shard):
+        writer, metadata = self.open_shard(shard)
+        with writer:
+            for _ in self.download_files(shard, metadata, writer):
+                pass
+        self.close_part_pool()
+        self.finish_shard(shard)
         return shard
 
+    def pool(self):
+        # worker processes share the breaker, rate limiter and metrics
+        states = shared_states(
+            self.retry.breaker, self.rate_limiter, self.metrics
+        )
+        # workers live for all shards, so their S3 client keeps
+        # its connections alive
+        return super().pool(
+            attach_shared, (states,), maxtasksperchild=None
+        )
+
     def download_shards(self):
         with self.positioned(), self.pool() as pool:
             yield from pool.imap_unordered(self.download_shard, self.shards)
 
+    def download_shards_adaptive(self, max_concurrency=256):
+        """
+        Download shards from one shared queue of requests.
+        Up to processes shards are open at the same time and their samples
+        are downloaded by a single pool of max_concurrency threads.
+        The number of concurrent requests is controlled by an AIMDLimiter,
+        starting at threads.
+        Yields shards as they are finished.
+        """
+        limiter = AIMDLimiter(self.threads, maximum=max_concurrency)
+        self.limiter = limiter
+        self.concurrency = max_concurrency
+        self.open_shards = self.processes
+        requests = Queue()
+        results = Queue()
+        shards = iter(self.shards)
+        # shard -> [writer, number of remaining samples]
+        open_shards = {}
+
+        def worker():
+            while True:
+                item = requests.get()
+                if item is None:
+                    return
+                shard, writer, sample = item
+                limiter.acquire()
+                data = None
+                try:
+                    key, data = self.download_file(sample)
+                except BaseException as e:
+                    results.put(e)
+                    return
+                finally:
+                    limiter.release(len(data or b''))
+                try:
+                    self.store_file(writer, key, data)
+                except BaseException as e:
+                    results.put(e)
+                    return
+                results.put(shard)
+
+        def fill():
+            # open shards until processes shards are open,
+            # shards without samples are finished immediately
+            finished = []
+            for shard in shards:
+                writer, metadata = self.open_shard(shard)
+                if not metadata:
+                    writer.close()
+                    finished.append(shard)
+                    continue
+                open_shards[shard] = [writer, len(metadata)]
+                for sample in metadata:
+                    requests.put((shard, writer, sample))
+                if len(open_shards) >= self.processes:
+                    break
+            return finished
+
+        threads = [
+            th.Thread(target=worker, daemon=True)
+            for _ in range(max_concurrency)
+        ]
+        for thread in threads:
+            thread.start()
+        limiter.start()
+        progress = tqdm(desc='files', position=1, smoothing=0)
+        try:
+            yield from fill()
+            while open_shards:
+                shard = results.get()
+                if isinstance(shard, BaseException):
+                    raise shard
+                progress.update()
+                progress.set_postfix(limit=limiter.limit, refresh=False)
+                state = open_shards[shard]
+                state[1] -= 1
+                if state[1] == 0:
+                    state[0].close()
+                    del open_shards[shard]
+                    self.finish_shard(shard)
+                    yield shard
+                    yield from fill()
+        finally:
+            # workers must stop before their writers are aborted,
+            # so drop queued samples and wait for files in flight
+            try:
+                while True:
+                    requests.get_nowait()
+            except Empty:
+                pass
+            for _ in threads:
+                requests.put(None)
+            try:
+                for thread in threads:
+                    thread.join()
+            finally:
+                for writer, _ in open_shards.values():
+                    writer.abort()
+                limiter.stop()
+                progress.close()
+                self.limiter = None
+
     def find_missing(self, shard, metadata, existing_keys):
+        # list all objects of the shard instead of a request per sample
+        manifest = self.retry.call(
+            load_manifest,
+            (
+                self.bucket, self.outdir, shard, self.kinds,
+                self.manifest_ttl, self.rate_limiter,
+            ),
+            partial(self.record_error, shard),
+        )
+        cache = self.key_caches[shard]
         missing = []
         # for each sample, check if any of the possible keys is in the shard
-        # if not, check if file exists on AWS and add to list of missing samples
-        with self.position() as position:
-            for sample in self.tqdm(metadata, shard, position):
-                for _, key in get_possible_keys(sample):
-                    if key in existing_keys:
-                        break
-                else:
-                    if self.file_exists(sample):
-                        missing.append(sample)
+        # if not, check if it was listed and add to list of missing samples
+        for sample in metadata:
+            keys = [key for _, key in get_possible_keys(sample)]
+            if any(key in existing_keys for key in keys):
+                continue
+            found = next((key for key in keys if key in manifest), None)
+            cache.set(keys[0], found)
+            if found is not None:
+                missing.append(sample)
         return missing
 
     def check_shard(self, shard):
-        shardpath = self.outdir / (shard + '.zip')
+        shardpath = self.outdir / (shard + self.shard_suffix)
         if not shardpath.exists():
             return shard
         # get named of all files in shard
-        with zipfile.ZipFile(shardpath, 'r') as z:
-            existing_keys = set(z.namelist())
+        existing_keys = read_keys(shardpath)
+        existing_keys |= self.skipped_keys(shard)
         metadata = self.prepare_metadata(shard)
         missing = self.find_missing(shard, metadata, existing_keys)
         if missing:
-            shardpath = self.outdir / (shard + '_missing.zip')
-            with zipfile.ZipFile(shardpath, 'w') as z:
-                for key, data in self.download_files(shard, missing):
-                    if data:
-                        z.writestr(key, data)
+            with self.open_writer(shard, '_missing', errors=False) as writer:
+                for _ in self.download_files(shard, missing, writer):
+                    pass
+        self.close_part_pool()
+        self.finish_shard(shard, check=True)
         return shard
 
     def check_shards(self):
@@ -154,7 +632,26 @@ def download_parallel(
         # overwrite=False,
         check=False,
         shard_start='000',
-        shard_end='fff'
+        shard_end='fff',
+        engine='threads',
+        endpoint_url=None,
+        scheduler='shards',
+        max_concurrency=256,
+        write_buffer=WRITE_BUFFER,
+        journal=False,
+        manifest_ttl=MANIFEST_TTL,
+        max_bandwidth=0,
+        max_requests=0,
+        control_file=None,
+        validate=False,
+        compress=None,
+        subsampling='422',
+        target_size=500,
+        dedup=None,
+        metrics_interval=METRICS_INTERVAL,
+        part_size=PART_SIZE,
+        part_parallelism=4,
+        shard_format='zip',
 ):
     if not shards:
         shards = find_meta_shards(indir)
@@ -174,19 +671,37 @@ def download_parallel(
         print(f'now download shards from {shards[0]} to {shards[-1]}')
 
     downloader = Downloader(
-        shards, indir, indir, outdir, kinds, filter_code, processes, threads
+        shards, indir, indir, outdir, kinds, filter_code, processes, threads,
+        engine, endpoint_url, write_buffer, journal, manifest_ttl,
+        max_bandwidth, max_requests, validate, compress, subsampling,
+        target_size, dedup, part_size, part_parallelism, shard_format,
     )
+    if control_file:
+        downloader.rate_limiter.watch(Path(control_file))
+    stop_metrics = None
+    if metrics_interval:
+        stop_metrics = downloader.metrics.export(outdir, metrics_interval)
+    if check:
+        gen = downloader.check_shards()
+    elif scheduler == 'adaptive':
+        gen = downloader.download_shards_adaptive(max_concurrency)
+    else:
+        gen = downloader.download_shards()
     gen = tqdm(
-        downloader.check_shards() if check else downloader.download_shards(),
+        gen,
         desc='total',
         total=len(shards),
         smoothing=0,
         position=0,
     )
-    for shard in gen:
-        if not check:
-            # pass
-            shard_finished(shard, outdir)
+    try:
+        for shard in gen:
+            if not check:
+                # pass
+                shard_finished(shard, outdir)
+    finally:
+        if stop_metrics is not None:
+            stop_metrics()
 
 
 def main():
@@ -202,13 +717,56 @@ def main():
         '-p', '--processes',
         default=8,
         type=int,
-        help='Number of shards downloaded in parallel.'
+        help='Number of shards downloaded in parallel. '
+             'With --scheduler adaptive, the number of open shards.'
     )
     parser.add_argument(
         '-t', '--threads',
         default=8,
         type=int,
-        help='Number of threads to download each shard.'
+        help='Number of threads to download each shard. '
+             'With --engine async, the number of requests in flight. '
+             'With --scheduler adaptive, the initial number of requests.'
+    )
+    parser.add_argument(
+        '--scheduler',
+        default='shards',
+        choices=('shards', 'adaptive'),
+        help='Download each shard with its own threads, or all open shards '
+             'from one shared queue with adaptive concurrency (AIMD). '
+             'The adaptive scheduler uses a single process and boto3.'
+    )
+    parser.add_argument(
+        '--max-concurrency',
+        default=256,
+        type=int,
+        help='Maximum number of requests with --scheduler adaptive.'
+    )
+    parser.add_argument(
+        '--write-buffer',
+        default=WRITE_BUFFER // MB,
+        type=int,
+        help='Maximum MB of downloaded files waiting to be written per shard.'
+    )
+    parser.add_argument(
+        '--journal',
+        action='store_true',
+        help='Write shards to <shard>.zip.part with periodic checkpoints. '
+             'Interrupted shards resume where they stopped and are renamed '
+             'to <shard>.zip when complete.'
+    )
+    parser.add_argument(
+        '--engine',
+        default='threads',
+        choices=('threads', 'async'),
+        help='Download with a thread pool and boto3, '
+             'or asyncio and aiohttp (anonymous access only).'
+    )
+    parser.add_argument(
+        '--endpoint-url',
+        default=None,
+        type=str,
+        help='Use this S3 endpoint instead of AWS, e.g., s3local.py.'
     )
 
     def _kind(v):
@@ -246,13 +804,14 @@ def main():
 
 
     def _evalable(v):
-        eval(v)
+        validate_filter(v)
         return v
     parser.add_argument(
         '--filter',
         type=_evalable,
         default='lambda x: True',
-        help='Lambda function to select samples.'
+        help='Lambda function or filter expression to select samples, '
+             'e.g., "accuracy >= 12 and usertags has beach".'
     )
     # parser.add_argument(
     #     '--overwrite',
@@ -264,6 +823,94 @@ def main():
         action='store_true',
         help='Check existing shard and attempt to add missing files.'
     )
+    parser.add_argument(
+        '--manifest-ttl',
+        default=MANIFEST_TTL / 3600,
+        type=float,
+        help='With --check, reuse cached object listings of shards '
+             'for this many hours.'
+    )
+    parser.add_argument(
+        '--max-bandwidth',
+        default=0,
+        type=float,
+        help='Maximum download rate of all processes together in MB/s. '
+             '0 means unlimited.'
+    )
+    parser.add_argument(
+        '--max-requests',
+        default=0,
+        type=float,
+        help='Maximum requests per second of all processes together. '
+             '0 means unlimited.'
+    )
+    parser.add_argument(
+        '--control-file',
+        default=None,
+        type=str,
+        help='JSON file that is watched for changes to adjust limits at '
+             'runtime, e.g., {"max_bandwidth": 50, "max_requests": 200}.'
+    )
+    parser.add_argument(
+        '--validate',
+        action='store_true',
+        help='Validate images before they are written and drop garbage.'
+    )
+    parser.add_argument(
+        '--compress',
+        type=int,
+        default=None,
+        help='Validate and re-compress images with this quality, e.g., 85.'
+    )
+    parser.add_argument(
+        '--subsampling',
+        type=str,
+        choices=('444', '422', '411', '420'),
+        default='422',
+        help='Use this color subsampling method when compressing.'
+    )
+    parser.add_argument(
+        '--target-size',
+        type=int,
+        default=500,
+        help='Longer side of compressed images',
+    )
+    parser.add_argument(
+        '--dedup',
+        default=None,
+        type=str,
+        help='Path of a content hash store shared by all processes. '
+             'Files with the same content as a stored file are listed '
+             'in <shard>.dups instead of being written to the shard. '
+             'Files larger than --part-size are always written.'
+    )
+    parser.add_argument(
+        '--metrics-interval',
+        default=METRICS_INTERVAL,
+        type=float,
+        help='Write metrics.prom and metrics.json to the output directory '
+             'every this many seconds. 0 disables them.'
+    )
+    parser.add_argument(
+        '--part-size',
+        default=PART_SIZE / MB,
+        type=float,
+        help='Download videos larger than this many MB in parts of this '
+             'size with concurrent ranged GETs. 0 disables parts.'
+    )
+    parser.add_argument(
+        '--part-parallelism',
+        default=4,
+        type=int,
+        help='Number of parts of a video downloaded at the same time.'
+    )
+    parser.add_argument(
+        '--format',
+        default='zip',
+        choices=('zip', 'pack'),
+        help='Write shards as ZIP files or as packs with an index, '
+             'which can be memory-mapped for random access.'
+    )
     args = parser.parse_args()
     indir = Path(args.indir)
     outdir = Path(args.outdir) or args.indir
@@ -290,7 +937,26 @@ def main():
             # args.overwrite,
             args.check,
             args.start,
-            args.end
+            args.end,
+            args.engine,
+            args.endpoint_url,
+            args.scheduler,
+            args.max_concurrency,
+            args.write_buffer * MB,
+            args.journal,
+            args.manifest_ttl * 3600,
+            args.max_bandwidth * MB,
+            args.max_requests,
+            args.control_file,
+            args.validate,
+            args.compress,
+            args.subsampling,
+            args.target_size,
+            args.dedup,
+            args.metrics_interval,
+            int(args.part_size * MB),
+            args.part_parallelism,
+            args.format,
         )
 
     except KeyboardInterrupt:
@@ -0,0 +1,171 @@
+"""
+asyncio download engine for the Downloader. Requires aiohttp.
+
+Objects are fetched with plain unsigned GET requests, which works for the
+public multimedia-commons bucket and for s3local.py.
+Hundreds of requests can be in flight in a single thread.
+"""
+import time
+import asyncio
+import threading as th
+from queue import Full
+from queue import Queue
+from collections import deque
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+from vars import AWS_URL_PREFIX
+from vars import BUCKET_NAME
+from transfer import candidate_keys
+from transfer import THROTTLED
+from transfer import THROTTLE_CODES
+from transfer import TRANSIENT
+
+
+def make_base_url(endpoint_url=None):
+    if endpoint_url:
+        return f'{endpoint_url.rstrip("/")}/{BUCKET_NAME}'
+    return AWS_URL_PREFIX
+
+
+class AsyncFetcher:
+    """
+    Download samples with up to concurrency requests in flight.
+    Each request has a timeout of timeout seconds
+    and is attempted up to retries times.
+    If given, limiter is a RateLimiter for requests and bytes
+    and metrics a DownloadMetrics that records files and errors.
+    """
+    def __init__(
+            self,
+            endpoint_url=None,
+            concurrency=256,
+            timeout=60,
+            retries=5,
+            limiter=None,
+            metrics=None,
+    ):
+        if aiohttp is None:
+            raise RuntimeError('the async engine requires aiohttp')
+        self.base_url = make_base_url(endpoint_url)
+        self.concurrency = concurrency
+        self.timeout = timeout
+        self.retries = retries
+        self.limiter = limiter
+        self.metrics = metrics
+
+    async def fetch_sample(self, session, sample, cache=None):
+        start = time.monotonic()
+        key, data, failed = await self._fetch_sample(session, sample, cache)
+        if self.metrics is not None:
+            self.metrics.record_file(
+                key, data, time.monotonic() - start, failed
+            )
+        return key, data
+
+    def record_error(self, key, error):
+        if self.metrics is None:
+            return
+        status = getattr(error, 'status', None)
+        kind = THROTTLED if str(status) in THROTTLE_CODES else TRANSIENT
+        self.metrics.record_error(key, kind=kind)
+
+    async def _fetch_sample(self, session, sample, cache):
+        canonical_key, keys = candidate_keys(sample, cache)
+        limiter = self.limiter
+        for key in keys:
+            for attempt in range(self.retries):
+                if limiter is not None:
+                    await asyncio.sleep(limiter.reserve_request())
+                try:
+                    async with session.get(f'{self.base_url}/{key}') as r:
+                        if r.status == 404:
+                            break
+                        r.raise_for_status()
+                        data = await r.read()
+                    if limiter is not None:
+                        await asyncio.sleep(limiter.reserve_bytes(len(data)))
+                    if cache is not None:
+                        cache.set(canonical_key, key)
+                    return key, data, False
+                except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                    self.record_error(canonical_key, e)
+                    if attempt == self.retries - 1:
+                        return canonical_key, None, True
+        if cache is not None:
+            cache.set(canonical_key, None)
+        return canonical_key, None, False
+
+    async def fetch_all(self, samples, queue, get_cache=None, ordered=True):
+        connector = aiohttp.TCPConnector(limit=self.concurrency)
+        timeout = aiohttp.ClientTimeout(total=self.timeout)
+        async with aiohttp.ClientSession(
+                connector=connector, timeout=timeout
+        ) as session:
+            loop = asyncio.get_running_loop()
+            # at most a window of samples is in flight, if results are
+            # returned in order it starts at the oldest unfinished one
+            window = deque() if ordered else set()
+            add = window.append if ordered else window.add
+            samples = iter(samples)
+            while True:
+                while len(window) < 2 * self.concurrency:
+                    sample = next(samples, None)
+                    if sample is None:
+                        break
+                    cache = get_cache(sample) if get_cache else None
+                    add(asyncio.ensure_future(
+                        self.fetch_sample(session, sample, cache)
+                    ))
+                if not window:
+                    break
+                if ordered:
+                    results = [await window.popleft()]
+                else:
+                    done, window = await asyncio.wait(
+                        window, return_when=asyncio.FIRST_COMPLETED
+                    )
+                    add = window.add
+                    results = [task.result() for task in done]
+                for result in results:
+                    try:
+                        queue.put_nowait(result)
+                    except Full:
+                        # wait for the consumer without blocking the loop
+                        await loop.run_in_executor(None, queue.put, result)
+
+    def fetch(self, samples, get_cache=None, ordered=True):
+        """
+        Yield (key, data) for the given samples,
+        in order or as they complete if ordered is False.
+        Like Downloader.download_file, data is None if the sample
+        could not be downloaded.
+        If given, get_cache returns the KeyCache for a sample.
+        """
+        end = object()
+        queue = Queue(2 * self.concurrency)
+        errors = []
+
+        def run():
+            try:
+                asyncio.run(self.fetch_all(
+                    samples, queue, get_cache, ordered
+                ))
+            except BaseException as e:
+                errors.append(e)
+            finally:
+                queue.put(end)
+
+        thread = th.Thread(target=run, daemon=True)
+        thread.start()
+        while True:
+            item = queue.get()
+            if item is end:
+                break
+            yield item
+        thread.join()
+        if errors:
+            raise errors[0]
@@ -1,10 +1,17 @@
 """
-Download the YFCC100m dataset from AWS. Requires the metadata files produced by
-the convert_metadata tool as input. Files are stored in 4096 ZIP-files. For
-images shards are ~27000 files each and occupy 11 TiB. The download can be
-stopped at any time and will ignore fully downloaded shards when resumed.
-
-WARNING:
+Repair shards of the YFCC100m dataset by downloading the files that failed.
+Requires the metadata files produced by the convert_metadata tool and the
+output directory of the download tool, where files that could not be
+downloaded are listed in <shard>.err.
+
+Failures are imported into a durable ledger (failures.sqlite in the output
+directory by default, see ledger.py). For every shard with failed keys,
+the keys that are still missing from the shard are found with set lookups
+in the index of the shard, only those are downloaded with many concurrent
+requests and appended to the existing ZIP or pack shard, validated,
+compressed and deduplicated like download.py does. Repaired keys,
+keys that no longer exist and keys that failed again are recorded in the
+ledger, so repairs can be interrupted and run again at any time.
 
 IMPORTANT: Needs AWS credentials to work. Create an AWS account (credit card
            required, but will not be charged). You can install aws-cli and run
@@ -13,193 +20,199 @@ IMPORTANT: Needs AWS credentials to work. Create an AWS account (credit card
            ~/.aws/config
            [default]
            region = us-west-2
-           s3 =
-               max_concurrent_requests = 100
-               max_queue_size = 10000
-               max_bandwidth = 50MB/s
-               multipart_threshold = 64MB
-               multipart_chunksize = 16MB
-               use_accelerate_endpoint = false
 
            ~/.aws/credentials
            [default]
            aws_access_key_id = <key>
            aws_secret_access_key = <secret>
 """
-import io
-import shutil
-import zipfile
-from glob import glob
 from pathlib import Path
-import threading as th
+from functools import partial
 from multiprocessing.pool import ThreadPool
 
-import os
-
-import multiprocessing
 from tqdm import tqdm
-import boto3
-from botocore.exceptions import ClientError
-from datadings.tools.cached_property import cached_property
 
-from vars import BUCKET_NAME
-from tools import find_meta_shards
+from archive import WRITE_BUFFER
+from archive import append_writer
+from download import Downloader
+from ledger import FailureLedger
+from ledger import FAILED
+from ledger import LEDGER_NAME
+from ledger import MISSING
+from ledger import REPAIRED
+from pack import PACK_SUFFIX
+from pack import read_keys
+from tools import MB
 from tools import get_possible_keys
-from tools import WorkerBase
-from tools import load_finished_shards
-from tools import shard_finished
-
-
-class Downloader(WorkerBase):
-    def __init__(self, shards, indir, metadir, outdir, kinds, filter_code, processes, threads):
-        super().__init__(shards, indir, metadir, outdir, kinds, filter_code, processes, threads)
-        self.error_keys = set()
-
-    @cached_property
-    def bucket(self):
-        loc = th.local()
-        if not hasattr(loc, 'bucket'):
-            loc.session = boto3.Session()
-            loc.bucket = loc.session.resource('s3').Bucket(BUCKET_NAME)
-        return loc.bucket
-
-    def file_exists(self, sample):
-        for _, key in get_possible_keys(sample):
-            try:
-                self.bucket.Object(key).load()
-                return True
-            except ClientError:
-                pass
-        return False
-
-    def download_file(self, sample):
-        for canonical_key, key in get_possible_keys(sample):
-            if key not in self.error_keys:
-                # print(f'{key} not in key')
+from tools import hex_range
+from tools import validate_filter
+
+
+def find_shard(outdir, shard):
+    """
+    Returns the path of the ZIP or pack shard,
+    including shards with an interrupted repair, or None.
+    """
+    for suffix in (PACK_SUFFIX, '.zip'):
+        path = outdir / (shard + suffix)
+        if path.exists() or path.with_name(path.name + '.part').exists():
+            return path
+    return None
+
+
+class Repairer(Downloader):
+    """
+    Downloader that appends failed files to finished shards.
+    Files are stored like download.py stores them, so options like
+    validate, compress and dedup should match those of the download.
+    """
+    def __init__(
+            self,
+            shards,
+            indir,
+            metadir,
+            outdir,
+            kinds,
+            filter_code,
+            processes,
+            threads,
+            ledger,
+            max_attempts=0,
+            endpoint_url=None,
+            write_buffer=WRITE_BUFFER,
+            validate=False,
+            compress=None,
+            subsampling='422',
+            target_size=500,
+            dedup=None,
+    ):
+        super().__init__(
+            shards,
+            indir,
+            metadir,
+            outdir,
+            kinds,
+            filter_code,
+            processes,
+            threads,
+            endpoint_url=endpoint_url,
+            write_buffer=write_buffer,
+            validate=validate,
+            compress=compress,
+            subsampling=subsampling,
+            target_size=target_size,
+            dedup=dedup,
+        )
+        self.ledger = ledger
+        self.max_attempts = max_attempts
+
+    def find_missing(self, shard, failed, existing_keys):
+        """
+        Returns samples with failed keys that are not in the shard,
+        a dict that maps their canonical keys to their failed keys,
+        and the failed keys of samples that are in the shard.
+        """
+        missing = []
+        failed_keys = {}
+        present = []
+        for sample in self.prepare_metadata(shard):
+            # the canonical key is also the key of most samples
+            keys = list(dict.fromkeys(
+                key for _, key in get_possible_keys(sample)
+            ))
+            # failures of streamed files are recorded with the resolved key
+            sample_failed = [key for key in keys if key in failed]
+            if not sample_failed:
                 continue
+            if any(key in existing_keys for key in keys):
+                present.extend(sample_failed)
             else:
-                # print(f'{key} in key')
-                # continue
-                try:
-                    bio = io.BytesIO()
-                    for try_time in range(20):
-                        try:
-                            self.bucket.download_fileobj(key, bio)
-                            break
-                        except:
-                            continue
-                    return key, bio.getvalue()
-                except ClientError:
-                    pass
+                missing.append(sample)
+                failed_keys[keys[0]] = sample_failed
+        return missing, failed_keys, present
+
+    def repair_file(self, writer, sample):
+        """
+        Download and store one sample.
+        Returns (canonical key, key, whether it exists, error).
+        """
+        canonical_key, key, data, error = self.fetch_file(sample)
+        if data is not None:
+            self.store_file(writer, key, data)
+        return canonical_key, key, data is not None, error
+
+    def repair_shard(self, shard):
+        """
+        Download failed files of the shard that are still missing and
+        append them to the shard. Returns (shard, number of repaired files).
+        The shard is only opened for writing if files are missing.
+        """
+        path = find_shard(self.outdir, shard)
+        failed = self.ledger.pending(shard, self.max_attempts)
+        if path is None or not failed:
+            return shard, 0
+        writer = None
+        if path.exists():
+            existing_keys = read_keys(path)
         else:
-            # noinspection PyUnboundLocalVariable
-            return canonical_key, None
-
-    def download_files(self, shard, files):
-        pool = ThreadPool(self.threads)
-        with self.position() as position:
-            yield from self.tqdm(
-                pool.imap(self.download_file, files),
-                shard,
-                position,
-                length=len(files),
-            )
-
-    def download_shard(self, shard):
-        metadata = self.prepare_metadata(shard)
-        errpath = self.outdir / (shard + '.err')
-        with zipfile.ZipFile(self.outdir / (shard + '.zip'), 'a') as z:
-            # downloaded_list = z.namelist()
-        # with zipfile.ZipFile(self.outdir / (shard + '.zip'), 'w') as z:
-            for key, data in self.download_files(shard, metadata):
-                if data:
-                    # print(f'key = {key}, data is None = {data is None}')
-                    z.writestr(key, data)
-                # else:
-                #     with errpath.open('at', encoding='utf-8') as err:
-                #         err.write(key+'\n')
-        return shard
-
-    def download_shards(self):
-        with self.positioned(), self.pool() as pool:
-            yield from pool.imap_unordered(self.download_shard, self.shards)
-
-    def find_missing(self, shard, metadata, existing_keys):
-        missing = []
-        # for each sample, check if any of the possible keys is in the shard
-        # if not, check if file exists on AWS and add to list of missing samples
-        with self.position() as position:
-            for sample in self.tqdm(metadata, shard, position):
-                for _, key in get_possible_keys(sample):
-                    if key in existing_keys:
-                        break
+            # restore the shard after an interrupted repair
+            writer = append_writer(path, self.write_buffer)
+            existing_keys = set(writer.keys)
+        # files that were added by download.py --check
+        missing_path = path.with_name(shard + '_missing' + path.suffix)
+        if missing_path.exists():
+            existing_keys |= read_keys(missing_path)
+        existing_keys |= self.skipped_keys(shard)
+        missing, failed_keys, present = \
+            self.find_missing(shard, failed, existing_keys)
+        self.ledger.update(present, REPAIRED)
+        if missing and writer is None:
+            writer = append_writer(path, self.write_buffer)
+        if writer is None:
+            self.finish_shard(shard, repair=True)
+            return shard, 0
+        stored = {}
+        not_found = []
+        errors = {}
+        with writer, ThreadPool(self.threads) as pool, \
+                self.position() as position:
+            for canonical_key, key, exists, error in self.tqdm(
+                    pool.imap_unordered(
+                        partial(self.repair_file, writer), missing
+                    ),
+                    shard,
+                    position,
+                    length=len(missing),
+            ):
+                keys = failed_keys[canonical_key]
+                if exists:
+                    stored[key] = keys
+                elif error is None:
+                    not_found.extend(keys)
                 else:
-                    if self.file_exists(sample):
-                        missing.append(sample)
-        return missing
-
-    def check_shard(self, shard):
-        shardpath = self.outdir / (shard + '.zip')
-        if not shardpath.exists():
-            return shard
-        # get named of all files in shard
-        with zipfile.ZipFile(shardpath, 'r') as z:
-            existing_keys = set(z.namelist())
-        metadata = self.prepare_metadata(shard)
-        missing = self.find_missing(shard, metadata, existing_keys)
-        if missing:
-            shardpath = self.outdir / (shard + '_missing.zip')
-            with zipfile.ZipFile(shardpath, 'w') as z:
-                for key, data in self.download_files(shard, missing):
-                    if data:
-                        z.writestr(key, data)
-        return shard
-
-    def check_shards(self):
+                    errors.setdefault(repr(error), []).extend(keys)
+        self.close_part_pool()
+        # files are only repaired once the shard is complete again,
+        # streamed files may still have failed while they were written
+        repaired = []
+        num_repaired = 0
+        for key, keys in stored.items():
+            if key in writer.failed:
+                errors.setdefault('write failed', []).extend(keys)
+            else:
+                repaired.extend(keys)
+                num_repaired += 1
+        self.ledger.update(repaired, REPAIRED)
+        self.ledger.update(not_found, MISSING)
+        for error, keys in errors.items():
+            self.ledger.update(keys, FAILED, error)
+        self.finish_shard(shard, repair=True)
+        return shard, num_repaired
+
+    def repair_shards(self):
         with self.positioned(), self.pool() as pool:
-            yield from pool.imap_unordered(self.check_shard, self.shards)
-
-    def set_err_keys(self, err_files):
-        tmp_err_folder = './tmp_errs'
-        shutil.rmtree(tmp_err_folder)
-        if not os.path.exists(tmp_err_folder):
-            os.mkdir(tmp_err_folder)
+            yield from pool.imap_unordered(self.repair_shard, self.shards)
 
-        self.bad_err_key_num = 0
-        for err_file in tqdm(err_files):
-            zip_file = err_file[:-4] + '.zip'
-            with zipfile.ZipFile(zip_file, 'r') as z:
-                downloaded_list = z.namelist()
-            new_err_keys = set()
-            with open(err_file, 'r') as f:
-                for line in f:
-                    line = line.strip()
-                    if line not in downloaded_list:
-                        self.error_keys.add(line)
-                        new_err_keys.add(line)
-                    else:
-                        self.bad_err_key_num += 1
-            mv_cmd = f'mv {err_file} {tmp_err_folder}'
-            os.system(mv_cmd)
-            with open(err_file, 'w') as f:
-                f.write('\n'.join(new_err_keys))
-        print(f'size of self.error_key: {len(self.error_keys)}')
-        print(f'bad_err_key_num = {self.bad_err_key_num}')
-        print('')
-
-
-def hex_range(start, end):
-    # 将开始和结束的十六进制字符串转换为整数
-    start_int = int(start, 16)
-    end_int = int(end, 16)
-
-    # 生成从开始到结束的所有整数
-    num_list = range(start_int, end_int + 1)
-
-    # 将这些整数转换为十六进制字符串，并将它们放入一个列表中
-    hex_list = [hex(num)[2:].zfill(3) for num in num_list]
-
-    return hex_list
 
 def download_parallel(
         indir,
@@ -208,40 +221,52 @@ def download_parallel(
         kinds=(0, 1),
         filter_code='lambda x: True',
         processes=8,
-        threads=8,
-        # overwrite=False,
-        check=False,
-        err_files=[],
+        threads=64,
+        ledger_path=None,
         shard_start='000',
-        shard_end='fff'
+        shard_end='fff',
+        endpoint_url=None,
+        write_buffer=WRITE_BUFFER,
+        max_attempts=0,
+        validate=False,
+        compress=None,
+        subsampling='422',
+        target_size=500,
+        dedup=None,
 ):
-    if not shards:
-        shards = find_meta_shards(indir)
-        shard_range = hex_range(shard_start, shard_end)
-
-        shards = list(set(shards) & set(shard_range))
-        # finished_shards = load_finished_shards(outdir)
-        # if check:
-        #     shards = finished_shards
-        # elif not overwrite:
-        #     shards -= finished_shards
-        shards = sorted(shards)
-
-    downloader = Downloader(
-        shards, indir, indir, outdir, kinds, filter_code, processes, threads
+    ledger = FailureLedger(ledger_path or outdir / LEDGER_NAME)
+    imported = sum(
+        ledger.import_err(path) for path in sorted(outdir.glob('*.err'))
+    )
+    if imported:
+        print(f'imported {imported} failed keys')
+    pending = ledger.shards(max_attempts)
+    if shards:
+        shards = sorted(set(shards) & set(pending))
+    else:
+        shard_range = set(hex_range(shard_start, shard_end))
+        shards = [shard for shard in pending if shard in shard_range]
+
+    repairer = Repairer(
+        shards, indir, indir, outdir, kinds, filter_code, processes, threads,
+        ledger, max_attempts, endpoint_url, write_buffer, validate, compress,
+        subsampling, target_size, dedup,
     )
-    downloader.set_err_keys(err_files)
     gen = tqdm(
-        downloader.check_shards() if check else downloader.download_shards(),
+        repairer.repair_shards(),
         desc='total',
         total=len(shards),
         smoothing=0,
         position=0,
     )
-    for shard in gen:
-        if not check:
-            pass
-            # shard_finished(shard, outdir)
+    num_repaired = 0
+    for _, repaired in gen:
+        num_repaired += repaired
+    counts = ledger.counts()
+    print(f'repaired {num_repaired} files, '
+          f'{counts.get(FAILED, 0)} failed, '
+          f'{counts.get(MISSING, 0)} missing in the bucket')
+    ledger.close()
 
 
 def main():
@@ -255,15 +280,15 @@ def main():
     )
     parser.add_argument(
         '-p', '--processes',
-        default=16,#todo
+        default=8,
         type=int,
-        help='Number of shards downloaded in parallel.'
+        help='Number of shards repaired in parallel.'
     )
     parser.add_argument(
         '-t', '--threads',
-        default=8,
+        default=64,
         type=int,
-        help='Number of threads to download each shard.'
+        help='Number of threads to download the missing files of each shard.'
     )
 
     def _kind(v):
@@ -283,9 +308,8 @@ def main():
         default=(),
         type=str,
         nargs='+',
-        help='Specify individual shards to download.'
+        help='Specify individual shards to repair.'
     )
-
     parser.add_argument(
         '--start',
         type=str,
@@ -299,30 +323,77 @@ def main():
         help='end shard index'
     )
 
-
     def _evalable(v):
-        eval(v)
+        validate_filter(v)
         return v
     parser.add_argument(
         '--filter',
         type=_evalable,
         default='lambda x: True',
-        help='Lambda function to select samples.'
+        help='Lambda function or filter expression to select samples, '
+             'e.g., "accuracy >= 12 and usertags has beach".'
+    )
+    parser.add_argument(
+        '--ledger',
+        default=None,
+        type=str,
+        help=f'Path of the failure ledger. Defaults to <outdir>/{LEDGER_NAME}.'
     )
-    # parser.add_argument(
-    #     '--overwrite',
-    #     action='store_true',
-    #     help='Overwrite finished shards.'
-    # )
     parser.add_argument(
-        '--check',
+        '--max-attempts',
+        default=0,
+        type=int,
+        help='Give up on keys that failed this many repairs. '
+             '0 retries them forever.'
+    )
+    parser.add_argument(
+        '--write-buffer',
+        default=WRITE_BUFFER // MB,
+        type=int,
+        help='Maximum MB of downloaded files waiting to be written per shard.'
+    )
+    parser.add_argument(
+        '--endpoint-url',
+        default=None,
+        type=str,
+        help='Use this S3 endpoint instead of AWS, e.g., s3local.py.'
+    )
+    parser.add_argument(
+        '--validate',
         action='store_true',
-        help='Check existing shard and attempt to add missing files.'
+        help='Validate images before they are written and drop garbage.'
+    )
+    parser.add_argument(
+        '--compress',
+        type=int,
+        default=None,
+        help='Validate and re-compress images with this quality, e.g., 85.'
+    )
+    parser.add_argument(
+        '--subsampling',
+        type=str,
+        choices=('444', '422', '411', '420'),
+        default='422',
+        help='Use this color subsampling method when compressing.'
+    )
+    parser.add_argument(
+        '--target-size',
+        type=int,
+        default=500,
+        help='Longer side of compressed images',
+    )
+    parser.add_argument(
+        '--dedup',
+        default=None,
+        type=str,
+        help='Path of the content hash store used for the download. '
+             'Files with the same content as a stored file are listed '
+             'in <shard>.dups instead of being written to the shard. '
+             'Files larger than the part size are always written.'
     )
     args = parser.parse_args()
-    err_files = glob(os.path.join(args.outdir, '*.err'))
     indir = Path(args.indir)
-    outdir = Path(args.outdir) or args.indir
+    outdir = Path(args.outdir or args.indir)
 
     try:
         download_parallel(
@@ -333,15 +404,21 @@ def main():
             args.filter,
             args.processes,
             args.threads,
-            # args.overwrite,
-            args.check,
-            err_files,
+            args.ledger,
             args.start,
-            args.end
+            args.end,
+            args.endpoint_url,
+            args.write_buffer * MB,
+            args.max_attempts,
+            args.validate,
+            args.compress,
+            args.subsampling,
+            args.target_size,
+            args.dedup,
         )
     except KeyboardInterrupt:
         pass
 
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    main()
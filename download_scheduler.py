@@ -0,0 +1,194 @@
+"""
+Concurrency and rate control for downloads.
+"""
+import json
+import time
+import threading as th
+
+from tqdm import tqdm
+
+from transfer import SharedState
+from transfer import is_not_found
+from transfer import is_throttle
+from tools import MB
+
+
+class AIMDLimiter:
+    """
+    Limit the number of concurrent requests.
+    The limit is adjusted every interval seconds with additive increase and
+    multiplicative decrease (AIMD), based on the number of finished
+    requests and the number of errors in the last interval:
+
+    - if requests were throttled or more than error_threshold of attempts
+      failed, the limit is multiplied by decrease,
+    - if throughput dropped by more than drop_threshold after the last
+      increase, that increase is reverted,
+    - otherwise the limit grows by increase.
+    """
+    def __init__(
+            self,
+            initial=8,
+            minimum=1,
+            maximum=256,
+            increase=4,
+            decrease=0.5,
+            error_threshold=0.02,
+            drop_threshold=0.2,
+            interval=5.0,
+    ):
+        self.limit = max(minimum, min(initial, maximum))
+        self.minimum = minimum
+        self.maximum = maximum
+        self.increase = increase
+        self.decrease = decrease
+        self.error_threshold = error_threshold
+        self.drop_threshold = drop_threshold
+        self.interval = interval
+        self.active = 0
+        self.finished = 0
+        self.errors = 0
+        self.throttles = 0
+        self.num_bytes = 0
+        self.rate = 0
+        self.increased = False
+        self.last_adjust = time.monotonic()
+        self.cond = th.Condition()
+        self.stopped = th.Event()
+
+    def acquire(self):
+        with self.cond:
+            while self.active >= self.limit:
+                self.cond.wait()
+            self.active += 1
+
+    def release(self, num_bytes=0):
+        with self.cond:
+            self.active -= 1
+            self.finished += 1
+            self.num_bytes += num_bytes
+            self.cond.notify()
+
+    def record_error(self, error):
+        # missing files are expected and say nothing about the load
+        if is_not_found(error):
+            return
+        with self.cond:
+            self.errors += 1
+            if is_throttle(error):
+                self.throttles += 1
+
+    def adjust(self):
+        with self.cond:
+            now = time.monotonic()
+            rate = self.finished / max(now - self.last_adjust, 1e-6)
+            error_ratio = self.errors / max(self.finished + self.errors, 1)
+            if self.throttles or error_ratio > self.error_threshold:
+                limit = int(self.limit * self.decrease)
+                self.increased = False
+            elif self.increased \
+                    and rate < (1 - self.drop_threshold) * self.rate:
+                limit = self.limit - self.increase
+                self.increased = False
+            else:
+                limit = self.limit + self.increase
+                self.increased = True
+            self.limit = max(self.minimum, min(limit, self.maximum))
+            self.rate = rate
+            self.finished = self.errors = self.throttles = 0
+            self.last_adjust = now
+            self.cond.notify_all()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            self.adjust()
+
+    def start(self):
+        th.Thread(target=self.run, daemon=True).start()
+
+    def stop(self):
+        self.stopped.set()
+
+
+class RateLimiter(SharedState):
+    """
+    Token buckets that limit bytes/s and requests/s of all worker
+    processes together. A rate of 0 means unlimited.
+    Each bucket holds up to burst seconds worth of tokens.
+
+    Tokens are reserved before they are available and the caller waits
+    until the reservation is covered. Bytes are only known after a file
+    is downloaded, so large files delay the next request of the caller.
+    reserve_request and reserve_bytes return the time to wait,
+    e.g., for asyncio, while request and consume wait themselves.
+    """
+    BYTE_RATE, BYTE_TOKENS, BYTE_TIME = range(3)
+    REQUEST_RATE, REQUEST_TOKENS, REQUEST_TIME = range(3, 6)
+
+    def __init__(self, max_bandwidth=0, max_requests=0, burst=1.0):
+        super().__init__([max_bandwidth, 0, 0, max_requests, 0, 0])
+        self.burst = burst
+
+    def set_rates(self, max_bandwidth, max_requests):
+        state = self.state
+        with state.get_lock():
+            state[self.BYTE_RATE] = max_bandwidth
+            state[self.REQUEST_RATE] = max_requests
+
+    def _reserve(self, index, amount):
+        state = self.state
+        # avoid the lock if unlimited
+        if state[index] <= 0:
+            return 0
+        with state.get_lock():
+            rate = state[index]
+            if rate <= 0:
+                return 0
+            now = time.monotonic()
+            tokens = state[index + 1] + (now - state[index + 2]) * rate
+            tokens = min(tokens, rate * self.burst) - amount
+            state[index + 1] = tokens
+            state[index + 2] = now
+        return max(0.0, -tokens / rate)
+
+    def reserve_request(self):
+        return self._reserve(self.REQUEST_RATE, 1)
+
+    def reserve_bytes(self, num_bytes):
+        return self._reserve(self.BYTE_RATE, num_bytes)
+
+    def request(self):
+        delay = self.reserve_request()
+        if delay:
+            time.sleep(delay)
+
+    def consume(self, num_bytes):
+        delay = self.reserve_bytes(num_bytes)
+        if delay:
+            time.sleep(delay)
+
+    def watch(self, path, interval=1.0):
+        """
+        Start a thread that applies changes to the JSON control file path,
+        e.g., {"max_bandwidth": 50, "max_requests": 200},
+        with max_bandwidth in MB/s. Missing values mean unlimited.
+        """
+        def run():
+            mtime = None
+            while True:
+                try:
+                    current = path.stat().st_mtime_ns
+                    if current != mtime:
+                        mtime = current
+                        control = json.loads(path.read_text('utf-8'))
+                        self.set_rates(
+                            float(control.get('max_bandwidth', 0)) * MB,
+                            float(control.get('max_requests', 0)),
+                        )
+                except FileNotFoundError:
+                    pass
+                except (ValueError, TypeError, AttributeError) as e:
+                    tqdm.write(f'ignoring invalid control file {path}: {e}')
+                time.sleep(interval)
+
+        th.Thread(target=run, daemon=True).start()
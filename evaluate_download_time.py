@@ -0,0 +1,231 @@
+"""
+Benchmark download_parallel end-to-end against s3local.py.
+
+A synthetic multimedia-commons bucket and matching metadata shards are
+generated in a temporary directory. Some samples are missing and some are
+stored under their original extension, like in the real bucket.
+The server runs in its own process with configurable latency, bandwidth
+and error injection. Every combination of the given engines, schedulers,
+processes and threads downloads all shards into a fresh output directory
+and files/s, MB/s, p50/p99 latency per file (from the download metrics),
+requests per S3 connection and peak RSS of all download processes
+together are reported.
+
+Run from the repository directory, e.g.:
+    python evaluate_download_time.py --processes 1 4 --threads 8 32
+"""
+import os
+import json
+import time
+import random
+import argparse
+import tempfile
+import gzip
+import resource
+import itertools as it
+import multiprocessing as mp
+from pathlib import Path
+
+# s3local.py ignores credentials, but boto3 needs some
+os.environ.setdefault('AWS_ACCESS_KEY_ID', 'local')
+os.environ.setdefault('AWS_SECRET_ACCESS_KEY', 'local')
+os.environ.setdefault('AWS_DEFAULT_REGION', 'us-west-2')
+
+from s3local import S3Server
+from vars import BUCKET_NAME
+from tools import MB
+from tools import get_possible_keys
+from download import download_parallel
+
+PAGE_SIZE = os.sysconf('SC_PAGE_SIZE')
+
+
+def make_dataset(root, shards, sample_num, min_size, max_size, missing):
+    """
+    Create metadata shards in root/meta and their files in root/s3.
+    Returns the number of files and their total size.
+    """
+    rnd = random.Random(0)
+    metadir = root / 'meta'
+    metadir.mkdir()
+    num_files = num_bytes = 0
+    for shard in shards:
+        samples = []
+        for _ in range(sample_num):
+            ext = 'jpg' if rnd.random() < 0.9 else 'png'
+            sample = {
+                'key': f'{shard}{rnd.getrandbits(116):029x}',
+                'marker': 0,
+                'ext': ext,
+            }
+            samples.append(sample)
+            if rnd.random() < missing:
+                continue
+            # the original extension is used if it is not jpg
+            _, key = list(get_possible_keys(sample))[-1]
+            path = root / 's3' / BUCKET_NAME / key
+            path.parent.mkdir(parents=True, exist_ok=True)
+            size = rnd.randint(min_size, max_size)
+            path.write_bytes(rnd.randbytes(size))
+            num_files += 1
+            num_bytes += size
+        with gzip.open(metadir / (shard + '.gz'), 'wt') as fp:
+            for sample in samples:
+                fp.write(json.dumps(sample) + '\n')
+    return num_files, num_bytes
+
+
+def tree_rss(pid):
+    """
+    Returns the resident memory of pid and all its descendants in bytes.
+    """
+    total = 0
+    pids = [pid]
+    while pids:
+        pid = pids.pop()
+        try:
+            with open(f'/proc/{pid}/statm') as fp:
+                total += int(fp.read().split()[1]) * PAGE_SIZE
+            for task in os.listdir(f'/proc/{pid}/task'):
+                with open(f'/proc/{pid}/task/{task}/children') as fp:
+                    pids.extend(int(p) for p in fp.read().split())
+        except (FileNotFoundError, ProcessLookupError):
+            pass
+    return total
+
+
+def run(metadir, outdir, shards, kwargs):
+    download_parallel(metadir, outdir, shards, (0,), **kwargs)
+
+
+def benchmark(root, shards, endpoint_url, name, kwargs):
+    """
+    Run download_parallel in a new process and return its metrics
+    and the peak RSS of the process tree.
+    """
+    outdir = root / name
+    outdir.mkdir()
+    kwargs = dict(kwargs, endpoint_url=endpoint_url, metrics_interval=1)
+    process = mp.Process(
+        target=run, args=(root / 'meta', outdir, shards, kwargs)
+    )
+    t0 = time.perf_counter()
+    process.start()
+    peak_rss = 0
+    use_proc = os.path.exists(f'/proc/{process.pid}/task')
+    while process.is_alive():
+        if use_proc:
+            peak_rss = max(peak_rss, tree_rss(process.pid))
+        time.sleep(0.05)
+    process.join()
+    t = time.perf_counter() - t0
+    if not use_proc:
+        # largest single process, in KiB on Linux
+        peak_rss = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * 1024
+    if process.exitcode != 0:
+        raise RuntimeError(f'{name} failed with exit code {process.exitcode}')
+    metrics = json.loads((outdir / 'metrics.json').read_text('utf-8'))
+    metrics['seconds'] = t
+    metrics['peak_rss'] = peak_rss
+    return metrics
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+    )
+    parser.add_argument('--shards', default=4, type=int)
+    parser.add_argument('--files', default=1000, type=int,
+                        help='Samples per shard.')
+    parser.add_argument('--min-size', default=20, type=int,
+                        help='Minimum file size in KB.')
+    parser.add_argument('--max-size', default=200, type=int,
+                        help='Maximum file size in KB.')
+    parser.add_argument('--missing', default=0.05, type=float,
+                        help='Fraction of samples without file.')
+    parser.add_argument('--latency', default=20, type=float,
+                        help='Server latency per request in ms.')
+    parser.add_argument('--bandwidth', default=0, type=float,
+                        help='Server bandwidth in MB/s, 0 is unlimited.')
+    parser.add_argument('--error-rate', default=0, type=float,
+                        help='Fraction of requests with 500 InternalError.')
+    parser.add_argument('--throttle-rate', default=0, type=float,
+                        help='Fraction of requests with 503 SlowDown.')
+    parser.add_argument('--engines', default=('threads', 'async'),
+                        nargs='+', choices=('threads', 'async'))
+    parser.add_argument('--schedulers', default=('shards',),
+                        nargs='+', choices=('shards', 'adaptive'))
+    parser.add_argument('--processes', default=(1, 4), type=int, nargs='+')
+    parser.add_argument('--threads', default=(8, 32), type=int, nargs='+')
+    parser.add_argument('--output', default=None, type=str,
+                        help='Also write results to this JSON file.')
+    args = parser.parse_args()
+
+    shards = [f'{i:03x}' for i in range(args.shards)]
+    grid = [
+        (engine, scheduler, processes, threads)
+        for engine, scheduler, processes, threads in it.product(
+            args.engines, args.schedulers, args.processes, args.threads
+        )
+        # the adaptive scheduler always uses boto3 threads
+        if not (scheduler == 'adaptive' and engine == 'async')
+    ]
+    results = []
+    with tempfile.TemporaryDirectory() as tmpdir:
+        root = Path(tmpdir)
+        num_files, num_bytes = make_dataset(
+            root, shards, args.files,
+            args.min_size * 1000, args.max_size * 1000, args.missing,
+        )
+        server = S3Server(
+            root / 's3',
+            latency=args.latency / 1000,
+            bandwidth=args.bandwidth * MB,
+            error_rate=args.error_rate,
+            throttle_rate=args.throttle_rate,
+        )
+        # serve from a separate process, so the server does not compete
+        # with the benchmark for the GIL
+        server_process = mp.Process(target=server.serve_forever, daemon=True)
+        server_process.start()
+        try:
+            for engine, scheduler, processes, threads in grid:
+                name = f'{engine}-{scheduler}-{processes}-{threads}'
+                metrics = benchmark(root, shards, server.endpoint_url, name, {
+                    'engine': engine,
+                    'scheduler': scheduler,
+                    'processes': processes,
+                    'threads': threads,
+                })
+                results.append({
+                    'engine': engine,
+                    'scheduler': scheduler,
+                    'processes': processes,
+                    'threads': threads,
+                    **metrics,
+                })
+        finally:
+            server_process.terminate()
+            server.server_close()
+
+    print(f'{num_files} files, {num_bytes / 1e6:.0f} MB in {len(shards)} '
+          f'shards, {args.latency:.0f} ms latency')
+    print(f'{"engine":8} {"scheduler":9} {"proc":>4} {"thr":>4} '
+          f'{"files/s":>9} {"MB/s":>8} {"p50 ms":>8} {"p99 ms":>8} '
+          f'{"failed":>6} {"req/conn":>8} {"RSS MB":>8}')
+    for r in results:
+        p50 = (r['latency_p50'] or 0) * 1000
+        p99 = (r['latency_p99'] or 0) * 1000
+        reuse = r.get('requests_per_connection') or 0
+        print(f'{r["engine"]:8} {r["scheduler"]:9} {r["processes"]:4d} '
+              f'{r["threads"]:4d} {r["files"] / r["seconds"]:9.1f} '
+              f'{r["bytes"] / r["seconds"] / 1e6:8.1f} {p50:8.1f} '
+              f'{p99:8.1f} {r["failed"]:6d} {reuse:8.1f} '
+              f'{r["peak_rss"] / 1e6:8.1f}')
+    if args.output:
+        Path(args.output).write_text(json.dumps(results, indent=2), 'utf-8')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,49 @@
+"""
+Compare yfcc_hash with yfcc_hash_batch on synthetic download URLs.
+Run with python -m yfcc100m.evaluate_hash_time
+"""
+import random
+import time
+
+from .convert_metadata import yfcc_hash
+from .convert_metadata import yfcc_hash_batch
+
+total_url_num = 1_000_000
+chunk_size = 1024
+
+
+def make_urls(n, seed=0):
+    rnd = random.Random(seed)
+    return [
+        f'http://farm{rnd.randint(1, 9)}.staticflickr.com/'
+        f'{rnd.randint(1, 9999)}/{rnd.getrandbits(34)}_{rnd.getrandbits(40):x}.jpg'
+        for _ in range(n)
+    ]
+
+
+def timed(fun, urls):
+    t0 = time.perf_counter()
+    keys = fun(urls)
+    t1 = time.perf_counter()
+    return keys, t1 - t0
+
+
+def single(urls):
+    return [yfcc_hash(url) for url in urls]
+
+
+def batched(urls):
+    keys = []
+    for i in range(0, len(urls), chunk_size):
+        keys.extend(yfcc_hash_batch(urls[i:i+chunk_size]))
+    return keys
+
+
+urls = make_urls(total_url_num)
+single_keys, single_time = timed(single, urls)
+batched_keys, batched_time = timed(batched, urls)
+assert single_keys == batched_keys
+
+print(f'yfcc_hash:       {total_url_num / single_time:12,.0f} urls/s')
+print(f'yfcc_hash_batch: {total_url_num / batched_time:12,.0f} urls/s')
+print(f'speedup = {single_time / batched_time:.2f}')
@@ -0,0 +1,93 @@
+"""
+Compare the gzip text reader that load_metadata used before with the
+block-wise reader on a synthetic metadata shard.
+Run with python -m yfcc100m.evaluate_metadata_time
+"""
+import gzip
+import json
+import random
+import tempfile
+import time
+from pathlib import Path
+
+from .tools import json_loads
+from .tools import iter_jsonl_batches
+from .tools import load_jsonl
+
+shard_sample_num = 27000
+repeats = 5
+
+
+def make_sample(rnd, i):
+    photoid = rnd.getrandbits(34)
+    has_geo = rnd.random() < 0.3
+    return {
+        'photoid': photoid,
+        'uid': f'{rnd.getrandbits(30)}@N00',
+        'unickname': f'user{i % 1000}',
+        'datetaken': '2010-01-01 00:00:00.0',
+        'dateuploaded': str(1262304000 + i),
+        'capturedevice': 'Canon+EOS+400D+DIGITAL',
+        'title': f'title {i}',
+        'description': 'some+description+text ' * rnd.randint(0, 10),
+        'usertags': ','.join(rnd.sample(
+            ['beach', 'sun', 'dog', 'cat', 'nyc', 'paris', 'tree'], 3
+        )),
+        'machinetags': '',
+        'longitude': rnd.uniform(-180, 180) if has_geo else None,
+        'latitude': rnd.uniform(-90, 90) if has_geo else None,
+        'accuracy': rnd.randint(1, 16) if has_geo else None,
+        'pageurl': f'http://www.flickr.com/photos/x/{photoid}/',
+        'downloadurl': f'http://farm1.staticflickr.com/1/{photoid}_abc.jpg',
+        'licensename': 'Attribution-NonCommercial-ShareAlike License',
+        'licenseurl': 'http://creativecommons.org/licenses/by-nc-sa/2.0/',
+        'serverid': rnd.randint(1, 9999),
+        'farmid': rnd.randint(1, 9),
+        'secret': f'{rnd.getrandbits(40):x}',
+        'secretoriginal': f'{rnd.getrandbits(40):x}',
+        'ext': 'jpg',
+        'marker': 0,
+        'key': f'{rnd.getrandbits(128):x}',
+    }
+
+
+def write_shard(path):
+    rnd = random.Random(0)
+    # append in chunks like convert_metadata to get multiple gzip members
+    for start in range(0, shard_sample_num, 1000):
+        with gzip.open(path, 'at', encoding='utf-8', compresslevel=1) as fp:
+            for i in range(start, min(start + 1000, shard_sample_num)):
+                fp.write(json.dumps(make_sample(rnd, i)) + '\n')
+
+
+def load_text(path):
+    with gzip.open(path, 'rt', encoding='utf-8') as fp:
+        for line in fp:
+            yield json.loads(line)
+
+
+def load_batches(path):
+    for batch in iter_jsonl_batches(path):
+        yield from batch
+
+
+def timed(fun, path):
+    best = float('inf')
+    for _ in range(repeats):
+        t0 = time.perf_counter()
+        samples = list(fun(path))
+        best = min(best, time.perf_counter() - t0)
+    return samples, best
+
+
+with tempfile.TemporaryDirectory() as tmpdir:
+    path = Path(tmpdir) / '000.gz'
+    write_shard(path)
+    reference, reference_time = timed(load_text, path)
+    print(f'JSON backend: {json_loads.__module__}')
+    print(f'gzip text + json:  {shard_sample_num / reference_time:10,.0f} rows/s')
+    for name, fun in (('load_jsonl', load_jsonl), ('batches', load_batches)):
+        samples, t = timed(fun, path)
+        assert samples == reference
+        print(f'{name + ":":18} {shard_sample_num / t:10,.0f} rows/s '
+              f'(speedup = {reference_time / t:.2f})')
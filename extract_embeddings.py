@@ -20,7 +20,7 @@ import threading
 
 # total_image_num = 99000000
 # model_name = 'vit_small_patch16_224_in21k'
-from download_repair_error import hex_range
+from tools import hex_range
 
 model_name = 'vit_tiny_patch16_224_in21k'
 # device_id = '2'
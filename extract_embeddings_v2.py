@@ -5,6 +5,7 @@ import time
 from collections import defaultdict
 from glob import glob
 
+import io
 import zipfile
 
 import h5py
@@ -19,7 +20,9 @@ from torch.utils.data import DataLoader
 from multiprocessing import Pool
 import threading
 
-from download_repair_error import hex_range
+from tools import hex_range
+from dedup import DedupStore
+from pack import PackReader
 
 
 def process_zip(zip_path):
@@ -31,7 +34,7 @@ def process_zip(zip_path):
 
 
 class YFCCZipsDataset(Dataset):
-    def __init__(self, zip_file, transform=None, extract_root='./extract_folder'):
+    def __init__(self, zip_file, transform=None, extract_root='./extract_folder', dedup=None):
         self.zip_file = zip_file
         self.transform = transform
         self.extract_root = extract_root
@@ -41,8 +44,13 @@ class YFCCZipsDataset(Dataset):
             os.makedirs(self.extract_root)
         self.extract_folder = os.path.join(extract_root, os.path.basename(self.zip_file).split('.')[0])
         with zipfile.ZipFile(self.zip_file, 'r') as z:
-            z.extractall(self.extract_folder)
-            self.img_paths = [os.path.join(self.extract_folder, rel_path) for rel_path in z.namelist()]
+            names = z.namelist()
+            # skip files with the same content as an earlier file
+            if dedup is not None:
+                duplicates = dedup.duplicates(names)
+                names = [name for name in names if name not in duplicates]
+            z.extractall(self.extract_folder, names)
+            self.img_paths = [os.path.join(self.extract_folder, rel_path) for rel_path in names]
         self.img_paths = sorted(self.img_paths)
 
     def __len__(self):
@@ -63,6 +71,36 @@ class YFCCZipsDataset(Dataset):
             return img_key, None
 
 
+class YFCCPackDataset(Dataset):
+    """
+    Reads images directly from a memory-mapped pack, nothing is extracted.
+    """
+    def __init__(self, pack_file, transform=None, dedup=None):
+        self.pack_file = pack_file
+        self.transform = transform
+        self.reader = PackReader(pack_file)
+        keys = self.reader.keys()
+        # skip files with the same content as an earlier file
+        duplicates = dedup.duplicates(keys) if dedup is not None else {}
+        self.indices = [i for i, key in enumerate(keys) if key not in duplicates]
+        self.img_keys = [keys[i].split('/')[-1].split('.')[0] for i in self.indices]
+
+    def __len__(self):
+        return len(self.indices)
+
+    def __getitem__(self, idx):
+        img_key = self.img_keys[idx]
+        try:
+            image = Image.open(io.BytesIO(self.reader.read(self.indices[idx]))).convert('RGB')
+            if self.transform:
+                image = self.transform(image)
+            return img_key, image
+        except:
+            with open(f'errs/{img_key}.txt', 'a') as f:
+                f.write(f'{self.pack_file}\n')
+            return img_key, None
+
+
 def collate_fn(batch):
     batch = list(filter(lambda x: x[1] is not None, batch))
     if len(batch) == 0:
@@ -93,7 +131,12 @@ def extract_one_zip(args, zip_id):
     )
 
     extract_root = './extract_folder'
-    dataset = YFCCZipsDataset(zip_file=f'images/{zip_id}.zip', transform=tfms, extract_root=extract_root)
+    dedup = DedupStore(args.dedup) if args.dedup else None
+    if os.path.exists(f'images/{zip_id}.pack'):
+        dataset = YFCCPackDataset(pack_file=f'images/{zip_id}.pack', transform=tfms, dedup=dedup)
+    else:
+        dataset = YFCCZipsDataset(zip_file=f'images/{zip_id}.zip', transform=tfms, extract_root=extract_root,
+                                  dedup=dedup)
     print(f'image num = {len(dataset)}')
 
     dataloader = DataLoader(dataset, batch_size=batch_size, shuffle=False,
@@ -142,6 +185,7 @@ if __name__ == '__main__':
     parser.add_argument('--batch_size', type=int, default=64)
     parser.add_argument('--start', type=str, required=True)
     parser.add_argument('--end', type=str, required=True)
+    parser.add_argument('--dedup', type=str, default=None, help='content hash store of the download, skip duplicates')
     args = parser.parse_args()
     print(args)
     t0 = time.time()
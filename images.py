@@ -0,0 +1,105 @@
+"""
+Validation and re-compression of downloaded JPEG images.
+Used by the converter and, optionally, by the downloader
+before images are written to disk.
+"""
+import io
+from math import ceil
+
+import numpy as np
+from PIL import Image
+from simplejpeg import decode_jpeg
+from simplejpeg import decode_jpeg_header
+from simplejpeg import encode_jpeg
+
+
+def encode_fast(
+        arr,
+        quality=85,
+        colorspace='RGB',
+        colorsubsampling='422',
+        long_side=500,
+        target_pixels=500*375,
+):
+    h, w = arr.shape[:2]
+    # enforce full color resolution for small images
+    if h*w <= 0.5*target_pixels:
+        colorsubsampling = '444'
+    # downscale big images
+    if h*w > 1.5*target_pixels:
+        s = max(w, h)
+        r = long_side/s
+        w, h = int(round(r*w)), int(round(r*h))
+        pil = Image.fromarray(arr, 'RGB')
+        arr = np.array(pil.resize((w, h), resample=Image.LANCZOS))
+    return encode_jpeg(
+        arr,
+        quality=quality,
+        colorspace=colorspace,
+        colorsubsampling=colorsubsampling,
+    )
+
+
+def decode_fast(data):
+    try:
+        # decode JPEGs at reduced size for speedup
+        return data, False, decode_jpeg(
+            data,
+            'gray',
+            fastdct=True,
+            fastupsample=True,
+            min_height=100,
+            min_width=100,
+            min_factor=1,
+        )
+    except ValueError:
+        # use pillow in case anything goes wrong
+        # and re-encode the image
+        bio = io.BytesIO(data)
+        im = Image.open(bio)
+        data = encode_fast(np.array(im.convert('RGB')))
+        return data, True, np.array(im.convert('L'))
+
+
+def validate_image(data):
+    try:
+        data, compressed, im = decode_fast(data)
+        # if the compressed image is very small
+        # and less than 5% of all lines have significant variance
+        # the image is most likely garbage
+        if len(data) < 20000 and np.percentile(im.var(0), 95) < 50:
+            return None, False
+        return data, compressed
+    except (ValueError, IOError, OSError):
+        return None, False
+
+
+def transcode_image(data, compress=None, subsampling='422', target_size=500):
+    """
+    Validate the image and, if compress is given, re-compress it with
+    this quality, downscaled so the longer side is target_size.
+    Small images are not compressed again.
+    Returns None if the image is garbage or cannot be decoded.
+    """
+    data, compressed = validate_image(data)
+    if data is None:
+        return None
+    if compress and not compressed:
+        short_side = int(ceil(target_size / 4 * 3))
+        target_pixels = target_size * short_side
+        h, w, _, _ = decode_jpeg_header(data)
+        # do not compress small images
+        if h * w > 0.5 * target_pixels:
+            arr = decode_jpeg(
+                data,
+                min_width=short_side,
+                min_height=short_side,
+            )
+            data = encode_fast(
+                arr,
+                quality=compress,
+                colorsubsampling=subsampling,
+                target_pixels=target_pixels,
+                long_side=target_size,
+            )
+    return data
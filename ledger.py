@@ -0,0 +1,186 @@
+"""
+Durable ledger of files that could not be downloaded.
+
+Like the dedup store, the ledger is an SQLite database in WAL mode that
+any number of processes can use at the same time. Every failed key is
+stored with its shard, status, number of repair attempts and last error:
+
+    failed    still needs to be downloaded
+    repaired  is in its shard now
+    missing   does not exist in the bucket (anymore)
+
+Failures are imported from the <shard>.err files written by the
+downloader. An .err file is imported again only if it changed, e.g.,
+because the shard was downloaded again, so keys that were repaired
+since are not retried.
+
+Print the status of a ledger with:
+    python ledger.py images/failures.sqlite
+"""
+import time
+import sqlite3
+import argparse
+import threading as th
+from pathlib import Path
+
+
+LEDGER_NAME = 'failures.sqlite'
+FAILED = 'failed'
+REPAIRED = 'repaired'
+MISSING = 'missing'
+SCHEMA = (
+    'CREATE TABLE IF NOT EXISTS failures ('
+    'key TEXT PRIMARY KEY, shard TEXT NOT NULL, status TEXT NOT NULL, '
+    'attempts INTEGER NOT NULL DEFAULT 0, error TEXT, updated REAL NOT NULL'
+    ') WITHOUT ROWID',
+    'CREATE INDEX IF NOT EXISTS failures_shard ON failures (shard, status)',
+    'CREATE TABLE IF NOT EXISTS imports '
+    '(path TEXT PRIMARY KEY, mtime_ns INTEGER, size INTEGER) WITHOUT ROWID',
+)
+
+
+class FailureLedger:
+    """
+    Failure ledger at path, see module docstring.
+    The connection is opened on first use, so ledgers can be passed to
+    worker processes. Threads share the connection of their process.
+    """
+    def __init__(self, path, timeout=60):
+        self.path = Path(path)
+        self.timeout = timeout
+        self.conn = None
+        self.lock = th.Lock()
+
+    def __getstate__(self):
+        return self.path, self.timeout
+
+    def __setstate__(self, state):
+        self.__init__(*state)
+
+    def _connect(self):
+        if self.conn is None:
+            conn = sqlite3.connect(
+                self.path,
+                timeout=self.timeout,
+                isolation_level=None,
+                check_same_thread=False,
+            )
+            conn.execute('PRAGMA journal_mode = WAL')
+            conn.execute('PRAGMA synchronous = NORMAL')
+            for statement in SCHEMA:
+                conn.execute(statement)
+            self.conn = conn
+        return self.conn
+
+    def import_err(self, path):
+        """
+        Add the keys in the .err file at path as failed, unless it was
+        imported before and has not changed since.
+        Returns the number of imported keys.
+        """
+        path = Path(path)
+        stat = path.stat()
+        shard = path.stem
+        with self.lock:
+            conn = self._connect()
+            row = conn.execute(
+                'SELECT mtime_ns, size FROM imports WHERE path = ?',
+                (str(path.resolve()),),
+            ).fetchone()
+            if row == (stat.st_mtime_ns, stat.st_size):
+                return 0
+            keys = set(path.read_text('utf-8').split())
+            now = time.time()
+            with conn:
+                conn.execute('BEGIN IMMEDIATE')
+                # failures of a new download of the shard count again
+                conn.executemany(
+                    'INSERT INTO failures (key, shard, status, updated) '
+                    'VALUES (?, ?, ?, ?) ON CONFLICT (key) DO UPDATE SET '
+                    'status = excluded.status, attempts = 0, error = NULL, '
+                    'updated = excluded.updated',
+                    [(key, shard, FAILED, now) for key in keys],
+                )
+                conn.execute(
+                    'INSERT OR REPLACE INTO imports VALUES (?, ?, ?)',
+                    (str(path.resolve()), stat.st_mtime_ns, stat.st_size),
+                )
+        return len(keys)
+
+    def update(self, keys, status, error=None):
+        """
+        Set the status of keys. Failed keys count another attempt.
+        """
+        attempts = 1 if status == FAILED else 0
+        with self.lock:
+            conn = self._connect()
+            with conn:
+                conn.execute('BEGIN IMMEDIATE')
+                conn.executemany(
+                    'UPDATE failures SET status = ?, '
+                    'attempts = attempts + ?, error = ?, updated = ? '
+                    'WHERE key = ?',
+                    [(status, attempts, error, time.time(), key)
+                     for key in keys],
+                )
+
+    def pending(self, shard, max_attempts=None):
+        """
+        Returns the set of failed keys of the shard,
+        without keys that failed max_attempts times.
+        """
+        query = 'SELECT key FROM failures WHERE shard = ? AND status = ?'
+        args = [shard, FAILED]
+        if max_attempts:
+            query += ' AND attempts < ?'
+            args.append(max_attempts)
+        with self.lock:
+            rows = self._connect().execute(query, args)
+            return {key for key, in rows}
+
+    def shards(self, max_attempts=None):
+        """
+        Returns the sorted shards with pending keys.
+        """
+        query = 'SELECT DISTINCT shard FROM failures WHERE status = ?'
+        args = [FAILED]
+        if max_attempts:
+            query += ' AND attempts < ?'
+            args.append(max_attempts)
+        with self.lock:
+            rows = self._connect().execute(query + ' ORDER BY shard', args)
+            return [shard for shard, in rows]
+
+    def counts(self):
+        """
+        Returns the number of keys by status.
+        """
+        with self.lock:
+            return dict(self._connect().execute(
+                'SELECT status, COUNT(*) FROM failures GROUP BY status'
+            ))
+
+    def close(self):
+        with self.lock:
+            if self.conn is not None:
+                self.conn.close()
+                self.conn = None
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+    )
+    parser.add_argument('ledger', help='Path of the ledger.')
+    args = parser.parse_args()
+    ledger = FailureLedger(args.ledger)
+    counts = ledger.counts()
+    for status in (FAILED, REPAIRED, MISSING):
+        print(f'{status:9} {counts.get(status, 0)}')
+    print(f'{len(ledger.shards())} shards with failed keys')
+    ledger.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,94 @@
+"""
+Sorted fixed-width indexes that map sample keys and photo ids to the
+position of the sample in the metadata shards, i.e., the shard name and the
+row number in the order that load_metadata yields samples.
+Indexes are created by convert_metadata with --index.
+"""
+from pathlib import Path
+
+import numpy as np
+
+
+KEY_INDEX = 'key_index.bin'
+PHOTOID_INDEX = 'photoid_index.bin'
+KEY_DTYPE = np.dtype([('key', 'S32'), ('shard', '<u2'), ('row', '<u4')])
+PHOTOID_DTYPE = np.dtype([('photoid', '<u8'), ('shard', '<u2'), ('row', '<u4')])
+
+
+def open_index(path, dtype):
+    if path.stat().st_size == 0:
+        return np.zeros(0, dtype=dtype)
+    return np.memmap(path, dtype=dtype, mode='r')
+
+
+def bisect_left(column, values):
+    """
+    Vectorized binary search for values in a sorted column.
+    Only the rows of the column that are visited are read,
+    so column can be a (strided) view of a memory-mapped file.
+    """
+    lo = np.zeros(len(values), dtype=np.int64)
+    hi = np.full(len(values), len(column), dtype=np.int64)
+    active = lo < hi
+    while active.any():
+        mid = (lo + hi) // 2
+        less = np.zeros(len(values), dtype=bool)
+        less[active] = column[mid[active]] < values[active]
+        lo = np.where(active & less, mid + 1, lo)
+        hi = np.where(active & ~less, mid, hi)
+        active = lo < hi
+    return lo
+
+
+class MetadataIndex:
+    """
+    Look up the metadata shard and row of samples by key or photo id.
+    Index files are memory-mapped, so opening an index is instant and
+    lookups only read the few pages visited by the binary search.
+    """
+    def __init__(self, indir):
+        indir = Path(indir)
+        self.keys = open_index(indir / KEY_INDEX, KEY_DTYPE)
+        self.photoids = open_index(indir / PHOTOID_INDEX, PHOTOID_DTYPE)
+
+    @staticmethod
+    def _lookup(index, field, values):
+        values = np.asarray(values, dtype=index.dtype[field])
+        column = index[field]
+        pos = bisect_left(column, values)
+        found = pos < len(index)
+        found[found] = column[pos[found]] == values[found]
+        records = index[pos[found]]
+        shards = np.full(len(values), None, dtype=object)
+        rows = np.full(len(values), -1, dtype=np.int64)
+        shards[found] = ['%03x' % s for s in records['shard'].tolist()]
+        rows[found] = records['row']
+        return shards, rows
+
+    def lookup_keys(self, keys):
+        """
+        Returns arrays of shard names and row numbers for the given keys.
+        Shard is None and row is -1 for keys that are not found.
+        """
+        keys = [key.encode('ascii') for key in keys]
+        return self._lookup(self.keys, 'key', keys)
+
+    def lookup_photoids(self, photoids):
+        """
+        Same as lookup_keys for photo ids.
+        """
+        return self._lookup(self.photoids, 'photoid', photoids)
+
+    def lookup_key(self, key):
+        """
+        Returns (shard, row) for the given key, or None if not found.
+        """
+        shards, rows = self.lookup_keys([key])
+        return None if shards[0] is None else (shards[0], int(rows[0]))
+
+    def lookup_photoid(self, photoid):
+        """
+        Returns (shard, row) for the given photo id, or None if not found.
+        """
+        shards, rows = self.lookup_photoids([photoid])
+        return None if shards[0] is None else (shards[0], int(rows[0]))
@@ -0,0 +1,283 @@
+"""
+Download metrics that are aggregated across worker processes.
+
+Counters and a histogram of the time it takes to download each file
+(including retries) are kept in a SharedState. Worker threads record into
+process-local totals, which are added to the shared state about once per
+second and whenever a shard is finished.
+The main process periodically writes them to <outdir>/metrics.prom in the
+Prometheus text format, e.g., for the node_exporter textfile collector,
+and to <outdir>/metrics.json.
+A summary of every shard is appended to <outdir>/shard_metrics.jsonl.
+Requests and connections of the per-process S3 clients are counted when
+shards are finished, their ratio shows how well connections are reused.
+"""
+import os
+import json
+import time
+import bisect
+import threading as th
+
+from transfer import SharedState
+from transfer import NOT_FOUND
+from transfer import THROTTLED
+from transfer import TRANSIENT
+from transfer import FATAL
+from transfer import classify_error
+
+
+METRICS_INTERVAL = 10.0
+SHARD_METRICS = 'shard_metrics.jsonl'
+COUNTERS = (
+    ('files', 'Files downloaded.'),
+    ('bytes', 'Bytes downloaded.'),
+    ('missing', 'Samples that do not exist.'),
+    ('failed', 'Samples that could not be downloaded.'),
+    ('dropped', 'Downloaded images dropped by validation.'),
+    ('duplicates', 'Downloaded files with known content.'),
+    ('errors_' + NOT_FOUND, 'Requests for keys that do not exist.'),
+    ('errors_' + THROTTLED, 'Requests that were throttled.'),
+    ('errors_' + TRANSIENT, 'Requests with network or server errors.'),
+    ('errors_' + FATAL, 'Requests with other errors.'),
+    ('requests', 'HTTP requests sent by S3 clients.'),
+    ('connections', 'HTTP connections opened by S3 clients.'),
+)
+COUNTER_INDEX = {name: i for i, (name, _) in enumerate(COUNTERS)}
+# upper bounds of the latency histogram buckets in seconds,
+# the last bucket is +Inf
+BUCKETS = (
+    0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+    1.0, 2.5, 5.0, 10.0, 30.0, 60.0,
+)
+NUM_VALUES = len(COUNTERS) + len(BUCKETS) + 2
+
+
+def _shard_of(key):
+    return key.rpartition('/')[2][:3]
+
+
+def _percentile(buckets, q):
+    """
+    Estimate the q-quantile from histogram bucket counts
+    by linear interpolation within the bucket.
+    """
+    total = sum(buckets)
+    if not total:
+        return None
+    rank = q * total
+    seen = 0
+    for i, count in enumerate(buckets):
+        if count and seen + count >= rank:
+            if i == len(BUCKETS):
+                return BUCKETS[-1]
+            low = BUCKETS[i - 1] if i else 0.0
+            return low + (BUCKETS[i] - low) * (rank - seen) / count
+        seen += count
+    return BUCKETS[-1]
+
+
+class _Totals:
+    """
+    Counters, histogram buckets and the sum of latencies as one list.
+    """
+    def __init__(self):
+        self.values = [0.0] * NUM_VALUES
+        self.start = time.time()
+
+    def record(self, name, amount=1):
+        self.values[COUNTER_INDEX[name]] += amount
+
+    def observe(self, seconds):
+        offset = len(COUNTERS)
+        self.values[offset + bisect.bisect_left(BUCKETS, seconds)] += 1
+        self.values[-1] += seconds
+
+    def summary(self, values=None):
+        values = self.values if values is None else values
+        counters = {
+            name: int(values[i]) for i, (name, _) in enumerate(COUNTERS)
+        }
+        buckets = values[len(COUNTERS):-1]
+        elapsed = max(time.time() - self.start, 1e-6)
+        return {
+            'seconds': round(elapsed, 3),
+            **counters,
+            'files_per_second': round(counters['files'] / elapsed, 3),
+            'mb_per_second': round(counters['bytes'] / elapsed / 1e6, 3),
+            'latency_mean': round(values[-1] / max(sum(buckets), 1), 6),
+            'latency_p50': _percentile(buckets, 0.5),
+            'latency_p90': _percentile(buckets, 0.9),
+            'latency_p99': _percentile(buckets, 0.99),
+            # connections are reused if this is much larger than 1
+            'requests_per_connection': round(
+                counters['requests'] / counters['connections'], 3
+            ) if counters['connections'] else None,
+        }
+
+
+class DownloadMetrics(SharedState):
+    """
+    Record metrics of downloads in any worker process.
+    See module docstring for details.
+    """
+    def __init__(self, flush_interval=1.0):
+        super().__init__([0.0] * NUM_VALUES)
+        self.start = time.time()
+        self.flush_interval = flush_interval
+        self._init_local()
+
+    def _init_local(self):
+        self.lock = th.Lock()
+        self.pending = _Totals()
+        self.shards = {}
+        self.last_flush = time.monotonic()
+
+    def __getstate__(self):
+        state = super().__getstate__()
+        for name in ('lock', 'pending', 'shards', 'last_flush'):
+            del state[name]
+        return state
+
+    def __setstate__(self, state):
+        super().__setstate__(state)
+        self._init_local()
+
+    def _totals(self, key):
+        shard = _shard_of(key)
+        totals = self.shards.get(shard)
+        if totals is None:
+            totals = self.shards[shard] = _Totals()
+        return totals
+
+    def record(self, key, name, amount=1):
+        """
+        Add amount to the counter name for the shard of key.
+        """
+        with self.lock:
+            self.pending.record(name, amount)
+            self._totals(key).record(name, amount)
+        self.maybe_flush()
+
+    def record_file(self, key, data, seconds, failed=False):
+        """
+        Record the result of downloading one sample, see download_file.
+        """
+        if failed:
+            name = 'failed'
+        elif data is None:
+            name = 'missing'
+        else:
+            name = 'files'
+        with self.lock:
+            for totals in (self.pending, self._totals(key)):
+                totals.record(name)
+                if data is not None:
+                    totals.record('bytes', len(data))
+                totals.observe(seconds)
+        self.maybe_flush()
+
+    def record_error(self, key, error=None, kind=None):
+        """
+        Count a failed request by the class of error, or kind if given.
+        """
+        self.record(key, 'errors_' + (kind or classify_error(error)))
+
+    def maybe_flush(self):
+        if time.monotonic() - self.last_flush >= self.flush_interval:
+            self.flush()
+
+    def flush(self):
+        """
+        Add the totals of this process to the shared state.
+        """
+        with self.lock:
+            values = self.pending.values
+            self.pending = _Totals()
+            self.last_flush = time.monotonic()
+        state = self.state
+        with state.get_lock():
+            for i, value in enumerate(values):
+                if value:
+                    state[i] += value
+
+    def finish_shard(self, shard, outdir, **extra):
+        """
+        Append the summary of the shard to shard_metrics.jsonl in outdir.
+        """
+        with self.lock:
+            totals = self.shards.pop(shard, None) or _Totals()
+        self.flush()
+        summary = {'shard': shard, **extra, **totals.summary()}
+        line = json.dumps(summary) + '\n'
+        # a single small write to a file opened for appending is not
+        # interleaved with lines of other processes
+        with (outdir / SHARD_METRICS).open('at', encoding='utf-8') as fp:
+            fp.write(line)
+        return summary
+
+    def summary(self):
+        """
+        Returns totals of all processes, as far as they were flushed.
+        """
+        totals = _Totals()
+        totals.start = self.start
+        return totals.summary(self.state[:])
+
+    def prometheus(self, prefix='yfcc100m_download'):
+        values = self.state[:]
+        lines = []
+        for i, (name, help_text) in enumerate(COUNTERS):
+            metric = f'{prefix}_{name}_total'
+            lines.append(f'# HELP {metric} {help_text}')
+            lines.append(f'# TYPE {metric} counter')
+            lines.append(f'{metric} {values[i]:.0f}')
+        metric = f'{prefix}_file_seconds'
+        lines.append(f'# HELP {metric} Time to download a file.')
+        lines.append(f'# TYPE {metric} histogram')
+        count = 0
+        offset = len(COUNTERS)
+        for i, bound in enumerate(BUCKETS + ('+Inf',)):
+            count += values[offset + i]
+            lines.append(f'{metric}_bucket{{le="{bound}"}} {count:.0f}')
+        lines.append(f'{metric}_sum {values[-1]}')
+        lines.append(f'{metric}_count {count:.0f}')
+        metric = f'{prefix}_start_time_seconds'
+        lines.append(f'# TYPE {metric} gauge')
+        lines.append(f'{metric} {self.start}')
+        return '\n'.join(lines) + '\n'
+
+    def write(self, outdir):
+        """
+        Write metrics.prom and metrics.json to outdir.
+        Files are replaced atomically, so readers never see partial files.
+        """
+        self.flush()
+        for name, text in (
+                ('metrics.prom', self.prometheus()),
+                ('metrics.json', json.dumps(self.summary(), indent=2)),
+        ):
+            path = outdir / name
+            tmppath = path.with_name(path.name + '.tmp')
+            tmppath.write_text(text, encoding='utf-8')
+            os.replace(tmppath, path)
+
+    def export(self, outdir, interval=METRICS_INTERVAL):
+        """
+        Start a thread that writes metrics to outdir every interval seconds.
+        Returns a function that stops the thread and writes final metrics.
+        """
+        stopped = th.Event()
+
+        def run():
+            while not stopped.wait(interval):
+                self.write(outdir)
+
+        thread = th.Thread(target=run, daemon=True)
+        thread.start()
+
+        def stop():
+            stopped.set()
+            thread.join()
+            self.write(outdir)
+
+        return stop
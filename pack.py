@@ -0,0 +1,231 @@
+"""
+Pack shards, an alternative to ZIP shards that can be read without
+extracting them first.
+
+A pack is a sequence of records, each a header followed by the key
+(UTF-8) and the data of one file, and an index footer:
+
+    record:  magic b'YFR1', <H key length, <Q data length, <I crc32, key, data
+    index:   magic b'YFI1', INDEX_DTYPE entries sorted by key
+    trailer: magic b'YFP1', <I version, <Q number of entries, <Q index offset
+
+Records can be streamed from the start, e.g., from a pipe, with iter_pack.
+PackReader memory-maps the file and finds files through the index, so any
+file is read with a single slice of the map.
+Packs are written by archive.PackWriter.
+"""
+import os
+import mmap
+import zlib
+import struct
+import zipfile
+
+import numpy as np
+
+
+PACK_SUFFIX = '.pack'
+VERSION = 1
+RECORD_MAGIC = b'YFR1'
+INDEX_MAGIC = b'YFI1'
+TRAILER_MAGIC = b'YFP1'
+RECORD = struct.Struct('<4sHQI')
+TRAILER = struct.Struct('<4sIQQ')
+KEY_WIDTH = 64
+INDEX_DTYPE = np.dtype([
+    ('key', f'S{KEY_WIDTH}'),
+    ('offset', '<u8'),
+    ('length', '<u8'),
+    ('crc', '<u4'),
+])
+
+
+class PackError(ValueError):
+    pass
+
+
+def record_header(key, length, crc):
+    key = key.encode('utf-8')
+    if len(key) > KEY_WIDTH:
+        raise PackError(f'key longer than {KEY_WIDTH} bytes: {key!r}')
+    return RECORD.pack(RECORD_MAGIC, len(key), length, crc) + key
+
+
+def make_index(entries):
+    """
+    Returns the index footer for (key, offset, length, crc) entries
+    of records, where offset is the position of the data.
+    """
+    index = np.array(
+        [(key.encode('utf-8'), offset, length, crc)
+         for key, offset, length, crc in entries],
+        dtype=INDEX_DTYPE,
+    )
+    index.sort(order='key')
+    return INDEX_MAGIC + index.tobytes()
+
+
+def make_trailer(count, index_offset):
+    return TRAILER.pack(TRAILER_MAGIC, VERSION, count, index_offset)
+
+
+def _read_header(fp):
+    """
+    Returns (key, length, crc) of the next record in fp, or None at the
+    index or the end of the file. Raises PackError for partial headers.
+    """
+    header = fp.read(RECORD.size)
+    if not header or header[:4] == INDEX_MAGIC:
+        return None
+    if len(header) < RECORD.size:
+        raise PackError('truncated record header')
+    magic, key_length, length, crc = RECORD.unpack(header)
+    if magic != RECORD_MAGIC:
+        raise PackError(f'bad record magic {magic!r}')
+    key = fp.read(key_length)
+    if len(key) < key_length:
+        raise PackError('truncated record key')
+    return key.decode('utf-8'), length, crc
+
+
+def scan_pack(fp, end=None):
+    """
+    Returns (key, offset, length, crc) of all records in fp up to end,
+    reading only their headers.
+    """
+    entries = []
+    while end is None or fp.tell() < end:
+        header = _read_header(fp)
+        if header is None:
+            break
+        key, length, crc = header
+        offset = fp.tell()
+        entries.append((key, offset, length, crc))
+        fp.seek(offset + length)
+    return entries
+
+
+def iter_pack(fp, verify=True):
+    """
+    Yield (key, data) of all records in the file object fp in the order
+    they were written. fp is read sequentially, it need not be seekable.
+    """
+    while True:
+        header = _read_header(fp)
+        if header is None:
+            return
+        key, length, crc = header
+        data = fp.read(length)
+        if len(data) < length:
+            raise PackError(f'truncated data of {key}')
+        if verify and zlib.crc32(data) != crc:
+            raise PackError(f'bad crc32 of {key}')
+        yield key, data
+
+
+class PackReader:
+    """
+    Random access to the files in a pack through a memory map.
+    Files are looked up by key with a binary search in the index,
+    or by position in the index, which is sorted by key.
+    """
+    def __init__(self, path, verify=False):
+        self.path = path
+        self.verify = verify
+        self.fp = open(path, 'rb')
+        size = os.fstat(self.fp.fileno()).st_size
+        if size < TRAILER.size:
+            self.fp.close()
+            raise PackError(f'{path} is not a pack')
+        self.mm = mmap.mmap(self.fp.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, count, index_offset = \
+            TRAILER.unpack_from(self.mm, size - TRAILER.size)
+        if magic != TRAILER_MAGIC or version != VERSION:
+            self.close()
+            raise PackError(f'{path} is not a pack')
+        self.index = np.frombuffer(
+            self.mm, INDEX_DTYPE, count, index_offset + len(INDEX_MAGIC)
+        )
+
+    def __len__(self):
+        return len(self.index)
+
+    def keys(self):
+        return [key.decode('utf-8') for key in self.index['key']]
+
+    def find(self, key):
+        """
+        Returns the position of key in the index, or -1.
+        """
+        key = key.encode('utf-8')
+        column = self.index['key']
+        i = int(np.searchsorted(column, key))
+        if i < len(column) and column[i] == key:
+            return i
+        return -1
+
+    def __contains__(self, key):
+        return self.find(key) >= 0
+
+    def read(self, i):
+        """
+        Returns the data of the i-th file in the index.
+        """
+        entry = self.index[i]
+        offset = int(entry['offset'])
+        data = self.mm[offset:offset + int(entry['length'])]
+        if self.verify and zlib.crc32(data) != entry['crc']:
+            raise PackError(f'bad crc32 of {self.index["key"][i]!r}')
+        return data
+
+    def __getitem__(self, key):
+        i = self.find(key)
+        if i < 0:
+            raise KeyError(key)
+        return self.read(i)
+
+    def get(self, key, default=None):
+        i = self.find(key)
+        return default if i < 0 else self.read(i)
+
+    def __iter__(self):
+        """
+        Yield (key, data) of all files, sorted by key.
+        """
+        for i, key in enumerate(self.keys()):
+            yield key, self.read(i)
+
+    def close(self):
+        # the index is a view of the map
+        self.index = None
+        self.mm.close()
+        self.fp.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+def iter_shard(path):
+    """
+    Yield (key, data) of all files in a ZIP or pack shard.
+    """
+    if str(path).endswith(PACK_SUFFIX):
+        with PackReader(path) as reader:
+            yield from reader
+        return
+    with zipfile.ZipFile(path, 'r') as z:
+        for file in z.infolist():
+            yield file.filename, z.open(file).read()
+
+
+def read_keys(path):
+    """
+    Returns the set of keys in a ZIP or pack shard.
+    """
+    if str(path).endswith(PACK_SUFFIX):
+        with PackReader(path) as reader:
+            return set(reader.keys())
+    with zipfile.ZipFile(path, 'r') as z:
+        return set(z.namelist())
@@ -5,7 +5,7 @@ import os
 import sys
 import threading
 import time
-from download_repair_error import hex_range
+from tools import hex_range
 import numpy as np
 import timm
 
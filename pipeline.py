@@ -1,7 +1,7 @@
 import json
 import os
 
-from download_repair_error import hex_range
+from tools import hex_range
 
 pre_start = '52'
 pre_end = '5f'
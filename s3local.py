@@ -0,0 +1,352 @@
+"""
+Minimal S3-compatible HTTP server that serves files from a local directory.
+Useful to test and benchmark the download tools without AWS.
+
+Objects are stored as <root>/<bucket>/<key> and requested path-style, e.g.:
+    python s3local.py /tmp/s3 --port 9000
+    python -m yfcc100m.convert_metadata --endpoint-url http://127.0.0.1:9000 ...
+
+Supports GET (including Range requests), HEAD and ListObjectsV2.
+Optionally, every request is delayed by a fixed latency, the total
+bandwidth of all responses is limited, and a fraction of requests fail
+with 500 InternalError or 503 SlowDown.
+Authentication is ignored, but boto3 still needs (any) credentials.
+"""
+import os
+import sys
+import time
+import random
+import argparse
+import threading as th
+from pathlib import Path
+from email.utils import formatdate
+from xml.sax.saxutils import escape
+from urllib.parse import parse_qs
+from urllib.parse import quote
+from urllib.parse import unquote
+from urllib.parse import urlsplit
+from http.server import ThreadingHTTPServer
+from http.server import BaseHTTPRequestHandler
+
+
+ERROR_TEMPLATE = (
+    '<?xml version="1.0" encoding="UTF-8"?>\n'
+    '<Error><Code>{code}</Code><Message>{message}</Message></Error>'
+)
+LIST_TEMPLATE = (
+    '<?xml version="1.0" encoding="UTF-8"?>\n'
+    '<ListBucketResult xmlns="http://s3.amazonaws.com/doc/2006-03-01/">'
+    '<Name>{bucket}</Name><Prefix>{prefix}</Prefix>'
+    '<KeyCount>{count}</KeyCount><MaxKeys>{max_keys}</MaxKeys>'
+    '{encoding}<IsTruncated>{truncated}</IsTruncated>{token}{contents}'
+    '</ListBucketResult>'
+)
+CONTENTS_TEMPLATE = (
+    '<Contents><Key>{key}</Key><LastModified>{modified}</LastModified>'
+    '<ETag>&quot;{etag}&quot;</ETag><Size>{size}</Size>'
+    '<StorageClass>STANDARD</StorageClass></Contents>'
+)
+
+
+class Bandwidth:
+    """
+    Token bucket shared by all connections that limits bytes per second.
+    """
+    def __init__(self, rate, burst=0.1):
+        self.rate = rate
+        self.capacity = rate * burst
+        self.tokens = self.capacity
+        self.last = time.monotonic()
+        self.lock = th.Lock()
+
+    def consume(self, num_bytes):
+        with self.lock:
+            now = time.monotonic()
+            tokens = self.tokens + (now - self.last) * self.rate
+            self.tokens = min(tokens, self.capacity) - num_bytes
+            self.last = now
+            delay = -self.tokens / self.rate
+        if delay > 0:
+            time.sleep(delay)
+
+
+def list_keys(root, bucket, prefix):
+    """
+    Returns the sorted keys in bucket that start with prefix.
+    Only the directory that contains the prefix is walked.
+    """
+    bucketdir = root / bucket
+    base = bucketdir / prefix.rpartition('/')[0]
+    resolved = base.resolve()
+    if resolved != bucketdir.resolve() \
+            and bucketdir.resolve() not in resolved.parents:
+        return []
+    keys = []
+    for dirpath, _, filenames in os.walk(base):
+        rel = Path(dirpath).relative_to(bucketdir).as_posix()
+        for name in filenames:
+            key = name if rel == '.' else f'{rel}/{name}'
+            if key.startswith(prefix):
+                keys.append(key)
+    return sorted(keys)
+
+
+class S3Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_error_xml(self, status, code, message, head=False):
+        body = ERROR_TEMPLATE.format(code=code, message=message).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/xml')
+        self.send_header('Content-Length', str(0 if head else len(body)))
+        self.end_headers()
+        if not head:
+            self.wfile.write(body)
+
+    def object_path(self):
+        path = unquote(urlsplit(self.path).path).lstrip('/')
+        bucket, _, key = path.partition('/')
+        root = self.server.root
+        objpath = (root / bucket / key).resolve()
+        if not key or root.resolve() not in objpath.parents:
+            return None
+        return objpath
+
+    def parse_range(self, size):
+        header = self.headers.get('Range')
+        if not header or not header.startswith('bytes='):
+            return None
+        start, _, end = header[6:].partition('-')
+        if not start:
+            start, end = max(0, size - int(end)), size - 1
+        else:
+            start, end = int(start), int(end) if end else size - 1
+        return start, min(end, size - 1)
+
+    def send_object(self, head=False):
+        path = self.object_path()
+        if path is None or not path.is_file():
+            self.send_error_xml(
+                404, 'NoSuchKey', 'The specified key does not exist.', head
+            )
+            return
+        stat = path.stat()
+        size = stat.st_size
+        byterange = self.parse_range(size)
+        if byterange is not None and byterange[0] >= size:
+            self.send_error_xml(
+                416, 'InvalidRange', 'The requested range is not satisfiable',
+                head,
+            )
+            return
+        start, end = byterange or (0, size - 1)
+        self.send_response(200 if byterange is None else 206)
+        self.send_header('Content-Type', 'application/octet-stream')
+        self.send_header('Content-Length', str(end - start + 1))
+        self.send_header('Accept-Ranges', 'bytes')
+        self.send_header('ETag', f'"{stat.st_mtime_ns:x}-{size:x}"')
+        self.send_header(
+            'Last-Modified', formatdate(stat.st_mtime, usegmt=True)
+        )
+        if byterange is not None:
+            self.send_header('Content-Range', f'bytes {start}-{end}/{size}')
+        self.end_headers()
+        if head:
+            return
+        bandwidth = self.server.bandwidth
+        chunk_size = 64*1024 if bandwidth else 1024*1024
+        with path.open('rb') as fp:
+            fp.seek(start)
+            remaining = end - start + 1
+            while remaining > 0:
+                chunk = fp.read(min(remaining, chunk_size))
+                if not chunk:
+                    break
+                if bandwidth:
+                    bandwidth.consume(len(chunk))
+                self.wfile.write(chunk)
+                remaining -= len(chunk)
+
+    def inject_error(self, head=False):
+        """
+        Returns True if an error was sent instead of a response.
+        """
+        server = self.server
+        if not server.error_rate and not server.throttle_rate:
+            return False
+        r = server.random.random()
+        if r < server.throttle_rate:
+            self.send_error_xml(
+                503, 'SlowDown', 'Please reduce your request rate.', head
+            )
+            return True
+        if r < server.throttle_rate + server.error_rate:
+            self.send_error_xml(
+                500, 'InternalError', 'We encountered an internal error.', head
+            )
+            return True
+        return False
+
+    def do_HEAD(self):
+        time.sleep(self.server.latency)
+        if self.inject_error(head=True):
+            return
+        self.send_object(head=True)
+
+    def send_list(self, bucket, query):
+        root = self.server.root
+        if not (root / bucket).is_dir():
+            self.send_error_xml(
+                404, 'NoSuchBucket', 'The specified bucket does not exist.'
+            )
+            return
+        prefix = query.get('prefix', [''])[0]
+        max_keys = min(int(query.get('max-keys', ['1000'])[0]), 1000)
+        start = query.get(
+            'continuation-token', query.get('start-after', [''])
+        )[0]
+        url_encoded = query.get('encoding-type', [''])[0] == 'url'
+        keys = [k for k in list_keys(root, bucket, prefix) if k > start]
+        page = keys[:max_keys]
+        contents = []
+        for key in page:
+            stat = (root / bucket / key).stat()
+            contents.append(CONTENTS_TEMPLATE.format(
+                key=quote(key) if url_encoded else escape(key),
+                modified=time.strftime(
+                    '%Y-%m-%dT%H:%M:%S.000Z', time.gmtime(stat.st_mtime)
+                ),
+                etag=f'{stat.st_mtime_ns:x}-{stat.st_size:x}',
+                size=stat.st_size,
+            ))
+        truncated = len(keys) > max_keys
+        token = ''
+        if truncated:
+            token = f'<NextContinuationToken>{escape(page[-1])}' \
+                    f'</NextContinuationToken>'
+        body = LIST_TEMPLATE.format(
+            bucket=escape(bucket),
+            prefix=quote(prefix) if url_encoded else escape(prefix),
+            count=len(page),
+            max_keys=max_keys,
+            encoding='<EncodingType>url</EncodingType>' if url_encoded else '',
+            truncated='true' if truncated else 'false',
+            token=token,
+            contents=''.join(contents),
+        ).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/xml')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        time.sleep(self.server.latency)
+        if self.inject_error():
+            return
+        url = urlsplit(self.path)
+        query = parse_qs(url.query)
+        bucket, _, key = unquote(url.path).lstrip('/').partition('/')
+        if not key and query.get('list-type') == ['2']:
+            self.send_list(bucket, query)
+            return
+        self.send_object()
+
+
+class S3Server(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(
+            self,
+            root,
+            address=('127.0.0.1', 0),
+            latency=0,
+            bandwidth=0,
+            error_rate=0,
+            throttle_rate=0,
+            seed=None,
+    ):
+        super().__init__(address, S3Handler)
+        self.root = Path(root)
+        self.latency = latency
+        self.bandwidth = Bandwidth(bandwidth) if bandwidth else None
+        self.error_rate = error_rate
+        self.throttle_rate = throttle_rate
+        self.random = random.Random(seed)
+
+    def handle_error(self, request, client_address):
+        # clients that exit with open connections are not an error
+        if not isinstance(sys.exc_info()[1], ConnectionError):
+            super().handle_error(request, client_address)
+
+    @property
+    def endpoint_url(self):
+        host, port = self.server_address[:2]
+        return f'http://{host}:{port}'
+
+
+def start_server(root, host='127.0.0.1', port=0, latency=0, **kwargs):
+    """
+    Start a server in a background thread.
+    kwargs are passed on to S3Server, e.g., bandwidth in bytes/s.
+    Returns the server, use server.endpoint_url to connect
+    and server.shutdown() to stop it.
+    """
+    server = S3Server(root, (host, port), latency, **kwargs)
+    th.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+    )
+    parser.add_argument('root', help='Directory that contains the buckets.')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', default=9000, type=int)
+    parser.add_argument(
+        '--latency',
+        default=0,
+        type=float,
+        help='Delay every request by this many milliseconds.',
+    )
+    parser.add_argument(
+        '--bandwidth',
+        default=0,
+        type=float,
+        help='Limit all responses together to this many MB/s.',
+    )
+    parser.add_argument(
+        '--error-rate',
+        default=0,
+        type=float,
+        help='Fraction of requests that fail with 500 InternalError.',
+    )
+    parser.add_argument(
+        '--throttle-rate',
+        default=0,
+        type=float,
+        help='Fraction of requests that fail with 503 SlowDown.',
+    )
+    args = parser.parse_args()
+    server = S3Server(
+        args.root,
+        (args.host, args.port),
+        args.latency / 1000,
+        args.bandwidth * 1000 * 1000,
+        args.error_rate,
+        args.throttle_rate,
+    )
+    print(f'serving {args.root} at {server.endpoint_url}')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
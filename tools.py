@@ -1,6 +1,9 @@
-import gzip
+import re
 import json
+import zlib
 import itertools as it
+from hashlib import md5
+from pathlib import Path
 from string import hexdigits
 from queue import Empty
 from operator import itemgetter
@@ -8,9 +11,15 @@ from contextlib import contextmanager
 import multiprocessing as mp
 from multiprocessing.queues import Queue
 
+import numpy as np
 from tqdm import tqdm
 from datadings.tools.cached_property import cached_property
 
+try:
+    from orjson import loads as json_loads
+except ImportError:
+    json_loads = json.loads
+
 
 class Sentinel:
     pass
@@ -39,7 +48,15 @@ class IterableQueue(Queue):
         self.put(Sentinel())
 
 
+DEFAULT_FILTER = 'lambda x: True'
+# sizes and rates on the command line are in decimal MB
+MB = 1000 * 1000
+
+
 class WorkerBase:
+    # metadata columns required by this stage, None means all
+    columns = None
+
     def __init__(
             self,
             shards,
@@ -65,6 +82,12 @@ class WorkerBase:
     def filter_fun(self):
         return eval(self.filter_code)
 
+    @cached_property
+    def sample_filter(self):
+        if is_filter_expression(self.filter_code):
+            return SampleFilter(self.filter_code)
+        return None
+
     @contextmanager
     def positioned(self):
         with mp.Manager() as manager:
@@ -87,7 +110,17 @@ class WorkerBase:
 
     def prepare_metadata(self, shard):
         # load metadata and sort by key
-        metadata = load_metadata(self.metadir, shard)
+        if self.sample_filter is not None:
+            metadata = self.sample_filter.select(
+                self.metadir, shard, self.columns
+            )
+            metadata = filter(lambda s: s['marker'] in self.kinds, metadata)
+            return sorted(metadata, key=itemgetter('key'))
+        columns = self.columns
+        if self.filter_code != DEFAULT_FILTER:
+            # arbitrary filters may look at any column
+            columns = None
+        metadata = load_metadata(self.metadir, shard, columns)
         metadata = filter(lambda s: s['marker'] in self.kinds, metadata)
         metadata = filter(self.filter_fun, metadata)
         return sorted(metadata, key=itemgetter('key'))
@@ -104,21 +137,486 @@ class WorkerBase:
             leave=position == 0,
         )
 
-    def pool(self):
+    def pool(self, initializer=None, initargs=(), maxtasksperchild=1):
         write_lock = mp.Lock()
         tqdm.set_lock(write_lock)
         return mp.Pool(
             self.processes,
-            initializer=tqdm.set_lock,
-            initargs=(write_lock,),
-            maxtasksperchild=1,
+            initializer=_init_worker,
+            initargs=(write_lock, initializer, initargs),
+            maxtasksperchild=maxtasksperchild,
+        )
+
+
+def _init_worker(write_lock, initializer, initargs):
+    tqdm.set_lock(write_lock)
+    if initializer is not None:
+        initializer(*initargs)
+
+
+def iter_gzip_lines(path, block_size=4*1024*1024):
+    """
+    Yield lists of lines (bytes without newline) from a gzip file.
+    The file is read and decompressed in large blocks,
+    lines are split without decoding them.
+    Files with multiple gzip members are supported.
+    Like gzip.open, EOFError is raised if the last member is truncated.
+    """
+    decompressor = zlib.decompressobj(31)
+    # whether the current member received any input
+    in_member = False
+    rest = b''
+    with open(path, 'rb') as fp:
+        while True:
+            block = fp.read(block_size)
+            if not block:
+                break
+            data = [rest]
+            while block:
+                data.append(decompressor.decompress(block))
+                in_member = True
+                if decompressor.eof:
+                    # start of the next gzip member
+                    block = decompressor.unused_data
+                    decompressor = zlib.decompressobj(31)
+                    in_member = False
+                else:
+                    block = b''
+            lines = b''.join(data).split(b'\n')
+            rest = lines.pop()
+            yield lines
+    if in_member and not decompressor.eof:
+        raise EOFError(
+            'Compressed file ended before the end-of-stream marker was reached'
+        )
+    if rest:
+        yield [rest]
+
+
+def iter_jsonl_batches(path, batch_size=10000):
+    """
+    Yield lists of up to batch_size samples from a gzipped JSON lines file.
+    Uses orjson if it is installed.
+    """
+    batch = []
+    for lines in iter_gzip_lines(path):
+        batch.extend(json_loads(line) for line in lines if line)
+        while len(batch) >= batch_size:
+            yield batch[:batch_size]
+            batch = batch[batch_size:]
+    if batch:
+        yield batch
+
+
+def load_jsonl(path):
+    for batch in iter_jsonl_batches(path):
+        yield from batch
+
+
+def _encode_column(name, values):
+    arrays = {}
+    types = {type(v) for v in values if v is not None}
+    if not (types <= {int} or types == {float} or types == {str}):
+        # mixed types, fall back to JSON strings
+        arrays[name + '.json'] = np.ones(1, dtype=bool)
+        values = [json.dumps(v) for v in values]
+        types = {str}
+    nulls = np.array([v is None for v in values], dtype=bool)
+    if nulls.any():
+        arrays[name + '.null'] = nulls
+    if types <= {int}:
+        arrays[name] = np.array([v or 0 for v in values], dtype=np.int64)
+    elif types == {float}:
+        arrays[name] = np.array([v or 0 for v in values], dtype=np.float64)
+    else:
+        values = [v or '' for v in values]
+        if all(v.isascii() for v in values) \
+                and max(map(len, values), default=0) <= 64:
+            # short ASCII strings like keys are stored as fixed-width bytes
+            arrays[name] = np.array(values, dtype=np.bytes_)
+        else:
+            encoded = [v.encode('utf-8') for v in values]
+            arrays[name + '.heap'] = np.frombuffer(b''.join(encoded), np.uint8)
+            arrays[name + '.offsets'] = np.cumsum(
+                [0] + [len(v) for v in encoded], dtype=np.int64
+            )
+    return arrays
+
+
+def save_columns(path, rows):
+    """
+    Store rows (dicts with identical keys) column-wise in a ``.npz`` file.
+    Strings are stored as fixed-width bytes if short and ASCII,
+    otherwise as one UTF-8 heap plus offsets per column.
+    """
+    names = list(rows[0]) if rows else []
+    arrays = {'__columns__': np.array(names, dtype=np.str_)}
+    for name in names:
+        arrays.update(_encode_column(name, [row[name] for row in rows]))
+    np.savez(path, **arrays)
+
+
+def _decode_column(data, name):
+    if name + '.heap' in data:
+        heap = data[name + '.heap'].tobytes()
+        offsets = data[name + '.offsets'].tolist()
+        values = np.array([
+            heap[a:b].decode('utf-8') for a, b in zip(offsets, offsets[1:])
+        ], dtype=object)
+    else:
+        values = data[name]
+        if values.dtype.kind == 'S':
+            values = values.astype(np.str_)
+    if name + '.json' in data:
+        values = np.array([json.loads(v) for v in values], dtype=object)
+    if name + '.null' in data:
+        values = values.astype(object)
+        values[data[name + '.null']] = None
+    return values
+
+
+def load_columns(indir, shard, columns=None):
+    """
+    Load the given columns (all by default) of a columnar metadata shard.
+    Returns a dict of numpy arrays.
+    Only the requested columns are read from the file.
+    If there is no columnar shard, the gzipped JSON lines file is read.
+    """
+    indir = Path(indir)
+    if not (indir / (shard + '.npz')).exists():
+        samples = list(load_metadata(indir, shard, columns))
+        names = list(samples[0]) if samples else columns or []
+        return {
+            name: np.array([sample[name] for sample in samples], dtype=object)
+            for name in names
+        }
+    with np.load(indir / (shard + '.npz')) as data:
+        names = data['__columns__'].tolist()
+        if columns is not None:
+            names = [name for name in names if name in columns]
+        return {name: _decode_column(data, name) for name in names}
+
+
+def load_metadata(indir, shard, columns=None):
+    """
+    Yield metadata samples of the given shard as dicts.
+    Samples are read from the columnar ``.npz`` shard if it exists,
+    otherwise from the gzipped JSON lines file.
+    If columns are given, samples contain only those columns.
+    """
+    indir = Path(indir)
+    if (indir / (shard + '.npz')).exists():
+        data = load_columns(indir, shard, columns)
+        names = list(data)
+        yield from (
+            dict(zip(names, values))
+            for values in zip(*(data[name].tolist() for name in names))
+        )
+        return
+    samples = load_jsonl(indir / (shard + '.gz'))
+    if columns is None:
+        yield from samples
+    else:
+        for sample in samples:
+            yield {k: v for k, v in sample.items() if k in columns}
+
+
+FILTER_TOKEN = re.compile(r"""\s*(?:
+    (?P<number>-?\d+(?:\.\d+)?(?:[eE][-+]?\d+)?)
+    |(?P<string>'[^']*'|"[^"]*")
+    |(?P<op>==|!=|<=|>=|<|>|\.\.|[(),\[\]])
+    |(?P<name>[A-Za-z_]\w*)
+)""", re.VERBOSE)
+FILTER_COMPARISONS = {
+    '==': np.equal,
+    '!=': np.not_equal,
+    '<': np.less,
+    '<=': np.less_equal,
+    '>': np.greater,
+    '>=': np.greater_equal,
+}
+
+
+def is_filter_expression(code):
+    return not code.lstrip().startswith('lambda')
+
+
+def tokenize_filter(expression):
+    tokens = []
+    pos = 0
+    expression = expression.rstrip()
+    while pos < len(expression):
+        match = FILTER_TOKEN.match(expression, pos)
+        if match is None:
+            raise ValueError(f'invalid filter at: {expression[pos:]!r}')
+        kind = match.lastgroup
+        value = match.group(kind)
+        if kind == 'number':
+            value = float(value) if set('.eE') & set(value) else int(value)
+        elif kind == 'string':
+            value = value[1:-1]
+        tokens.append((kind, value))
+        pos = match.end()
+    return tokens
+
+
+class FilterParser:
+    """
+    Parse filter expressions like::
+
+        marker == 0 and accuracy >= 12
+        latitude in 40..41.5 and not usertags has beach
+        geo(40.5, -74.3, 41.0, -73.7) or ext in [png, gif]
+
+    into nested tuples. Values are numbers, quoted strings or bare words.
+    """
+    def __init__(self, expression):
+        self.tokens = tokenize_filter(expression)
+        self.pos = 0
+
+    def peek(self):
+        if self.pos < len(self.tokens):
+            return self.tokens[self.pos]
+        return None, None
+
+    def next(self):
+        token = self.peek()
+        if token[0] is None:
+            raise ValueError('unexpected end of filter')
+        self.pos += 1
+        return token
+
+    def accept(self, value):
+        if self.peek()[1] == value and self.peek()[0] != 'string':
+            self.pos += 1
+            return True
+        return False
+
+    def expect(self, value):
+        if not self.accept(value):
+            raise ValueError(f'expected {value!r}, got {self.peek()[1]!r}')
+
+    def parse(self):
+        node = self.parse_or()
+        if self.pos != len(self.tokens):
+            raise ValueError(f'unexpected {self.peek()[1]!r} in filter')
+        return node
+
+    def parse_or(self):
+        node = self.parse_and()
+        while self.accept('or'):
+            node = ('or', node, self.parse_and())
+        return node
+
+    def parse_and(self):
+        node = self.parse_not()
+        while self.accept('and'):
+            node = ('and', node, self.parse_not())
+        return node
+
+    def parse_not(self):
+        if self.accept('not'):
+            return 'not', self.parse_not()
+        if self.accept('('):
+            node = self.parse_or()
+            self.expect(')')
+            return node
+        return self.parse_predicate()
+
+    def parse_value(self):
+        kind, value = self.next()
+        if kind not in ('number', 'string', 'name'):
+            raise ValueError(f'expected value, got {value!r}')
+        return value
+
+    def parse_number(self):
+        kind, value = self.next()
+        if kind != 'number':
+            raise ValueError(f'expected number, got {value!r}')
+        return value
+
+    def parse_predicate(self):
+        kind, field = self.next()
+        if kind != 'name':
+            raise ValueError(f'expected column name, got {field!r}')
+        if field == 'geo' and self.accept('('):
+            box = [self.parse_number()]
+            for _ in range(3):
+                self.expect(',')
+                box.append(self.parse_number())
+            self.expect(')')
+            return ('geo', *box)
+        if self.accept('has'):
+            return 'has', field, str(self.parse_value())
+        if self.accept('in'):
+            if self.accept('['):
+                values = [self.parse_value()]
+                while self.accept(','):
+                    values.append(self.parse_value())
+                self.expect(']')
+                return 'isin', field, tuple(values)
+            low = self.parse_value()
+            self.expect('..')
+            return 'range', field, low, self.parse_value()
+        kind, op = self.next()
+        if op not in FILTER_COMPARISONS or kind != 'op':
+            raise ValueError(f'expected comparison, got {op!r}')
+        value = self.parse_value()
+        if not _is_number(value) and op not in ('==', '!='):
+            raise ValueError(f'cannot compare strings with {op}')
+        return 'cmp', field, op, value
+
+
+def _filter_fields(node):
+    if node[0] in ('and', 'or'):
+        return _filter_fields(node[1]) | _filter_fields(node[2])
+    if node[0] == 'not':
+        return _filter_fields(node[1])
+    if node[0] == 'geo':
+        return {'latitude', 'longitude'}
+    return {node[1]}
+
+
+def _as_float(values):
+    try:
+        return np.asarray(values, dtype=np.float64)
+    except (TypeError, ValueError):
+        return np.array(
+            [np.nan if v is None or v == '' else float(v) for v in values],
+            dtype=np.float64,
         )
 
 
-def load_metadata(indir, shard):
-    with gzip.open(indir / (shard + '.gz'), 'rt', encoding='utf-8') as fp:
-        for line in fp:
-            yield json.loads(line)
+def _as_str(values):
+    return np.array(['' if v is None else str(v) for v in values], dtype=str)
+
+
+def _is_number(value):
+    return isinstance(value, (int, float))
+
+
+def _evaluate_filter(node, data):
+    kind = node[0]
+    if kind == 'and':
+        return _evaluate_filter(node[1], data) & _evaluate_filter(node[2], data)
+    if kind == 'or':
+        return _evaluate_filter(node[1], data) | _evaluate_filter(node[2], data)
+    if kind == 'not':
+        return ~_evaluate_filter(node[1], data)
+    if kind == 'geo':
+        lat = _as_float(data['latitude'])
+        lon = _as_float(data['longitude'])
+        lat_min, lon_min, lat_max, lon_max = node[1:]
+        return (lat >= lat_min) & (lat <= lat_max) \
+            & (lon >= lon_min) & (lon <= lon_max)
+    column = data[node[1]]
+    if kind == 'has':
+        tags = np.char.add(np.char.add(',', _as_str(column)), ',')
+        return np.char.find(tags, f',{node[2]},') >= 0
+    if kind == 'isin':
+        if all(map(_is_number, node[2])):
+            return np.isin(_as_float(column), node[2])
+        return np.isin(_as_str(column), [str(v) for v in node[2]])
+    if kind == 'range':
+        values = _as_float(column)
+        return (values >= node[2]) & (values <= node[3])
+    _, _, op, value = node
+    if _is_number(value):
+        return FILTER_COMPARISONS[op](_as_float(column), value)
+    return FILTER_COMPARISONS[op](_as_str(column), str(value))
+
+
+class SampleFilter:
+    """
+    Declarative sample filter that is evaluated on whole columns of a
+    metadata shard, see FilterParser for the syntax.
+    Selected rows are cached per shard and filter in
+    <metadir>/filter_cache, so subsequent runs with the same filter
+    only load the columns the stage needs, see select.
+    """
+    def __init__(self, expression):
+        self.tree = FilterParser(expression).parse()
+        self.fields = _filter_fields(self.tree)
+        self.hash = md5(repr(self.tree).encode('utf-8')).hexdigest()[:16]
+
+    def __call__(self, data):
+        return _evaluate_filter(self.tree, data)
+
+    def cache_path(self, indir, shard, columns=None):
+        # include the state of the shard file to notice changes
+        path = indir / (shard + '.npz')
+        suffix = '.npy'
+        key = f'{self.hash}'
+        if not path.exists():
+            path = indir / (shard + '.gz')
+            # selected rows of JSON shards are cached with their columns
+            suffix = '.npz'
+            key += ':' + (','.join(sorted(columns)) if columns else '*')
+        stat = path.stat()
+        h = md5(f'{key}:{stat.st_size}:{stat.st_mtime_ns}'.encode())
+        return indir / 'filter_cache' / f'{shard}-{h.hexdigest()[:16]}{suffix}'
+
+    def select(self, indir, shard, columns=None):
+        """
+        Yield samples of a shard that pass the filter.
+        If columns are given, samples contain only those columns.
+        For columnar shards the indices of selected rows are cached,
+        so later runs only load the columns they need.
+        Gzipped JSON shards are cached as columnar files with the selected
+        rows and given columns, so later runs skip parsing them entirely.
+        """
+        indir = Path(indir)
+        path = self.cache_path(indir, shard, columns)
+        rows_cached = path.suffix == '.npz'
+        if path.exists():
+            if rows_cached:
+                data = load_columns(path.parent, path.stem)
+                indices = slice(None)
+            else:
+                indices = np.load(path)
+                data = load_columns(indir, shard, columns)
+        else:
+            data = load_columns(
+                indir, shard, None if columns is None
+                else set(columns) | self.fields
+            )
+            indices = np.flatnonzero(self(data)).astype(np.int64)
+            path.parent.mkdir(exist_ok=True)
+            if not rows_cached:
+                tmp = path.with_name(path.stem + '.tmp.npy')
+                np.save(tmp, indices)
+                tmp.replace(path)
+        names = [n for n in data if columns is None or n in columns]
+        rows = (
+            dict(zip(names, values))
+            for values in zip(*(data[name][indices].tolist() for name in names))
+        )
+        if rows_cached and not path.exists():
+            rows = list(rows)
+            tmp = path.with_name(path.stem + '.tmp.npz')
+            save_columns(tmp, rows)
+            tmp.replace(path)
+        yield from rows
+
+
+def validate_filter(code):
+    if is_filter_expression(code):
+        SampleFilter(code)
+    else:
+        eval(code)
+
+
+def iter_metadata_batches(indir, shard, batch_size=10000, columns=None):
+    """
+    Same as load_metadata, but yields lists of up to batch_size samples.
+    """
+    indir = Path(indir)
+    if columns is None and not (indir / (shard + '.npz')).exists():
+        yield from iter_jsonl_batches(indir / (shard + '.gz'), batch_size)
+        return
+    metadata = load_metadata(indir, shard, columns)
+    for batch in iter(lambda: list(it.islice(metadata, batch_size)), []):
+        yield batch
 
 
 def load_finished_shards(outdir):
@@ -157,10 +655,28 @@ def make_shard_names():
     return {''.join(c) for c in it.product(digits, digits, digits)}
 
 
+def hex_range(start, end):
+    # 将开始和结束的十六进制字符串转换为整数
+    start_int = int(start, 16)
+    end_int = int(end, 16)
+
+    # 生成从开始到结束的所有整数
+    num_list = range(start_int, end_int + 1)
+
+    # 将这些整数转换为十六进制字符串，并将它们放入一个列表中
+    hex_list = [hex(num)[2:].zfill(3) for num in num_list]
+
+    return hex_list
+
+
 def make_meta_shard_names():
     return {name+'.gz' for name in make_shard_names()}
 
 
+def make_columnar_shard_names():
+    return {name+'.npz' for name in make_shard_names()}
+
+
 def make_output_shard_names():
     return {name+'.zip' for name in make_shard_names()}
 
@@ -0,0 +1,742 @@
+"""
+Fetch samples from S3 with one plain GET request per possible key.
+
+Which of the possible keys of a sample exists is stored in a persistent
+cache per shard, so later runs (e.g., --check or repairs) request the
+right key directly and never request keys that do not exist again.
+
+Failed requests are classified and retried by a RetryPolicy.
+A CircuitBreaker that is shared by all worker processes pauses downloads
+while the endpoint is unavailable.
+
+Manifests list all objects of a shard with ListObjectsV2, so existing
+files can be found without a request per key.
+
+Large objects can be downloaded in parts with concurrent ranged GETs,
+see RangedObject.
+
+Each process uses a single S3 client, whose HTTP connections are shared
+by all threads, see S3Connections.
+"""
+import os
+import gzip
+import time
+import uuid
+import random
+import threading as th
+import multiprocessing as mp
+from pathlib import Path
+from collections import deque
+
+import boto3
+import urllib3.exceptions
+from botocore.config import Config
+from botocore.exceptions import ClientError
+from botocore.exceptions import ConnectionError as BotoConnectionError
+from botocore.exceptions import CredentialRetrievalError
+from botocore.exceptions import HTTPClientError
+from botocore.exceptions import IncompleteReadError
+from botocore.exceptions import NoCredentialsError
+from botocore.exceptions import PartialCredentialsError
+from botocore.exceptions import ResponseStreamingError
+from tqdm import tqdm
+
+from tools import DATAKEYS
+from tools import PREFIX
+from tools import get_possible_keys
+
+
+NOT_FOUND = 'not_found'
+THROTTLED = 'throttled'
+TRANSIENT = 'transient'
+FATAL = 'fatal'
+
+NOT_FOUND_CODES = {'404', 'NoSuchKey', 'NotFound'}
+THROTTLE_CODES = {
+    'SlowDown',
+    'Throttling',
+    'ThrottlingException',
+    'RequestLimitExceeded',
+    'TooManyRequests',
+    '429',
+    '503',
+}
+TRANSIENT_CODES = {
+    'InternalError',
+    'ServiceUnavailable',
+    'RequestTimeout',
+    'GatewayTimeout',
+    'BadGateway',
+    '500',
+    '502',
+    '504',
+}
+CREDENTIAL_CODES = {
+    'InvalidAccessKeyId',
+    'SignatureDoesNotMatch',
+    'ExpiredToken',
+    'InvalidToken',
+}
+TRANSIENT_ERRORS = (
+    BotoConnectionError,
+    HTTPClientError,
+    IncompleteReadError,
+    ResponseStreamingError,
+    urllib3.exceptions.HTTPError,
+    ConnectionError,
+    TimeoutError,
+)
+CREDENTIAL_ERRORS = (
+    NoCredentialsError,
+    PartialCredentialsError,
+    CredentialRetrievalError,
+)
+
+
+def error_code(error):
+    if isinstance(error, ClientError):
+        return error.response.get('Error', {}).get('Code')
+    return None
+
+
+def is_throttle(error):
+    return error_code(error) in THROTTLE_CODES
+
+
+def is_not_found(error):
+    return error_code(error) in NOT_FOUND_CODES
+
+
+def is_credential_error(error):
+    return isinstance(error, CREDENTIAL_ERRORS) \
+        or error_code(error) in CREDENTIAL_CODES
+
+
+def classify_error(error):
+    """
+    Returns NOT_FOUND, THROTTLED, TRANSIENT (network errors and
+    server-side failures) or FATAL (everything else) for the error.
+    """
+    code = error_code(error)
+    if code in NOT_FOUND_CODES:
+        return NOT_FOUND
+    if code in THROTTLE_CODES:
+        return THROTTLED
+    if code in TRANSIENT_CODES or isinstance(error, TRANSIENT_ERRORS):
+        return TRANSIENT
+    return FATAL
+
+
+# shared states of objects like CircuitBreaker in this process, by name
+_shared_states = {}
+
+
+def attach_shared(states):
+    """
+    Pool initializer that makes shared states, e.g., from
+    {obj.name: obj.state}, available in a worker process.
+    """
+    _shared_states.update(states)
+
+
+class SharedState:
+    """
+    Base class for objects with a state of doubles that is shared with
+    worker processes. The state is not pickled with the object.
+    Instead, pools are created with initializer=attach_shared and the
+    states of all shared objects, so unpickled copies find their state.
+    """
+    def __init__(self, values):
+        self.name = uuid.uuid4().hex
+        self.initial = list(values)
+        self.state = mp.Array('d', self.initial)
+        _shared_states[self.name] = self.state
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['state']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.state = _shared_states.get(self.name)
+        if self.state is None:
+            self.state = mp.Array('d', self.initial)
+            _shared_states[self.name] = self.state
+
+
+def shared_states(*objs):
+    return {obj.name: obj.state for obj in objs}
+
+
+class CircuitBreaker(SharedState):
+    """
+    Pause all requests, including those of other worker processes,
+    while the endpoint is unavailable.
+    After threshold consecutive transient errors the breaker opens and
+    requests wait for cooldown seconds. Requests then resume; the next
+    error opens the breaker again with twice the cooldown
+    (up to max_cooldown), a successful request closes it.
+    """
+    FAILURES, PAUSE_UNTIL, COOLDOWN = range(3)
+
+    def __init__(self, threshold=20, cooldown=5.0, max_cooldown=300.0):
+        super().__init__([0, 0, cooldown])
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.max_cooldown = max_cooldown
+
+    def is_open(self):
+        return self.state[self.PAUSE_UNTIL] > time.time()
+
+    def wait(self):
+        while True:
+            delay = self.state[self.PAUSE_UNTIL] - time.time()
+            if delay <= 0:
+                return
+            time.sleep(min(delay, 1.0))
+
+    def success(self):
+        state = self.state
+        # avoid the lock in the common case
+        if state[self.FAILURES] == 0:
+            return
+        with state.get_lock():
+            state[self.FAILURES] = 0
+            state[self.COOLDOWN] = self.cooldown
+
+    def failure(self):
+        state = self.state
+        with state.get_lock():
+            state[self.FAILURES] += 1
+            now = time.time()
+            if state[self.FAILURES] < self.threshold \
+                    or state[self.PAUSE_UNTIL] > now:
+                return
+            cooldown = state[self.COOLDOWN]
+            state[self.PAUSE_UNTIL] = now + cooldown
+            state[self.COOLDOWN] = min(2 * cooldown, self.max_cooldown)
+        tqdm.write(f'endpoint unavailable, pausing for {cooldown:.0f}s')
+
+
+class RetryPolicy:
+    """
+    Call functions that make requests and retry them on
+    throttling and transient errors, up to attempts times.
+    Retries wait with exponential backoff and full jitter, i.e.,
+    a random time up to min(max_delay, base_delay * 2**attempt).
+    Not found and fatal errors are raised immediately.
+
+    If a breaker is given, requests wait while it is open and transient
+    errors are reported to it. Attempts that fail while the breaker is
+    open are not counted, so an outage does not use up the retries.
+    """
+    def __init__(
+            self,
+            attempts=8,
+            base_delay=0.1,
+            max_delay=30.0,
+            breaker=None,
+    ):
+        self.attempts = attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.breaker = breaker
+
+    def backoff(self, attempt):
+        return random.uniform(
+            0, min(self.max_delay, self.base_delay * 2 ** attempt)
+        )
+
+    def call(self, fun, args=(), on_error=None):
+        """
+        Returns fun(*args).
+        on_error is called with every error that occurs.
+        """
+        breaker = self.breaker
+        attempt = 0
+        while True:
+            if breaker is not None:
+                breaker.wait()
+            try:
+                result = fun(*args)
+            except Exception as e:
+                if on_error is not None:
+                    on_error(e)
+                kind = classify_error(e)
+                if kind in (NOT_FOUND, FATAL):
+                    raise
+                if kind == TRANSIENT and breaker is not None:
+                    breaker.failure()
+                    if breaker.is_open():
+                        continue
+                attempt += 1
+                if attempt >= self.attempts:
+                    raise
+                time.sleep(self.backoff(attempt))
+                continue
+            if breaker is not None:
+                breaker.success()
+            return result
+
+
+MISSING = '-'
+KEYS_SUFFIX = '.keys'
+
+
+class KeyCache:
+    """
+    Resolved keys of one shard, stored as tab-separated lines
+    ``<canonical key>\t<key>`` in path.
+    Key is - if none of the possible keys of the sample exist.
+    New entries are appended immediately,
+    so the cache survives interrupted runs.
+    """
+    def __init__(self, path):
+        self.path = Path(path)
+        self.keys = {}
+        self.lock = th.Lock()
+        self.fp = None
+        try:
+            with self.path.open('rt', encoding='utf-8') as fp:
+                for line in fp:
+                    # ignore a partial last line from an interrupted run
+                    if not line.endswith('\n'):
+                        break
+                    canonical_key, _, key = line[:-1].partition('\t')
+                    if key:
+                        self.keys[canonical_key] = \
+                            None if key == MISSING else key
+        except FileNotFoundError:
+            pass
+
+    def __contains__(self, canonical_key):
+        return canonical_key in self.keys
+
+    def __len__(self):
+        return len(self.keys)
+
+    def get(self, canonical_key, default=None):
+        return self.keys.get(canonical_key, default)
+
+    def set(self, canonical_key, key):
+        """
+        Record that key exists for the sample with the given canonical key,
+        or that none of its possible keys exist if key is None.
+        """
+        with self.lock:
+            if canonical_key in self.keys \
+                    and self.keys[canonical_key] == key:
+                return
+            self.keys[canonical_key] = key
+            if self.fp is None:
+                self.fp = self.path.open('at', encoding='utf-8')
+            self.fp.write(f'{canonical_key}\t{key or MISSING}\n')
+            self.fp.flush()
+
+    def close(self):
+        with self.lock:
+            if self.fp is not None:
+                self.fp.close()
+                self.fp = None
+
+
+class KeyCacheStore:
+    """
+    Opens the KeyCache of shards in outdir on demand.
+    Samples belong to the shard given by the first 3 characters of their key.
+    """
+    def __init__(self, outdir):
+        self.outdir = Path(outdir)
+        self.caches = {}
+        self.lock = th.Lock()
+
+    def __getitem__(self, shard):
+        with self.lock:
+            cache = self.caches.get(shard)
+            if cache is None:
+                path = self.outdir / (shard + KEYS_SUFFIX)
+                cache = self.caches[shard] = KeyCache(path)
+            return cache
+
+    def for_sample(self, sample):
+        return self[sample['key'][:3]]
+
+    def close(self, shard):
+        with self.lock:
+            cache = self.caches.pop(shard, None)
+        if cache is not None:
+            cache.close()
+
+
+def candidate_keys(sample, cache=None):
+    """
+    Returns the canonical key of the sample and the keys to request,
+    without duplicates.
+    The key found in the cache is requested first,
+    no keys are requested if the cache knows the sample does not exist.
+    Cached keys that are not possible keys of the sample anymore, e.g.,
+    because its extension changed, are ignored and replaced once the
+    sample is resolved again.
+    """
+    canonical_key = None
+    keys = []
+    for canonical_key, key in get_possible_keys(sample):
+        if key not in keys:
+            keys.append(key)
+    if cache is not None and canonical_key in cache:
+        known = cache.get(canonical_key)
+        if known is None:
+            return canonical_key, []
+        if known in keys:
+            keys.remove(known)
+            keys.insert(0, known)
+    return canonical_key, keys
+
+
+class RangedObject:
+    """
+    An object of size bytes of which only the first part was downloaded.
+    The remaining parts of part_size bytes are requested by iterating
+    over parts.
+    """
+    def __init__(self, key, first, size, part_size):
+        self.key = key
+        self.first = first
+        self.size = size
+        self.part_size = part_size
+
+    def __len__(self):
+        return self.size
+
+    def parts(self, fetch_range, pool, parallelism):
+        """
+        Yield the content of the object in order: first the part that was
+        already downloaded, then the remaining parts, which are requested
+        with fetch_range(start, end), at most parallelism at a time.
+        Parts are requested in the thread pool once iteration starts.
+        If the next part has not been started by the pool yet, e.g.,
+        because the pool is busy with parts of other objects, the
+        iterating thread requests it itself.
+        """
+        starts = iter(range(len(self.first), self.size, self.part_size))
+        pending = deque()
+
+        def submit():
+            start = next(starts, None)
+            if start is not None:
+                end = min(start + self.part_size, self.size) - 1
+                part = _Part(fetch_range, start, end)
+                pending.append(part)
+                pool.apply_async(part.run)
+
+        try:
+            for _ in range(parallelism):
+                submit()
+            yield self.first
+            while pending:
+                data = pending.popleft().result()
+                submit()
+                yield data
+        finally:
+            # iteration stopped early, parts not started are not needed
+            for part in pending:
+                part.cancel()
+
+
+class _Part:
+    """
+    A ranged request that is run by whichever thread claims it first.
+    """
+    def __init__(self, fetch_range, start, end):
+        self.fetch_range = fetch_range
+        self.start = start
+        self.end = end
+        self.claimed = th.Lock()
+        self.done = th.Event()
+        self.data = None
+        self.error = None
+
+    def run(self):
+        if not self.claimed.acquire(blocking=False):
+            return
+        try:
+            self.data = self.fetch_range(self.start, self.end)
+        except BaseException as e:
+            self.error = e
+        finally:
+            self.done.set()
+
+    def cancel(self):
+        if self.claimed.acquire(blocking=False):
+            self.done.set()
+
+    def result(self):
+        self.run()
+        self.done.wait()
+        if self.error is not None:
+            raise self.error
+        return self.data
+
+
+class S3Connections:
+    """
+    One low-level S3 client for all threads of a process.
+    Clients are thread-safe and keep a pool of up to max_pool_connections
+    HTTP connections, which are kept alive and reused by all threads for as
+    long as the process lives.
+    Resources are not thread-safe, so every thread gets its own Bucket,
+    but all of them send requests through the client of the process.
+    Use s3_connections to get the instance of the current process.
+    """
+    def __init__(self, endpoint_url=None, max_pool_connections=10):
+        self.endpoint_url = endpoint_url
+        self.max_pool_connections = max_pool_connections
+        self.lock = th.Lock()
+        self.local = th.local()
+        self.resource = None
+        self.requests = 0
+        self.connections = 0
+
+    def _resource(self):
+        with self.lock:
+            if self.resource is None:
+                # retries are handled by RetryPolicy
+                config = Config(
+                    retries={'mode': 'standard', 'max_attempts': 1},
+                    max_pool_connections=self.max_pool_connections,
+                )
+                if self.endpoint_url:
+                    config = config.merge(
+                        Config(s3={'addressing_style': 'path'})
+                    )
+                self.resource = boto3.Session().resource(
+                    's3', endpoint_url=self.endpoint_url, config=config,
+                )
+            return self.resource
+
+    @property
+    def client(self):
+        return self._resource().meta.client
+
+    def bucket(self, name):
+        """
+        Returns the Bucket name of this thread.
+        """
+        buckets = getattr(self.local, 'buckets', None)
+        if buckets is None:
+            buckets = self.local.buckets = {}
+        bucket = buckets.get(name)
+        if bucket is None:
+            bucket = buckets[name] = self._resource().Bucket(name)
+        return bucket
+
+    def _pools(self):
+        # botocore does not expose its urllib3 pools
+        http_session = getattr(self.client._endpoint, 'http_session', None)
+        managers = [getattr(http_session, '_manager', None)]
+        managers.extend(getattr(http_session, '_proxy_managers', {}).values())
+        for manager in managers:
+            if manager is None:
+                continue
+            for pool_key in manager.pools.keys():
+                pool = manager.pools.get(pool_key)
+                if pool is not None:
+                    yield pool
+
+    def take_stats(self):
+        """
+        Returns the number of requests sent and HTTP connections opened
+        since the last call. Requests per connection show whether
+        connections are reused.
+        """
+        with self.lock:
+            if self.resource is None:
+                return 0, 0
+        requests = connections = 0
+        for pool in self._pools():
+            requests += pool.num_requests
+            connections += pool.num_connections
+        with self.lock:
+            # pools may have been discarded
+            delta = (
+                max(requests - self.requests, 0),
+                max(connections - self.connections, 0),
+            )
+            self.requests = requests
+            self.connections = connections
+        return delta
+
+
+# S3Connections of this process by (pid, endpoint, pool size)
+_connections = {}
+_connections_lock = th.Lock()
+
+
+def s3_connections(endpoint_url=None, max_pool_connections=10):
+    """
+    Returns the S3Connections of this process.
+    The process ID is part of the key, so forked workers never use the
+    connections of their parent.
+    """
+    key = os.getpid(), endpoint_url, max_pool_connections
+    with _connections_lock:
+        connections = _connections.get(key)
+        if connections is None:
+            connections = _connections[key] = S3Connections(
+                endpoint_url, max_pool_connections
+            )
+    return connections
+
+
+def get_object(bucket, key, part_size=0):
+    """
+    Returns the content of key with one GET request,
+    or None if it does not exist.
+    With part_size, only the first part_size bytes are requested and a
+    RangedObject is returned if the object is larger.
+    Other errors are raised.
+    """
+    try:
+        if not part_size:
+            return bucket.Object(key).get()['Body'].read()
+        response = bucket.Object(key).get(Range=f'bytes=0-{part_size-1}')
+        data = response['Body'].read()
+    except Exception as e:
+        if is_not_found(e):
+            return None
+        # empty objects have no first byte
+        if error_code(e) == 'InvalidRange':
+            return b''
+        raise
+    content_range = response.get('ContentRange')
+    size = int(content_range.rpartition('/')[2]) if content_range \
+        else len(data)
+    if size > len(data):
+        return RangedObject(key, data, size, part_size)
+    return data
+
+
+def get_range(bucket, key, start, end, limiter=None):
+    """
+    Returns bytes start to end (inclusive) of key with a ranged GET.
+    Requests and downloaded bytes are counted by limiter, if given.
+    """
+    if limiter is not None:
+        limiter.request()
+    body = bucket.Object(key).get(Range=f'bytes={start}-{end}')['Body']
+    data = body.read()
+    if len(data) != end - start + 1:
+        raise IncompleteReadError(
+            actual_bytes=len(data), expected_bytes=end - start + 1
+        )
+    if limiter is not None:
+        limiter.consume(len(data))
+    return data
+
+
+def fetch_sample(bucket, sample, cache=None, limiter=None, part_size=0):
+    """
+    Download the first possible key of the sample that exists.
+    Returns (key, data), or (canonical key, None) if no key exists.
+    With part_size, data is a RangedObject for objects larger than
+    part_size, see get_object.
+    The result is recorded in cache, if given.
+    Requests and downloaded bytes are counted by limiter, if given.
+    """
+    canonical_key, keys = candidate_keys(sample, cache)
+    for key in keys:
+        if limiter is not None:
+            limiter.request()
+        data = get_object(bucket, key, part_size)
+        if data is not None:
+            if limiter is not None:
+                limiter.consume(len(getattr(data, 'first', data)))
+            if cache is not None:
+                cache.set(canonical_key, key)
+            return key, data
+    if cache is not None:
+        cache.set(canonical_key, None)
+    return canonical_key, None
+
+
+def object_exists(bucket, key):
+    try:
+        bucket.Object(key).load()
+        return True
+    except Exception as e:
+        if is_not_found(e):
+            return False
+        raise
+
+
+def sample_exists(bucket, sample, cache=None, limiter=None):
+    """
+    Check whether any possible key of the sample exists with HEAD requests.
+    The result is recorded in cache, if given.
+    """
+    canonical_key, keys = candidate_keys(sample, cache)
+    if cache is not None and canonical_key in cache:
+        return bool(keys)
+    for key in keys:
+        if limiter is not None:
+            limiter.request()
+        if object_exists(bucket, key):
+            if cache is not None:
+                cache.set(canonical_key, key)
+            return True
+    if cache is not None:
+        cache.set(canonical_key, None)
+    return False
+
+
+MANIFEST_TTL = 24 * 3600
+
+
+def list_keys(bucket, prefix, limiter=None):
+    """
+    Returns the keys of all objects under prefix,
+    requested with paginated ListObjectsV2.
+    """
+    client = bucket.meta.client
+    paginator = client.get_paginator('list_objects_v2')
+    keys = []
+    for page in paginator.paginate(Bucket=bucket.name, Prefix=prefix):
+        if limiter is not None:
+            limiter.request()
+        keys.extend(obj['Key'] for obj in page.get('Contents', ()))
+    return keys
+
+
+def load_manifest(
+        bucket,
+        outdir,
+        shard,
+        kinds,
+        ttl=MANIFEST_TTL,
+        limiter=None,
+):
+    """
+    Returns the set of keys of all objects of the given kinds in the shard.
+    Listings are cached in <shard>.<kind>.manifest.gz files in outdir
+    and listed again if they are older than ttl seconds.
+    """
+    keys = set()
+    for kind in kinds:
+        path = Path(outdir) / f'{shard}.{DATAKEYS[kind]}.manifest.gz'
+        try:
+            fresh = time.time() - path.stat().st_mtime < ttl
+        except FileNotFoundError:
+            fresh = False
+        if fresh:
+            with gzip.open(path, 'rt', encoding='utf-8') as fp:
+                keys.update(line.rstrip('\n') for line in fp)
+            continue
+        listed = list_keys(bucket, f'{PREFIX[kind]}/{shard}/', limiter)
+        tmppath = path.with_name(path.name + '.tmp')
+        with gzip.open(tmppath, 'wt', encoding='utf-8') as fp:
+            for key in sorted(listed):
+                fp.write(key+'\n')
+        os.replace(tmppath, path)
+        keys.update(listed)
+    return keys